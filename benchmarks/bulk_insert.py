@@ -0,0 +1,115 @@
+""" Compara la inserción de viajes por filas (unnest + RETURNING) contra COPY binario
+
+Uso: python -m benchmarks.bulk_insert --rows 100000
+
+Requiere las variables POSTGRES_* de la aplicación. Las tablas se crean en un
+esquema temporal que se elimina al terminar, por lo que no modifica los datos existentes.
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, cast
+
+import asyncpg
+import numpy as np
+import pandas as pd
+
+from optimized_shifts.celery.tasks import insert_trips
+
+
+def synthetic_trips(rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    start = np.datetime64("2018-05-01T00:00:00")
+    return pd.DataFrame(
+        {
+            "region": rng.choice(["Prague", "Turin", "Hamburg"], rows),
+            "timestamp": start + rng.integers(0, 60 * 60 * 24 * 90, rows).astype("timedelta64[s]"),
+            "source": rng.choice(["funny_car", "baba_car", "cheap_mobile"], rows),
+            "origin_x": rng.uniform(7.0, 15.0, rows),
+            "origin_y": rng.uniform(44.0, 54.0, rows),
+            "destination_x": rng.uniform(7.0, 15.0, rows),
+            "destination_y": rng.uniform(44.0, 54.0, rows),
+        }
+    )
+
+
+async def legacy_insert(
+    conn: "asyncpg.Connection[asyncpg.Record]",
+    df: pd.DataFrame,
+    regions_id_mapped: dict[str, int],
+):
+    """ Ruta de inserción previa: indexado con df.loc por fila y RETURNING de todo lo insertado """
+    stmt = """
+    INSERT INTO trips (region_id, origin, destination, timestamp, source) (
+        SELECT r.region_id, r.origin, r.destination, r.timestamp, r.source
+        FROM unnest($1::trips[]) as r
+    )
+    RETURNING trip_id, region_id, origin, destination, timestamp, source
+    """
+    return await conn.fetch(
+        stmt,
+        [
+            (
+                None,
+                cast(int, regions_id_mapped[df.loc[i, "region"]]),  # type: ignore
+                (df.loc[i, "origin_x"], df.loc[i, "origin_y"]),
+                (df.loc[i, "destination_x"], df.loc[i, "destination_y"]),
+                df.loc[i, "timestamp"],
+                df.loc[i, "source"],
+                None,
+                None,
+            )
+            for i in range(len(df))
+        ],
+    )
+
+
+async def main(rows: int):
+    conn = await asyncpg.connect(
+        host=os.environ.get("POSTGRES_HOST"),
+        user=os.environ.get("POSTGRES_USER"),
+        password=os.environ.get("POSTGRES_PASSWORD"),
+        database=os.environ.get("POSTGRES_DB"),
+    )
+    schema = f"bench_{os.getpid()}"
+    df = synthetic_trips(rows)
+
+    try:
+        await conn.execute(
+            f"""
+            CREATE SCHEMA {schema};
+            SET search_path TO {schema};
+            CREATE TABLE regions (LIKE public.regions INCLUDING ALL);
+            CREATE TABLE trips (LIKE public.trips INCLUDING ALL);
+            """
+        )
+        names = sorted(df["region"].unique())  # type: ignore
+        regions = await conn.fetch(
+            "INSERT INTO regions (region_name) SELECT unnest($1::text[]) RETURNING *",
+            names,
+        )
+        regions_id_mapped = {row["region_name"]: row["region_id"] for row in regions}
+
+        paths: dict[str, Callable[..., Awaitable[Any]]] = {
+            "legacy (df.loc + unnest RETURNING)": legacy_insert,
+            "copy (columnar + COPY)": insert_trips,
+        }
+        for name, insert in paths.items():
+            await conn.execute("TRUNCATE trips")
+            start = time.perf_counter()
+            await insert(conn, df, regions_id_mapped)
+            elapsed = time.perf_counter() - start
+            print(f"{name:<40} {rows / elapsed:>14,.0f} rows/s ({elapsed:.2f}s)")
+    finally:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        await conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100_000)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.rows))
@@ -0,0 +1,116 @@
+""" Mide el throughput de la ingesta de archivos según la cantidad de shards de viajes
+
+Uso: SHARD_DATABASES=postgresql://...,postgresql://... python -m benchmarks.shard_ingestion --rows 1000000
+
+Genera un archivo con `--rows` viajes sintéticos repartidos en `--regions` regiones y lo ingiere con
+`process_data_task` usando los primeros 1, 2, ..., N shards de SHARD_DATABASES. Cada corrida usa
+regiones nuevas, así se reparten entre los shards de esa corrida. Al terminar elimina las regiones y
+sus viajes de todos los shards, salvo con --keep.
+
+Requiere las variables POSTGRES_* de la aplicación (la base de datos de metadatos) y shards con
+init.sql aplicado, usar bases de datos de pruebas. Con docker-compose.shards.yaml cada shard corre
+en su propio contenedor; varios shards en un mismo servidor comparten sus CPU y discos.
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from datetime import datetime
+
+import asyncpg
+import numpy as np
+import pandas as pd
+
+from optimized_shifts.celery.config import celeryconfig
+from optimized_shifts.celery.shards import ShardRouter, connect_shards
+from optimized_shifts.celery.tasks import process_data_task
+
+START = datetime(2023, 1, 1)
+SECONDS = 365 * 24 * 60 * 60
+
+# Tablas con filas de las regiones del benchmark en cada shard
+SHARD_TABLES = ("trips", "trips_weekly_cells", "trips_sample", "trip_groups", "regions")
+
+
+def synthetic_csv(path: str, rows: int, regions: list[str], rng: np.random.Generator):
+    xs, ys = rng.uniform(7.0, 8.0, (2, rows)), rng.uniform(45.0, 46.0, (2, rows))
+    frame = pd.DataFrame(
+        {
+            "region": np.array(regions)[rng.integers(0, len(regions), rows)],
+            "origin_coord": "POINT (" + pd.Series(xs[0]).astype(str) + " " + pd.Series(ys[0]).astype(str) + ")",
+            "destination_coord": "POINT (" + pd.Series(xs[1]).astype(str) + " " + pd.Series(ys[1]).astype(str) + ")",
+            "datetime": pd.Timestamp(START) + pd.to_timedelta(rng.integers(0, SECONDS, rows), unit="s"),
+            "datasource": "benchmark",
+        }
+    )
+    frame.to_csv(path, index=False)
+
+
+async def cleanup(router: ShardRouter, names: list[str]):
+    region_ids = [
+        row["region_id"]
+        for row in await router.metadata.fetch(
+            "SELECT region_id FROM regions WHERE region_name = ANY($1::text[])", names
+        )
+    ]
+    for pool in router.pools:
+        for table in SHARD_TABLES:
+            await pool.execute(f"DELETE FROM {table} WHERE region_id = ANY($1::int[])", region_ids)
+
+    await router.metadata.execute("DELETE FROM region_shards WHERE region_id = ANY($1::int[])", region_ids)
+    await router.metadata.execute("DELETE FROM regions WHERE region_id = ANY($1::int[])", region_ids)
+
+
+async def main(rows: int, regions: int, chunksize: int, keep: bool):
+    metadata = await asyncpg.create_pool(
+        host=os.environ.get("POSTGRES_HOST"),
+        user=os.environ.get("POSTGRES_USER"),
+        password=os.environ.get("POSTGRES_PASSWORD"),
+        database=os.environ.get("POSTGRES_DB"),
+    )
+    if not metadata:
+        raise ValueError("Unable to connect with database")
+
+    shards = await connect_shards(celeryconfig.SHARD_DATABASES) or [metadata]
+    router = ShardRouter(metadata, shards)
+    names: list[str] = []
+
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            print(f"{'shards':>6} {'seconds':>8} {'trips/s':>10} {'speedup':>8}")
+            baseline = None
+            for count in range(1, len(shards) + 1):
+                run = [f"Shard benchmark {count}-{i}" for i in range(regions)]
+                names += run
+                path = os.path.join(directory, f"trips-{count}.csv")
+                synthetic_csv(path, rows, run, np.random.default_rng(count))
+
+                start = time.perf_counter()
+                result = await process_data_task(
+                    "mocked", path, chunksize, shards=ShardRouter(metadata, shards[:count])
+                )
+                elapsed = time.perf_counter() - start
+                if result is None or result.rows != rows:
+                    raise AssertionError(f"{count} shards inserted {result and result.rows} trips")
+
+                throughput = rows / elapsed
+                baseline = baseline or throughput
+                print(f"{count:>6} {elapsed:>8.1f} {throughput:>10,.0f} {throughput / baseline:>7.2f}x")
+    finally:
+        if not keep:
+            await cleanup(router, names)
+        for pool in {*shards, metadata}:
+            await pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--regions", type=int, default=8, help="Regions of each run, spread between its shards")
+    parser.add_argument("--chunksize", type=int, default=celeryconfig.INGEST_CHUNK_SIZE)
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic trips")
+    args = parser.parse_args()
+
+    asyncio.run(main(args.rows, args.regions, args.chunksize, args.keep))
@@ -0,0 +1,173 @@
+""" Compara el promedio semanal de /trips/stats calculado en la base de datos contra el motor columnar
+
+Uso: python -m benchmarks.stats_backend --rows 10000000 --queries 200
+
+Inserta `--rows` viajes sintéticos en una región nueva (con sus conteos en trips_weekly_cells), carga
+el motor columnar desde la base de datos y desde un snapshot, y calcula el promedio de los mismos bbox
+aleatorios con ambos backends, verificando que coincidan. Al terminar elimina la región y sus viajes,
+salvo con --keep.
+
+Requiere las variables POSTGRES_* de la aplicación, usar una base de datos de pruebas.
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import tempfile
+import time
+from datetime import datetime
+
+import asyncpg
+import numpy as np
+import pandas as pd
+
+from optimized_shifts.celery.snapshot import export_snapshot_task
+from optimized_shifts.columnar import TripsColumnStore
+from optimized_shifts.crud.region import RegionRepository
+from optimized_shifts.crud.trips import TripsRepository
+
+REGION = "Benchmark"
+START = datetime(2023, 1, 1)
+SECONDS = 365 * 24 * 60 * 60
+CHUNK = 1_000_000
+
+# Lado de los bbox consultados, en unidades de coordenadas
+BBOX_SIZES = (0.05, 0.2, 0.5)
+
+
+def synthetic_csv(region_id: int, rows: int, rng: np.random.Generator) -> bytes:
+    xs, ys = rng.uniform(7.0, 8.0, (2, rows)), rng.uniform(45.0, 46.0, (2, rows))
+    seconds = rng.integers(0, SECONDS, rows)
+    frame = pd.DataFrame(
+        {
+            "region_id": region_id,
+            "origin": "(" + pd.Series(xs[0]).astype(str) + "," + pd.Series(ys[0]).astype(str) + ")",
+            "destination": "(" + pd.Series(xs[1]).astype(str) + "," + pd.Series(ys[1]).astype(str) + ")",
+            "timestamp": pd.Timestamp(START) + pd.to_timedelta(seconds, unit="s"),
+            "source": "benchmark",
+        }
+    )
+    return frame.to_csv(index=False, header=False).encode()
+
+
+async def populate(db: "asyncpg.Pool[asyncpg.Record]", region_id: int, rows: int):
+    rng = np.random.default_rng(0)
+    start = time.perf_counter()
+    async with db.acquire() as conn:
+        await conn.execute(
+            "SELECT ensure_trips_partitions($1, $2)", START, START + pd.Timedelta(seconds=SECONDS)
+        )
+        for offset in range(0, rows, CHUNK):
+            data = synthetic_csv(region_id, min(CHUNK, rows - offset), rng)
+            await conn.copy_to_table(
+                "trips",
+                source=io.BytesIO(data),
+                columns=["region_id", "origin", "destination", "timestamp", "source"],
+                format="csv",
+            )
+
+        await conn.execute(
+            """
+            INSERT INTO trips_weekly_cells
+            SELECT
+                region_id,
+                DATE_TRUNC('week', timestamp),
+                trips_grid_cell(origin[0]),
+                trips_grid_cell(origin[1]),
+                trips_grid_cell(destination[0]),
+                trips_grid_cell(destination[1]),
+                COUNT(*)
+            FROM trips
+            WHERE region_id = $1
+            GROUP BY 1, 2, 3, 4, 5, 6
+            """,
+            region_id,
+        )
+        await conn.execute("ANALYZE trips")
+        await conn.execute("ANALYZE trips_weekly_cells")
+
+    print(f"inserted {rows:,} trips in {time.perf_counter() - start:.1f}s")
+
+
+def random_bboxes(queries: int, size: float, rng: np.random.Generator):
+    corners = rng.uniform((7.0, 45.0), (8.0 - size, 46.0 - size), (queries, 2))
+    return [((x, y), (x + size, y + size)) for x, y in corners]
+
+
+def report(name: str, latencies: list[float]):
+    ms = np.array(latencies) * 1000
+    print(
+        f"  {name:<9} p50={np.percentile(ms, 50):8.2f}ms p95={np.percentile(ms, 95):8.2f}ms "
+        f"{len(ms) / ms.sum() * 1000:>9,.0f} queries/s"
+    )
+
+
+async def main(rows: int, queries: int, keep: bool):
+    db = await asyncpg.create_pool(
+        host=os.environ.get("POSTGRES_HOST"),
+        user=os.environ.get("POSTGRES_USER"),
+        password=os.environ.get("POSTGRES_PASSWORD"),
+        database=os.environ.get("POSTGRES_DB"),
+    )
+    if not db:
+        raise ValueError("Unable to connect with database")
+
+    region_id = (await RegionRepository.get_or_create_multiple({REGION}, db))[REGION]
+    try:
+        if not await db.fetchval("SELECT EXISTS(SELECT 1 FROM trips WHERE region_id = $1)", region_id):
+            await populate(db, region_id, rows)
+
+        store = TripsColumnStore()
+        start = time.perf_counter()
+        await store.load(db)
+        print(f"columnar load of {len(store):,} trips in {time.perf_counter() - start:.1f}s")
+
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            await export_snapshot_task(directory, store.grid_size, pool=db)
+            print(f"snapshot export in {time.perf_counter() - start:.1f}s")
+
+            start = time.perf_counter()
+            await TripsColumnStore(snapshot_dir=directory).load(db)
+            print(f"columnar load from the snapshot in {time.perf_counter() - start:.2f}s")
+
+        rng = np.random.default_rng(1)
+        for size in BBOX_SIZES:
+            sql: list[float] = []
+            columnar: list[float] = []
+            for bbox in random_bboxes(queries, size, rng):
+                start = time.perf_counter()
+                expected = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
+                    bbox, region_id, db
+                )
+                sql.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                result = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
+                    bbox, region_id, db, store=store
+                )
+                columnar.append(time.perf_counter() - start)
+
+                if not np.isclose(result.mean or 0, expected.mean or 0):
+                    raise AssertionError(f"{bbox}: columnar {result.mean} != sql {expected.mean}")
+
+            print(f"-- bbox {size} x {size}, {queries} queries")
+            report("sql", sql)
+            report("columnar", columnar)
+    finally:
+        if not keep:
+            await db.execute("DELETE FROM trips WHERE region_id = $1", region_id)
+            await db.execute("DELETE FROM trips_weekly_cells WHERE region_id = $1", region_id)
+            await db.execute("DELETE FROM regions WHERE region_id = $1", region_id)
+        await db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic trips for another run")
+    args = parser.parse_args()
+
+    asyncio.run(main(args.rows, args.queries, args.keep))
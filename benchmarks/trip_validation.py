@@ -0,0 +1,99 @@
+""" Compara la validación de viajes con los validadores en Python previos contra TripRequestList
+
+Uso: python -m benchmarks.trip_validation --sizes 10000 100000 1000000
+"""
+
+import argparse
+import json
+import time
+from datetime import datetime
+from typing import Any
+
+import numpy as np
+from pydantic import BaseModel, TypeAdapter, field_validator
+
+from optimized_shifts.schemas.trip import TripRequestList
+
+
+class LegacyTripRequest(BaseModel):
+    """ Esquema previo: json.loads y strptime en validadores de Python por cada campo """
+    region: str
+    origin: tuple[float, float]
+    destination: tuple[float, float]
+    timestamp: datetime
+    source: str
+
+    @field_validator("origin", "destination", mode="before")
+    @classmethod
+    def validate_string_point(cls, raw: str | list[Any]) -> tuple[float, float]:
+        if isinstance(raw, str):
+            raw = json.loads(raw)
+        x, y = float(raw[0]), float(raw[1])  # type: ignore
+        return (x, y)
+
+    @field_validator("timestamp", mode="before")
+    @classmethod
+    def validate_timestamp(cls, raw: str) -> datetime:
+        return datetime.strptime(raw, "%Y-%m-%d %H:%M:%S")
+
+
+LegacyTripRequestList = TypeAdapter(list[LegacyTripRequest])
+
+
+def synthetic_payload(rows: int, seed: int = 0) -> list[dict[str, Any]]:
+    rng = np.random.default_rng(seed)
+    xs, ys = rng.uniform(7.0, 15.0, (2, rows)), rng.uniform(44.0, 54.0, (2, rows))
+    seconds = rng.integers(0, 60 * 60 * 24 * 90, rows)
+    start = datetime(2018, 5, 1).timestamp()
+    return [
+        {
+            "region": "Turin",
+            # Half of the points come as JSON strings, as the API accepts both forms
+            "origin": f"[{xs[0, i]}, {ys[0, i]}]" if i % 2 else [xs[0, i], ys[0, i]],
+            "destination": [xs[1, i], ys[1, i]],
+            "timestamp": datetime.fromtimestamp(start + seconds[i]).strftime("%Y-%m-%d %H:%M:%S"),
+            "source": "funny_car",
+        }
+        for i in range(rows)
+    ]
+
+
+def measure(name: str, validate, raw: bytes, rows: int, repeat: int):  # type: ignore
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        validate(raw)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<40} {rows / best:>14,.0f} records/s ({best:.3f}s)")
+
+
+def main(sizes: list[int], repeat: int):
+    for rows in sizes:
+        raw = json.dumps(synthetic_payload(rows)).encode()
+        print(f"-- {rows:,} records")
+
+        # The API parses the body with json.loads and then validates it, as FastAPI does
+        measure(
+            "legacy (json.loads + python validators)",
+            lambda raw: LegacyTripRequestList.validate_python(json.loads(raw)),
+            raw,
+            rows,
+            repeat,
+        )
+        measure(
+            "json.loads + TripRequestList",
+            lambda raw: TripRequestList.validate_python(json.loads(raw)),
+            raw,
+            rows,
+            repeat,
+        )
+        measure("TripRequestList.validate_json", TripRequestList.validate_json, raw, rows, repeat)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    main(args.sizes, args.repeat)
@@ -0,0 +1,114 @@
+""" Prueba de carga del websocket de notificaciones con distinta cantidad de workers de uvicorn
+
+Uso: python -m benchmarks.ws_fanout --workers 1 2 4 --clients 2000 --messages 50
+
+Por cada cantidad de workers levanta `uvicorn main:app --workers N`, conecta `--clients`
+websockets (repartidos por el sistema operativo entre los procesos), publica `--messages`
+notificaciones en Redis y mide cuánto tardan en llegar a todos los clientes. Verifica además
+que cada cliente reciba cada notificación exactamente una vez.
+
+Requiere las variables POSTGRES_* y BROKER_URL de la aplicación.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from collections import Counter
+
+import websockets
+from redis import asyncio as aioredis
+
+from optimized_shifts.celery.config import celeryconfig
+from optimized_shifts.celery.processer import NOTIFICATIONS_CHANNEL
+
+
+def start_server(workers: int, port: int) -> subprocess.Popen[bytes]:
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/api/v1/trips/live/metrics", timeout=1)
+            return server
+        except OSError:
+            time.sleep(0.2)
+
+    server.terminate()
+    raise TimeoutError("uvicorn didn't start")
+
+
+async def wait_for_subscribers(redis: "aioredis.Redis[bytes]", workers: int):
+    # Every worker process holds exactly one subscription to the channel
+    while True:
+        [(_, subscribers)] = await redis.pubsub_numsub(NOTIFICATIONS_CHANNEL)
+        if subscribers >= workers:
+            return
+        await asyncio.sleep(0.1)
+
+
+async def client(uri: str, messages: int, connected: asyncio.Event, received: Counter[str]):
+    async with websockets.connect(uri, max_queue=None) as ws:  # type: ignore
+        connected.set()
+        seen: Counter[str] = Counter()
+        while sum(seen.values()) < messages:
+            message = json.loads(await ws.recv())
+            seen[json.loads(message["data"])["task_id"]] += 1
+        received.update(f"{count}" for count in seen.values())
+
+
+async def run(workers: int, clients: int, messages: int, port: int):
+    redis = aioredis.Redis.from_url(celeryconfig.BROKER_URL)
+    server = start_server(workers, port)
+    uri = f"ws://127.0.0.1:{port}/api/v1/trips/live"
+
+    try:
+        await wait_for_subscribers(redis, workers)
+
+        received: Counter[str] = Counter()
+        events = [asyncio.Event() for _ in range(clients)]
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(client(uri, messages, event, received)) for event in events]
+        await asyncio.gather(*(event.wait() for event in events))
+        connect = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(messages):
+            await redis.publish(NOTIFICATIONS_CHANNEL, json.dumps({"task_id": str(i), "status": "DONE"}))
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout=120)
+        elapsed = time.perf_counter() - start
+
+        deliveries = clients * messages
+        exactly_once = received["1"] == deliveries
+        print(
+            f"workers={workers:<3} clients={clients:<6} connect={connect:6.2f}s "
+            f"fan-out={deliveries / elapsed:>12,.0f} msg/s ({elapsed:.2f}s) exactly_once={exactly_once}"
+        )
+    finally:
+        server.terminate()
+        server.wait()
+        await redis.close()
+
+
+async def main(workers: list[int], clients: int, messages: int, port: int):
+    for count in workers:
+        await run(count, clients, messages, port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--port", type=int, default=int(os.environ.get("BENCH_PORT", 8100)))
+    args = parser.parse_args()
+
+    asyncio.run(main(args.workers, args.clients, args.messages, args.port))
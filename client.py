@@ -7,10 +7,7 @@ async def hello():
     async with websockets.connect(uri) as websocket:
         while True:
             message = json.loads(await websocket.recv())
-            if message["type"] == "ping":
-                await websocket.send(json.dumps({"type": "pong"}))
-                continue
-            elif message["type"] == "notification":
+            if message["type"] == "notification":
                 print(message["data"])
 
 if __name__ == "__main__":
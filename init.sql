@@ -1,4 +1,4 @@
-DROP TABLE IF EXISTS regions, trips;
+DROP TABLE IF EXISTS regions, region_shards, trips, trips_weekly_cells, trip_groups, trips_sample;
 
 CREATE TABLE regions (
     region_id INT GENERATED ALWAYS AS IDENTITY,
@@ -6,16 +6,474 @@ CREATE TABLE regions (
     PRIMARY KEY (region_id)
 );
 
+-- Shard (posición en SHARD_DATABASES) que guarda los viajes de cada región. Solo se usa en la
+-- base de datos de metadatos y cuando hay shards configurados; las asignaciones no cambian
+CREATE TABLE region_shards (
+    region_id INT NOT NULL,
+    shard SMALLINT NOT NULL,
+    PRIMARY KEY (region_id)
+);
+
+CREATE INDEX region_shards_shard_idx ON region_shards (shard);
+
+-- Grupos de viajes similares: misma región, origen y destino en la misma celda de
+-- `distance` x `distance` y hora del día en la misma ventana de `time_window` minutos.
+-- Los umbrales son parte de la llave, así cambiarlos genera grupos nuevos
+CREATE TABLE trip_groups (
+    group_id INT GENERATED ALWAYS AS IDENTITY,
+    region_id INT NOT NULL,
+    distance DOUBLE PRECISION NOT NULL,
+    time_window INT NOT NULL,
+    origin_cell_x INT NOT NULL,
+    origin_cell_y INT NOT NULL,
+    destination_cell_x INT NOT NULL,
+    destination_cell_y INT NOT NULL,
+    time_bucket INT NOT NULL,
+    size BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (group_id),
+    UNIQUE (
+        region_id, distance, time_window,
+        origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, time_bucket
+    )
+);
+
+CREATE INDEX trip_groups_region_size_idx ON trip_groups (region_id, size DESC);
+
+-- Viajes particionados por mes según timestamp, las consultas con un rango de fechas solo
+-- leen las particiones de esos meses. trip_id usa una secuencia ya que las columnas
+-- identity no se permiten en tablas particionadas
 CREATE TABLE trips (
-    trip_id INT GENERATED ALWAYS AS IDENTITY,
+    trip_id SERIAL,
     region_id INT,
     origin POINT NOT NULL,
     destination POINT NOT NULL,
     timestamp TIMESTAMP NOT NULL,
     source TEXT,
-    PRIMARY KEY (trip_id),
+    group_id INT,
+    -- Transacción que insertó el viaje. Los ids se toman antes de confirmar, así que un viaje
+    -- con id menor puede confirmarse después; quienes copian los viajes leen los nuevos
+    -- comparando esta columna con el pg_snapshot de su última lectura
+    xact BIGINT DEFAULT pg_current_xact_id()::TEXT::BIGINT,
+    PRIMARY KEY (trip_id, timestamp),
     CONSTRAINT fk_region
         FOREIGN KEY(region_id)
-            REFERENCES regions(region_id)
+            REFERENCES regions(region_id),
+    CONSTRAINT fk_group
+        FOREIGN KEY(group_id)
+            REFERENCES trip_groups(group_id)
+) PARTITION BY RANGE (timestamp);
+
+-- Recibe los viajes de meses sin partición, ensure_trips_partitions los mueve a su
+-- partición cuando esta se crea
+CREATE TABLE trips_default PARTITION OF trips DEFAULT;
+
+-- Los filtros por bounding box del origen/destino usan los índices GiST, la agregación
+-- semanal de una región usa el btree. Cada partición tiene su propia copia
+CREATE INDEX trips_origin_idx ON trips USING GIST (origin);
+CREATE INDEX trips_destination_idx ON trips USING GIST (destination);
+CREATE INDEX trips_region_timestamp_idx ON trips (region_id, timestamp);
+CREATE INDEX trips_group_idx ON trips (group_id);
+-- Las transacciones recientes están en los últimos bloques de cada partición, BRIN descarta
+-- el resto sin el costo de mantener un btree en cada inserción
+CREATE INDEX trips_xact_idx ON trips USING BRIN (xact) WITH (autosummarize = on);
+
+-- Nombre de la partición mensual que contiene a `month`
+CREATE OR REPLACE FUNCTION trips_partition_name(month TIMESTAMP) RETURNS TEXT
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT 'trips_' || to_char(month, 'YYYY_MM') $$;
+
+-- Crea las particiones mensuales que falten entre `since` y `until` (ambos incluidos). La
+-- tabla se crea por separado y luego se adjunta, lo que no bloquea las inserciones en
+-- curso en otras particiones
+CREATE OR REPLACE FUNCTION ensure_trips_partitions(since TIMESTAMP, until TIMESTAMP) RETURNS VOID
+    LANGUAGE plpgsql
+    AS $$
+    DECLARE
+        month TIMESTAMP;
+        partition TEXT;
+    BEGIN
+        FOR month IN
+            SELECT generate_series(DATE_TRUNC('month', since), DATE_TRUNC('month', until), '1 month')
+        LOOP
+            partition := trips_partition_name(month);
+            CONTINUE WHEN to_regclass(partition) IS NOT NULL;
+
+            -- Ingestas concurrentes pueden pedir el mismo mes, solo una la crea
+            PERFORM pg_advisory_xact_lock(hashtext('ensure_trips_partitions'));
+            CONTINUE WHEN to_regclass(partition) IS NOT NULL;
+
+            EXECUTE format(
+                'CREATE TABLE %I (LIKE trips INCLUDING DEFAULTS, CHECK (timestamp >= %L AND timestamp < %L))',
+                partition, month, month + INTERVAL '1 month'
+            );
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM trips_default WHERE timestamp >= %L AND timestamp < %L RETURNING *) '
+                'INSERT INTO %I SELECT * FROM moved',
+                month, month + INTERVAL '1 month', partition
+            );
+            EXECUTE format(
+                'ALTER TABLE trips ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                partition, month, month + INTERVAL '1 month'
+            );
+        END LOOP;
+    END;
+    $$;
+
+-- Adjunta como partición del mes `month` una tabla cargada por fuera de la aplicación (por
+-- ejemplo con COPY sobre una tabla creada con LIKE trips INCLUDING DEFAULTS) y agrega
+-- sus viajes a trips_weekly_cells y a trips_sample. El mes no debe tener partición todavía
+CREATE OR REPLACE FUNCTION attach_trips_partition(loaded REGCLASS, month TIMESTAMP) RETURNS BIGINT
+    LANGUAGE plpgsql
+    AS $$
+    DECLARE
+        since TIMESTAMP := DATE_TRUNC('month', month);
+        attached BIGINT;
+    BEGIN
+        -- Los viajes cargados quedan como insertados por esta transacción, así quienes copian
+        -- los viajes los leen aunque la carga se haya confirmado antes de su última lectura
+        EXECUTE format('UPDATE %s SET xact = pg_current_xact_id()::TEXT::BIGINT', loaded);
+
+        -- Con la restricción validada, ATTACH no vuelve a recorrer la tabla
+        EXECUTE format(
+            'ALTER TABLE %s ADD CONSTRAINT %I CHECK (timestamp >= %L AND timestamp < %L)',
+            loaded, trips_partition_name(since) || '_range', since, since + INTERVAL '1 month'
+        );
+        EXECUTE format(
+            'ALTER TABLE trips ATTACH PARTITION %s FOR VALUES FROM (%L) TO (%L)',
+            loaded, since, since + INTERVAL '1 month'
+        );
+        EXECUTE format(
+            'ALTER TABLE %s DROP CONSTRAINT %I', loaded, trips_partition_name(since) || '_range'
+        );
+
+        EXECUTE format(
+            'INSERT INTO trips_weekly_cells
+            SELECT
+                region_id,
+                DATE_TRUNC(''week'', timestamp),
+                trips_grid_cell(origin[0]),
+                trips_grid_cell(origin[1]),
+                trips_grid_cell(destination[0]),
+                trips_grid_cell(destination[1]),
+                COUNT(*)
+            FROM %s
+            GROUP BY 1, 2, 3, 4, 5, 6', loaded
+        );
+        PERFORM sample_trips(loaded);
+
+        EXECUTE format('SELECT COUNT(*) FROM %s', loaded) INTO attached;
+        RETURN attached;
+    END;
+    $$;
+
+-- Grilla espacial de trips_weekly_cells, las coordenadas se agrupan en celdas de
+-- trips_grid_size() x trips_grid_size()
+CREATE OR REPLACE FUNCTION trips_grid_size() RETURNS DOUBLE PRECISION
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT 0.01::DOUBLE PRECISION $$;
+
+CREATE OR REPLACE FUNCTION trips_grid_cell(coordinate DOUBLE PRECISION) RETURNS INT
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT floor(coordinate / trips_grid_size())::INT $$;
+
+-- Coordenada desplazada `cells` celdas desde el inicio de la celda de `coordinate`
+CREATE OR REPLACE FUNCTION trips_grid_snap(coordinate DOUBLE PRECISION, cells DOUBLE PRECISION)
+    RETURNS DOUBLE PRECISION
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT (trips_grid_cell(coordinate) + cells) * trips_grid_size() $$;
+
+-- Indica si `p` está en una celda completamente contenida en el bbox (px, py), (qx, qy)
+CREATE OR REPLACE FUNCTION trips_grid_interior(
+    p POINT, px DOUBLE PRECISION, py DOUBLE PRECISION, qx DOUBLE PRECISION, qy DOUBLE PRECISION
+) RETURNS BOOLEAN
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$
+        SELECT trips_grid_cell(p[0]) BETWEEN trips_grid_cell(px) + 1 AND trips_grid_cell(qx) - 1
+            AND trips_grid_cell(p[1]) BETWEEN trips_grid_cell(py) + 1 AND trips_grid_cell(qy) - 1
+    $$;
+
+-- Conteo de viajes por región, semana, celda de origen y celda de destino. Cada inserción
+-- agrega sus conteos como filas nuevas (sin bloquear a otras inserciones concurrentes),
+-- por lo que una misma llave puede repetirse hasta que se compacte
+CREATE TABLE trips_weekly_cells (
+    region_id INT NOT NULL,
+    week TIMESTAMP NOT NULL,
+    origin_cell_x INT NOT NULL,
+    origin_cell_y INT NOT NULL,
+    destination_cell_x INT NOT NULL,
+    destination_cell_y INT NOT NULL,
+    count BIGINT NOT NULL
+);
+
+CREATE INDEX trips_weekly_cells_idx ON trips_weekly_cells (
+    region_id, origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y
 );
 
+-- Junta las filas repetidas de una región en una sola por llave
+CREATE OR REPLACE FUNCTION compact_trips_weekly_cells(compacted_region_id INT) RETURNS VOID
+    LANGUAGE SQL
+    AS $$
+        WITH deleted AS (
+            DELETE FROM trips_weekly_cells
+            WHERE region_id = compacted_region_id
+            RETURNING *
+        )
+        INSERT INTO trips_weekly_cells
+        SELECT region_id, week, origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, SUM(count)
+        FROM deleted
+        GROUP BY region_id, week, origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y
+    $$;
+
+-- Recalcula todos los conteos desde trips, para datos insertados fuera de la aplicación
+CREATE OR REPLACE FUNCTION rebuild_trips_weekly_cells() RETURNS VOID
+    LANGUAGE SQL
+    AS $$
+        DELETE FROM trips_weekly_cells;
+
+        INSERT INTO trips_weekly_cells
+        SELECT
+            region_id,
+            DATE_TRUNC('week', timestamp),
+            trips_grid_cell(origin[0]),
+            trips_grid_cell(origin[1]),
+            trips_grid_cell(destination[0]),
+            trips_grid_cell(destination[1]),
+            COUNT(*)
+        FROM trips
+        GROUP BY 1, 2, 3, 4, 5, 6;
+    $$;
+
+-- Muestra de los viajes para las estadísticas aproximadas. Cada viaje entra con probabilidad
+-- 1/16 según un valor `u` uniforme en [0, 1), y se guarda en el nivel más profundo que le
+-- corresponde: 1 si u < 1/16, 2 si u < 1/256 y 3 si u < 1/4096. Leer los niveles >= L es una
+-- muestra de Bernoulli de tasa 16^-L. Cada nivel es una partición con sus propios índices,
+-- así las muestras pequeñas se leen sin recorrer las más grandes
+CREATE TABLE trips_sample (
+    region_id INT NOT NULL,
+    origin POINT NOT NULL,
+    destination POINT NOT NULL,
+    timestamp TIMESTAMP NOT NULL,
+    level SMALLINT NOT NULL
+) PARTITION BY LIST (level);
+
+CREATE TABLE trips_sample_1 PARTITION OF trips_sample FOR VALUES IN (1);
+CREATE TABLE trips_sample_2 PARTITION OF trips_sample FOR VALUES IN (2);
+CREATE TABLE trips_sample_3 PARTITION OF trips_sample FOR VALUES IN (3);
+
+CREATE INDEX trips_sample_origin_idx ON trips_sample USING GIST (origin);
+CREATE INDEX trips_sample_region_timestamp_idx ON trips_sample (region_id, timestamp);
+
+-- Nivel de la muestra de un viaje con valor `u`, NULL si no entra en la muestra
+CREATE OR REPLACE FUNCTION trips_sample_level(u DOUBLE PRECISION) RETURNS SMALLINT
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$
+        SELECT CASE
+            WHEN u < 1.0 / 4096 THEN 3
+            WHEN u < 1.0 / 256 THEN 2
+            WHEN u < 1.0 / 16 THEN 1
+        END::SMALLINT
+    $$;
+
+-- Agrega a la muestra los viajes de `loaded` (trips o una tabla con sus columnas)
+CREATE OR REPLACE FUNCTION sample_trips(loaded REGCLASS) RETURNS VOID
+    LANGUAGE plpgsql
+    AS $$
+    BEGIN
+        EXECUTE format(
+            'INSERT INTO trips_sample
+            SELECT region_id, origin, destination, timestamp, level
+            FROM (
+                SELECT region_id, origin, destination, timestamp, trips_sample_level(random()) AS level
+                FROM %s
+                WHERE region_id IS NOT NULL
+            ) AS sampled
+            WHERE level IS NOT NULL', loaded
+        );
+    END;
+    $$;
+
+-- Vuelve a muestrear todos los viajes, para datos insertados o eliminados fuera de la aplicación
+CREATE OR REPLACE FUNCTION rebuild_trips_sample() RETURNS VOID
+    LANGUAGE plpgsql
+    AS $$
+    BEGIN
+        DELETE FROM trips_sample;
+        PERFORM sample_trips('trips');
+    END;
+    $$;
+
+-- Celda de la grilla de agrupación que contiene a `coordinate`
+CREATE OR REPLACE FUNCTION trip_group_cell(coordinate DOUBLE PRECISION, distance DOUBLE PRECISION)
+    RETURNS INT
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT floor(coordinate / distance)::INT $$;
+
+-- Ventana de `time_window` minutos del día que contiene a `ts`
+CREATE OR REPLACE FUNCTION trip_group_time_bucket(ts TIMESTAMP, time_window INT) RETURNS INT
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT floor(EXTRACT(EPOCH FROM ts::TIME) / (time_window * 60))::INT $$;
+
+-- Agrupa todos los viajes de una región. Cada viaje se asigna a su celda de origen,
+-- destino y ventana horaria, por lo que el costo es lineal en la cantidad de viajes.
+-- Los grupos que quedan vacíos (por ejemplo, de umbrales anteriores) se eliminan
+CREATE OR REPLACE FUNCTION cluster_trips(
+    clustered_region_id INT, cluster_distance DOUBLE PRECISION, cluster_time_window INT
+) RETURNS BIGINT
+    LANGUAGE plpgsql
+    AS $$
+    DECLARE
+        groups BIGINT;
+    BEGIN
+        -- Dos agrupaciones de la misma región a la vez se bloquearían entre sí
+        PERFORM pg_advisory_xact_lock(hashtext('cluster_trips'), clustered_region_id);
+
+        UPDATE trip_groups SET size = 0 WHERE region_id = clustered_region_id;
+
+        WITH keyed AS (
+            SELECT
+                trip_id,
+                timestamp,
+                trip_group_cell(origin[0], cluster_distance) AS origin_cell_x,
+                trip_group_cell(origin[1], cluster_distance) AS origin_cell_y,
+                trip_group_cell(destination[0], cluster_distance) AS destination_cell_x,
+                trip_group_cell(destination[1], cluster_distance) AS destination_cell_y,
+                trip_group_time_bucket(timestamp, cluster_time_window) AS time_bucket
+            FROM trips
+            WHERE region_id = clustered_region_id
+        ),
+        upserted AS (
+            INSERT INTO trip_groups AS g (
+                region_id, distance, time_window,
+                origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, time_bucket, size
+            )
+            SELECT
+                clustered_region_id, cluster_distance, cluster_time_window,
+                origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, time_bucket, COUNT(*)
+            FROM keyed
+            GROUP BY origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, time_bucket
+            ON CONFLICT (
+                region_id, distance, time_window,
+                origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, time_bucket
+            ) DO UPDATE SET size = EXCLUDED.size
+            RETURNING g.group_id, g.origin_cell_x, g.origin_cell_y, g.destination_cell_x, g.destination_cell_y, g.time_bucket
+        )
+        UPDATE trips AS t
+        SET group_id = u.group_id
+        FROM keyed AS k
+        JOIN upserted AS u USING (
+            origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, time_bucket
+        )
+        WHERE t.trip_id = k.trip_id AND
+            t.timestamp = k.timestamp AND
+            t.group_id IS DISTINCT FROM u.group_id;
+
+        DELETE FROM trip_groups WHERE region_id = clustered_region_id AND size = 0;
+
+        SELECT COUNT(*) INTO groups FROM trip_groups WHERE region_id = clustered_region_id;
+        RETURN groups;
+    END;
+    $$;
+
+-- Llave de grupo de cada viaje de un lote, numerados según su posición en el lote
+CREATE OR REPLACE FUNCTION trip_group_keys(
+    region_ids INT[],
+    origin_x DOUBLE PRECISION[],
+    origin_y DOUBLE PRECISION[],
+    destination_x DOUBLE PRECISION[],
+    destination_y DOUBLE PRECISION[],
+    timestamps TIMESTAMP[],
+    cluster_distance DOUBLE PRECISION,
+    cluster_time_window INT
+) RETURNS TABLE (
+    n BIGINT,
+    region_id INT,
+    origin_cell_x INT,
+    origin_cell_y INT,
+    destination_cell_x INT,
+    destination_cell_y INT,
+    time_bucket INT
+)
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$
+        SELECT
+            b.n,
+            b.region_id,
+            trip_group_cell(b.origin_x, cluster_distance),
+            trip_group_cell(b.origin_y, cluster_distance),
+            trip_group_cell(b.destination_x, cluster_distance),
+            trip_group_cell(b.destination_y, cluster_distance),
+            trip_group_time_bucket(b.timestamp, cluster_time_window)
+        FROM unnest(region_ids, origin_x, origin_y, destination_x, destination_y, timestamps)
+            WITH ORDINALITY AS b(region_id, origin_x, origin_y, destination_x, destination_y, timestamp, n)
+    $$;
+
+-- Grupo de cada viaje de un lote, en el mismo orden del lote, creando los grupos que no
+-- existan. Solo usa el índice único de trip_groups, así el costo depende del tamaño del
+-- lote y no de la cantidad de viajes almacenados. Los grupos nuevos deben confirmarse
+-- fuera de la transacción que inserta los viajes para no bloquear a ingestas concurrentes
+CREATE OR REPLACE FUNCTION trip_group_ids(
+    region_ids INT[],
+    origin_x DOUBLE PRECISION[],
+    origin_y DOUBLE PRECISION[],
+    destination_x DOUBLE PRECISION[],
+    destination_y DOUBLE PRECISION[],
+    timestamps TIMESTAMP[],
+    cluster_distance DOUBLE PRECISION,
+    cluster_time_window INT
+) RETURNS SETOF INT
+    LANGUAGE plpgsql
+    AS $$
+    BEGIN
+        -- Si otra ingesta está creando el mismo grupo, espera a que termine en vez de duplicarlo
+        INSERT INTO trip_groups (
+            region_id, distance, time_window,
+            origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, time_bucket
+        )
+        SELECT DISTINCT
+            k.region_id, cluster_distance, cluster_time_window,
+            k.origin_cell_x, k.origin_cell_y, k.destination_cell_x, k.destination_cell_y, k.time_bucket
+        FROM trip_group_keys(
+            region_ids, origin_x, origin_y, destination_x, destination_y, timestamps,
+            cluster_distance, cluster_time_window
+        ) AS k
+        ORDER BY 1, 4, 5, 6, 7, 8
+        ON CONFLICT DO NOTHING;
+
+        -- Una nueva sentencia ve los grupos que otras ingestas confirmaron mientras tanto
+        RETURN QUERY
+            SELECT g.group_id
+            FROM trip_group_keys(
+                region_ids, origin_x, origin_y, destination_x, destination_y, timestamps,
+                cluster_distance, cluster_time_window
+            ) AS k
+            JOIN trip_groups AS g ON
+                g.region_id = k.region_id AND
+                g.distance = cluster_distance AND
+                g.time_window = cluster_time_window AND
+                g.origin_cell_x = k.origin_cell_x AND
+                g.origin_cell_y = k.origin_cell_y AND
+                g.destination_cell_x = k.destination_cell_x AND
+                g.destination_cell_y = k.destination_cell_y AND
+                g.time_bucket = k.time_bucket
+            ORDER BY k.n;
+    END;
+    $$;
+
+-- Suma `counts` al tamaño de los grupos `group_ids`. Las filas se bloquean en orden de
+-- group_id, así dos ingestas que actualizan los mismos grupos no se bloquean mutuamente
+CREATE OR REPLACE FUNCTION add_trip_group_sizes(group_ids INT[], counts BIGINT[]) RETURNS VOID
+    LANGUAGE SQL
+    AS $$
+        WITH locked AS (
+            SELECT group_id
+            FROM trip_groups
+            WHERE group_id = ANY(group_ids)
+            ORDER BY group_id
+            FOR UPDATE
+        )
+        UPDATE trip_groups AS g
+        SET size = g.size + c.count
+        FROM unnest(group_ids, counts) AS c(group_id, count)
+        JOIN locked USING (group_id)
+        WHERE g.group_id = c.group_id
+    $$;
@@ -0,0 +1,11 @@
+-- Agrega los indices espaciales de init.sql a una base de datos existente.
+-- CREATE INDEX CONCURRENTLY no bloquea las escrituras, pero no puede ejecutarse dentro
+-- de una transacción, por lo que este archivo debe correrse con psql sin --single-transaction:
+--
+--   psql -h $POSTGRES_HOST -U $POSTGRES_USER -d $POSTGRES_DB -f migrations/001_trips_spatial_indexes.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS trips_origin_idx ON trips USING GIST (origin);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS trips_destination_idx ON trips USING GIST (destination);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS trips_region_timestamp_idx ON trips (region_id, timestamp);
+
+ANALYZE trips;
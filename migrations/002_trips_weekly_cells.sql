@@ -0,0 +1,83 @@
+-- Agrega la tabla trips_weekly_cells de init.sql a una base de datos existente y la
+-- llena con los viajes ya almacenados:
+--
+--   psql -h $POSTGRES_HOST -U $POSTGRES_USER -d $POSTGRES_DB -f migrations/002_trips_weekly_cells.sql
+
+-- Grilla espacial de trips_weekly_cells, las coordenadas se agrupan en celdas de
+-- trips_grid_size() x trips_grid_size()
+CREATE OR REPLACE FUNCTION trips_grid_size() RETURNS DOUBLE PRECISION
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT 0.01::DOUBLE PRECISION $$;
+
+CREATE OR REPLACE FUNCTION trips_grid_cell(coordinate DOUBLE PRECISION) RETURNS INT
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT floor(coordinate / trips_grid_size())::INT $$;
+
+-- Coordenada desplazada `cells` celdas desde el inicio de la celda de `coordinate`
+CREATE OR REPLACE FUNCTION trips_grid_snap(coordinate DOUBLE PRECISION, cells DOUBLE PRECISION)
+    RETURNS DOUBLE PRECISION
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT (trips_grid_cell(coordinate) + cells) * trips_grid_size() $$;
+
+-- Indica si `p` está en una celda completamente contenida en el bbox (px, py), (qx, qy)
+CREATE OR REPLACE FUNCTION trips_grid_interior(
+    p POINT, px DOUBLE PRECISION, py DOUBLE PRECISION, qx DOUBLE PRECISION, qy DOUBLE PRECISION
+) RETURNS BOOLEAN
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$
+        SELECT trips_grid_cell(p[0]) BETWEEN trips_grid_cell(px) + 1 AND trips_grid_cell(qx) - 1
+            AND trips_grid_cell(p[1]) BETWEEN trips_grid_cell(py) + 1 AND trips_grid_cell(qy) - 1
+    $$;
+
+-- Conteo de viajes por región, semana, celda de origen y celda de destino. Cada inserción
+-- agrega sus conteos como filas nuevas (sin bloquear a otras inserciones concurrentes),
+-- por lo que una misma llave puede repetirse hasta que se compacte
+CREATE TABLE IF NOT EXISTS trips_weekly_cells (
+    region_id INT NOT NULL,
+    week TIMESTAMP NOT NULL,
+    origin_cell_x INT NOT NULL,
+    origin_cell_y INT NOT NULL,
+    destination_cell_x INT NOT NULL,
+    destination_cell_y INT NOT NULL,
+    count BIGINT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS trips_weekly_cells_idx ON trips_weekly_cells (
+    region_id, origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y
+);
+
+-- Junta las filas repetidas de una región en una sola por llave
+CREATE OR REPLACE FUNCTION compact_trips_weekly_cells(compacted_region_id INT) RETURNS VOID
+    LANGUAGE SQL
+    AS $$
+        WITH deleted AS (
+            DELETE FROM trips_weekly_cells
+            WHERE region_id = compacted_region_id
+            RETURNING *
+        )
+        INSERT INTO trips_weekly_cells
+        SELECT region_id, week, origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, SUM(count)
+        FROM deleted
+        GROUP BY region_id, week, origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y
+    $$;
+
+-- Recalcula todos los conteos desde trips, para datos insertados fuera de la aplicación
+CREATE OR REPLACE FUNCTION rebuild_trips_weekly_cells() RETURNS VOID
+    LANGUAGE SQL
+    AS $$
+        DELETE FROM trips_weekly_cells;
+
+        INSERT INTO trips_weekly_cells
+        SELECT
+            region_id,
+            DATE_TRUNC('week', timestamp),
+            trips_grid_cell(origin[0]),
+            trips_grid_cell(origin[1]),
+            trips_grid_cell(destination[0]),
+            trips_grid_cell(destination[1]),
+            COUNT(*)
+        FROM trips
+        GROUP BY 1, 2, 3, 4, 5, 6;
+    $$;
+
+SELECT rebuild_trips_weekly_cells();
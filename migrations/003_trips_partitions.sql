@@ -0,0 +1,132 @@
+-- Convierte la tabla trips de una base de datos existente en la tabla particionada por mes
+-- de init.sql. Los viajes se copian a sus particiones, por lo que la ingesta debe estar
+-- detenida mientras corre. Requiere 001 y 002:
+--
+--   psql -h $POSTGRES_HOST -U $POSTGRES_USER -d $POSTGRES_DB --single-transaction -f migrations/003_trips_partitions.sql
+
+ALTER TABLE trips RENAME TO trips_unpartitioned;
+ALTER SEQUENCE trips_trip_id_seq RENAME TO trips_unpartitioned_trip_id_seq;
+ALTER INDEX trips_origin_idx RENAME TO trips_unpartitioned_origin_idx;
+ALTER INDEX trips_destination_idx RENAME TO trips_unpartitioned_destination_idx;
+ALTER INDEX trips_region_timestamp_idx RENAME TO trips_unpartitioned_region_timestamp_idx;
+ALTER TABLE trips_unpartitioned RENAME CONSTRAINT trips_pkey TO trips_unpartitioned_pkey;
+ALTER TABLE trips_unpartitioned RENAME CONSTRAINT fk_region TO trips_unpartitioned_fk_region;
+
+CREATE TABLE trips (
+    trip_id SERIAL,
+    region_id INT,
+    origin POINT NOT NULL,
+    destination POINT NOT NULL,
+    timestamp TIMESTAMP NOT NULL,
+    source TEXT,
+    PRIMARY KEY (trip_id, timestamp),
+    CONSTRAINT fk_region
+        FOREIGN KEY(region_id)
+            REFERENCES regions(region_id)
+) PARTITION BY RANGE (timestamp);
+
+-- Recibe los viajes de meses sin partición, ensure_trips_partitions los mueve a su
+-- partición cuando esta se crea
+CREATE TABLE trips_default PARTITION OF trips DEFAULT;
+
+CREATE INDEX trips_origin_idx ON trips USING GIST (origin);
+CREATE INDEX trips_destination_idx ON trips USING GIST (destination);
+CREATE INDEX trips_region_timestamp_idx ON trips (region_id, timestamp);
+
+-- Nombre de la partición mensual que contiene a `month`
+CREATE OR REPLACE FUNCTION trips_partition_name(month TIMESTAMP) RETURNS TEXT
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT 'trips_' || to_char(month, 'YYYY_MM') $$;
+
+-- Crea las particiones mensuales que falten entre `since` y `until` (ambos incluidos). La
+-- tabla se crea por separado y luego se adjunta, lo que no bloquea las inserciones en
+-- curso en otras particiones
+CREATE OR REPLACE FUNCTION ensure_trips_partitions(since TIMESTAMP, until TIMESTAMP) RETURNS VOID
+    LANGUAGE plpgsql
+    AS $$
+    DECLARE
+        month TIMESTAMP;
+        partition TEXT;
+    BEGIN
+        FOR month IN
+            SELECT generate_series(DATE_TRUNC('month', since), DATE_TRUNC('month', until), '1 month')
+        LOOP
+            partition := trips_partition_name(month);
+            CONTINUE WHEN to_regclass(partition) IS NOT NULL;
+
+            -- Ingestas concurrentes pueden pedir el mismo mes, solo una la crea
+            PERFORM pg_advisory_xact_lock(hashtext('ensure_trips_partitions'));
+            CONTINUE WHEN to_regclass(partition) IS NOT NULL;
+
+            EXECUTE format(
+                'CREATE TABLE %I (LIKE trips INCLUDING DEFAULTS, CHECK (timestamp >= %L AND timestamp < %L))',
+                partition, month, month + INTERVAL '1 month'
+            );
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM trips_default WHERE timestamp >= %L AND timestamp < %L RETURNING *) '
+                'INSERT INTO %I SELECT * FROM moved',
+                month, month + INTERVAL '1 month', partition
+            );
+            EXECUTE format(
+                'ALTER TABLE trips ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                partition, month, month + INTERVAL '1 month'
+            );
+        END LOOP;
+    END;
+    $$;
+
+-- Adjunta como partición del mes `month` una tabla cargada por fuera de la aplicación (por
+-- ejemplo con COPY sobre una tabla creada con LIKE trips INCLUDING DEFAULTS) y agrega
+-- sus viajes a trips_weekly_cells. El mes no debe tener partición todavía
+CREATE OR REPLACE FUNCTION attach_trips_partition(loaded REGCLASS, month TIMESTAMP) RETURNS BIGINT
+    LANGUAGE plpgsql
+    AS $$
+    DECLARE
+        since TIMESTAMP := DATE_TRUNC('month', month);
+        attached BIGINT;
+    BEGIN
+        -- Con la restricción validada, ATTACH no vuelve a recorrer la tabla
+        EXECUTE format(
+            'ALTER TABLE %s ADD CONSTRAINT %I CHECK (timestamp >= %L AND timestamp < %L)',
+            loaded, trips_partition_name(since) || '_range', since, since + INTERVAL '1 month'
+        );
+        EXECUTE format(
+            'ALTER TABLE trips ATTACH PARTITION %s FOR VALUES FROM (%L) TO (%L)',
+            loaded, since, since + INTERVAL '1 month'
+        );
+        EXECUTE format(
+            'ALTER TABLE %s DROP CONSTRAINT %I', loaded, trips_partition_name(since) || '_range'
+        );
+
+        EXECUTE format(
+            'INSERT INTO trips_weekly_cells
+            SELECT
+                region_id,
+                DATE_TRUNC(''week'', timestamp),
+                trips_grid_cell(origin[0]),
+                trips_grid_cell(origin[1]),
+                trips_grid_cell(destination[0]),
+                trips_grid_cell(destination[1]),
+                COUNT(*)
+            FROM %s
+            GROUP BY 1, 2, 3, 4, 5, 6', loaded
+        );
+
+        EXECUTE format('SELECT COUNT(*) FROM %s', loaded) INTO attached;
+        RETURN attached;
+    END;
+    $$;
+
+SELECT ensure_trips_partitions(MIN(timestamp), MAX(timestamp))
+FROM trips_unpartitioned
+HAVING COUNT(*) > 0;
+
+INSERT INTO trips (trip_id, region_id, origin, destination, timestamp, source)
+SELECT trip_id, region_id, origin, destination, timestamp, source
+FROM trips_unpartitioned;
+
+SELECT setval(pg_get_serial_sequence('trips', 'trip_id'), COALESCE(MAX(trip_id), 0) + 1, false) FROM trips;
+
+DROP TABLE trips_unpartitioned;
+
+ANALYZE trips;
@@ -0,0 +1,107 @@
+-- Agrega la agrupación de viajes similares de init.sql a una base de datos existente (requiere
+-- 003). Los índices de tablas particionadas no se pueden crear con CONCURRENTLY, por lo que
+-- la ingesta debería estar detenida mientras corre:
+--
+--   psql -h $POSTGRES_HOST -U $POSTGRES_USER -d $POSTGRES_DB --single-transaction -f migrations/004_trip_groups.sql
+--
+-- Los viajes existentes se agrupan luego con la tarea cluster_trips, o directamente con
+-- SELECT cluster_trips(region_id, 0.01, 30) FROM regions;
+
+-- Grupos de viajes similares: misma región, origen y destino en la misma celda de
+-- `distance` x `distance` y hora del día en la misma ventana de `time_window` minutos.
+-- Los umbrales son parte de la llave, así cambiarlos genera grupos nuevos
+CREATE TABLE IF NOT EXISTS trip_groups (
+    group_id INT GENERATED ALWAYS AS IDENTITY,
+    region_id INT NOT NULL,
+    distance DOUBLE PRECISION NOT NULL,
+    time_window INT NOT NULL,
+    origin_cell_x INT NOT NULL,
+    origin_cell_y INT NOT NULL,
+    destination_cell_x INT NOT NULL,
+    destination_cell_y INT NOT NULL,
+    time_bucket INT NOT NULL,
+    size BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (group_id),
+    UNIQUE (
+        region_id, distance, time_window,
+        origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, time_bucket
+    )
+);
+
+CREATE INDEX IF NOT EXISTS trip_groups_region_size_idx ON trip_groups (region_id, size DESC);
+
+ALTER TABLE trips ADD COLUMN IF NOT EXISTS group_id INT;
+ALTER TABLE trips ADD CONSTRAINT fk_group FOREIGN KEY(group_id) REFERENCES trip_groups(group_id);
+
+CREATE INDEX IF NOT EXISTS trips_group_idx ON trips (group_id);
+-- Celda de la grilla de agrupación que contiene a `coordinate`
+CREATE OR REPLACE FUNCTION trip_group_cell(coordinate DOUBLE PRECISION, distance DOUBLE PRECISION)
+    RETURNS INT
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT floor(coordinate / distance)::INT $$;
+
+-- Ventana de `time_window` minutos del día que contiene a `ts`
+CREATE OR REPLACE FUNCTION trip_group_time_bucket(ts TIMESTAMP, time_window INT) RETURNS INT
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT floor(EXTRACT(EPOCH FROM ts::TIME) / (time_window * 60))::INT $$;
+
+-- Agrupa todos los viajes de una región. Cada viaje se asigna a su celda de origen,
+-- destino y ventana horaria, por lo que el costo es lineal en la cantidad de viajes.
+-- Los grupos que quedan vacíos (por ejemplo, de umbrales anteriores) se eliminan
+CREATE OR REPLACE FUNCTION cluster_trips(
+    clustered_region_id INT, cluster_distance DOUBLE PRECISION, cluster_time_window INT
+) RETURNS BIGINT
+    LANGUAGE plpgsql
+    AS $$
+    DECLARE
+        groups BIGINT;
+    BEGIN
+        -- Dos agrupaciones de la misma región a la vez se bloquearían entre sí
+        PERFORM pg_advisory_xact_lock(hashtext('cluster_trips'), clustered_region_id);
+
+        UPDATE trip_groups SET size = 0 WHERE region_id = clustered_region_id;
+
+        WITH keyed AS (
+            SELECT
+                trip_id,
+                timestamp,
+                trip_group_cell(origin[0], cluster_distance) AS origin_cell_x,
+                trip_group_cell(origin[1], cluster_distance) AS origin_cell_y,
+                trip_group_cell(destination[0], cluster_distance) AS destination_cell_x,
+                trip_group_cell(destination[1], cluster_distance) AS destination_cell_y,
+                trip_group_time_bucket(timestamp, cluster_time_window) AS time_bucket
+            FROM trips
+            WHERE region_id = clustered_region_id
+        ),
+        upserted AS (
+            INSERT INTO trip_groups AS g (
+                region_id, distance, time_window,
+                origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, time_bucket, size
+            )
+            SELECT
+                clustered_region_id, cluster_distance, cluster_time_window,
+                origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, time_bucket, COUNT(*)
+            FROM keyed
+            GROUP BY origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, time_bucket
+            ON CONFLICT (
+                region_id, distance, time_window,
+                origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, time_bucket
+            ) DO UPDATE SET size = EXCLUDED.size
+            RETURNING g.group_id, g.origin_cell_x, g.origin_cell_y, g.destination_cell_x, g.destination_cell_y, g.time_bucket
+        )
+        UPDATE trips AS t
+        SET group_id = u.group_id
+        FROM keyed AS k
+        JOIN upserted AS u USING (
+            origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, time_bucket
+        )
+        WHERE t.trip_id = k.trip_id AND
+            t.timestamp = k.timestamp AND
+            t.group_id IS DISTINCT FROM u.group_id;
+
+        DELETE FROM trip_groups WHERE region_id = clustered_region_id AND size = 0;
+
+        SELECT COUNT(*) INTO groups FROM trip_groups WHERE region_id = clustered_region_id;
+        RETURN groups;
+    END;
+    $$;
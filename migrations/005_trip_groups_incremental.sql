@@ -0,0 +1,107 @@
+-- Agrega las funciones de asignación incremental de grupos de init.sql (requiere 004):
+--
+--   psql -h $POSTGRES_HOST -U $POSTGRES_USER -d $POSTGRES_DB -f migrations/005_trip_groups_incremental.sql
+
+-- Llave de grupo de cada viaje de un lote, numerados según su posición en el lote
+CREATE OR REPLACE FUNCTION trip_group_keys(
+    region_ids INT[],
+    origin_x DOUBLE PRECISION[],
+    origin_y DOUBLE PRECISION[],
+    destination_x DOUBLE PRECISION[],
+    destination_y DOUBLE PRECISION[],
+    timestamps TIMESTAMP[],
+    cluster_distance DOUBLE PRECISION,
+    cluster_time_window INT
+) RETURNS TABLE (
+    n BIGINT,
+    region_id INT,
+    origin_cell_x INT,
+    origin_cell_y INT,
+    destination_cell_x INT,
+    destination_cell_y INT,
+    time_bucket INT
+)
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$
+        SELECT
+            b.n,
+            b.region_id,
+            trip_group_cell(b.origin_x, cluster_distance),
+            trip_group_cell(b.origin_y, cluster_distance),
+            trip_group_cell(b.destination_x, cluster_distance),
+            trip_group_cell(b.destination_y, cluster_distance),
+            trip_group_time_bucket(b.timestamp, cluster_time_window)
+        FROM unnest(region_ids, origin_x, origin_y, destination_x, destination_y, timestamps)
+            WITH ORDINALITY AS b(region_id, origin_x, origin_y, destination_x, destination_y, timestamp, n)
+    $$;
+
+-- Grupo de cada viaje de un lote, en el mismo orden del lote, creando los grupos que no
+-- existan. Solo usa el índice único de trip_groups, así el costo depende del tamaño del
+-- lote y no de la cantidad de viajes almacenados. Los grupos nuevos deben confirmarse
+-- fuera de la transacción que inserta los viajes para no bloquear a ingestas concurrentes
+CREATE OR REPLACE FUNCTION trip_group_ids(
+    region_ids INT[],
+    origin_x DOUBLE PRECISION[],
+    origin_y DOUBLE PRECISION[],
+    destination_x DOUBLE PRECISION[],
+    destination_y DOUBLE PRECISION[],
+    timestamps TIMESTAMP[],
+    cluster_distance DOUBLE PRECISION,
+    cluster_time_window INT
+) RETURNS SETOF INT
+    LANGUAGE plpgsql
+    AS $$
+    BEGIN
+        -- Si otra ingesta está creando el mismo grupo, espera a que termine en vez de duplicarlo
+        INSERT INTO trip_groups (
+            region_id, distance, time_window,
+            origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, time_bucket
+        )
+        SELECT DISTINCT
+            k.region_id, cluster_distance, cluster_time_window,
+            k.origin_cell_x, k.origin_cell_y, k.destination_cell_x, k.destination_cell_y, k.time_bucket
+        FROM trip_group_keys(
+            region_ids, origin_x, origin_y, destination_x, destination_y, timestamps,
+            cluster_distance, cluster_time_window
+        ) AS k
+        ORDER BY 1, 4, 5, 6, 7, 8
+        ON CONFLICT DO NOTHING;
+
+        -- Una nueva sentencia ve los grupos que otras ingestas confirmaron mientras tanto
+        RETURN QUERY
+            SELECT g.group_id
+            FROM trip_group_keys(
+                region_ids, origin_x, origin_y, destination_x, destination_y, timestamps,
+                cluster_distance, cluster_time_window
+            ) AS k
+            JOIN trip_groups AS g ON
+                g.region_id = k.region_id AND
+                g.distance = cluster_distance AND
+                g.time_window = cluster_time_window AND
+                g.origin_cell_x = k.origin_cell_x AND
+                g.origin_cell_y = k.origin_cell_y AND
+                g.destination_cell_x = k.destination_cell_x AND
+                g.destination_cell_y = k.destination_cell_y AND
+                g.time_bucket = k.time_bucket
+            ORDER BY k.n;
+    END;
+    $$;
+
+-- Suma `counts` al tamaño de los grupos `group_ids`. Las filas se bloquean en orden de
+-- group_id, así dos ingestas que actualizan los mismos grupos no se bloquean mutuamente
+CREATE OR REPLACE FUNCTION add_trip_group_sizes(group_ids INT[], counts BIGINT[]) RETURNS VOID
+    LANGUAGE SQL
+    AS $$
+        WITH locked AS (
+            SELECT group_id
+            FROM trip_groups
+            WHERE group_id = ANY(group_ids)
+            ORDER BY group_id
+            FOR UPDATE
+        )
+        UPDATE trip_groups AS g
+        SET size = g.size + c.count
+        FROM unnest(group_ids, counts) AS c(group_id, count)
+        JOIN locked USING (group_id)
+        WHERE g.group_id = c.group_id
+    $$;
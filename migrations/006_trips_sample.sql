@@ -0,0 +1,110 @@
+-- Agrega la muestra de viajes trips_sample de init.sql a una base de datos existente (requiere
+-- 003) y la llena con los viajes ya almacenados:
+--
+--   psql -h $POSTGRES_HOST -U $POSTGRES_USER -d $POSTGRES_DB --single-transaction -f migrations/006_trips_sample.sql
+
+-- Muestra de los viajes para las estadísticas aproximadas. Cada viaje entra con probabilidad
+-- 1/16 según un valor `u` uniforme en [0, 1), y se guarda en el nivel más profundo que le
+-- corresponde: 1 si u < 1/16, 2 si u < 1/256 y 3 si u < 1/4096. Leer los niveles >= L es una
+-- muestra de Bernoulli de tasa 16^-L. Cada nivel es una partición con sus propios índices,
+-- así las muestras pequeñas se leen sin recorrer las más grandes
+CREATE TABLE trips_sample (
+    region_id INT NOT NULL,
+    origin POINT NOT NULL,
+    destination POINT NOT NULL,
+    timestamp TIMESTAMP NOT NULL,
+    level SMALLINT NOT NULL
+) PARTITION BY LIST (level);
+
+CREATE TABLE trips_sample_1 PARTITION OF trips_sample FOR VALUES IN (1);
+CREATE TABLE trips_sample_2 PARTITION OF trips_sample FOR VALUES IN (2);
+CREATE TABLE trips_sample_3 PARTITION OF trips_sample FOR VALUES IN (3);
+
+CREATE INDEX trips_sample_origin_idx ON trips_sample USING GIST (origin);
+CREATE INDEX trips_sample_region_timestamp_idx ON trips_sample (region_id, timestamp);
+
+-- Nivel de la muestra de un viaje con valor `u`, NULL si no entra en la muestra
+CREATE OR REPLACE FUNCTION trips_sample_level(u DOUBLE PRECISION) RETURNS SMALLINT
+    LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+    AS $$
+        SELECT CASE
+            WHEN u < 1.0 / 4096 THEN 3
+            WHEN u < 1.0 / 256 THEN 2
+            WHEN u < 1.0 / 16 THEN 1
+        END::SMALLINT
+    $$;
+
+-- Agrega a la muestra los viajes de `loaded` (trips o una tabla con sus columnas)
+CREATE OR REPLACE FUNCTION sample_trips(loaded REGCLASS) RETURNS VOID
+    LANGUAGE plpgsql
+    AS $$
+    BEGIN
+        EXECUTE format(
+            'INSERT INTO trips_sample
+            SELECT region_id, origin, destination, timestamp, level
+            FROM (
+                SELECT region_id, origin, destination, timestamp, trips_sample_level(random()) AS level
+                FROM %s
+                WHERE region_id IS NOT NULL
+            ) AS sampled
+            WHERE level IS NOT NULL', loaded
+        );
+    END;
+    $$;
+
+-- Vuelve a muestrear todos los viajes, para datos insertados o eliminados fuera de la aplicación
+CREATE OR REPLACE FUNCTION rebuild_trips_sample() RETURNS VOID
+    LANGUAGE plpgsql
+    AS $$
+    BEGIN
+        DELETE FROM trips_sample;
+        PERFORM sample_trips('trips');
+    END;
+    $$;
+
+-- Adjunta como partición del mes `month` una tabla cargada por fuera de la aplicación (por
+-- ejemplo con COPY sobre una tabla creada con LIKE trips INCLUDING DEFAULTS) y agrega
+-- sus viajes a trips_weekly_cells y a trips_sample. El mes no debe tener partición todavía
+CREATE OR REPLACE FUNCTION attach_trips_partition(loaded REGCLASS, month TIMESTAMP) RETURNS BIGINT
+    LANGUAGE plpgsql
+    AS $$
+    DECLARE
+        since TIMESTAMP := DATE_TRUNC('month', month);
+        attached BIGINT;
+    BEGIN
+        -- Con la restricción validada, ATTACH no vuelve a recorrer la tabla
+        EXECUTE format(
+            'ALTER TABLE %s ADD CONSTRAINT %I CHECK (timestamp >= %L AND timestamp < %L)',
+            loaded, trips_partition_name(since) || '_range', since, since + INTERVAL '1 month'
+        );
+        EXECUTE format(
+            'ALTER TABLE trips ATTACH PARTITION %s FOR VALUES FROM (%L) TO (%L)',
+            loaded, since, since + INTERVAL '1 month'
+        );
+        EXECUTE format(
+            'ALTER TABLE %s DROP CONSTRAINT %I', loaded, trips_partition_name(since) || '_range'
+        );
+
+        EXECUTE format(
+            'INSERT INTO trips_weekly_cells
+            SELECT
+                region_id,
+                DATE_TRUNC(''week'', timestamp),
+                trips_grid_cell(origin[0]),
+                trips_grid_cell(origin[1]),
+                trips_grid_cell(destination[0]),
+                trips_grid_cell(destination[1]),
+                COUNT(*)
+            FROM %s
+            GROUP BY 1, 2, 3, 4, 5, 6', loaded
+        );
+        PERFORM sample_trips(loaded);
+
+        EXECUTE format('SELECT COUNT(*) FROM %s', loaded) INTO attached;
+        RETURN attached;
+    END;
+    $$;
+
+SELECT rebuild_trips_sample();
+
+ANALYZE trips_sample;
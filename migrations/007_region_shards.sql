@@ -0,0 +1,19 @@
+-- Agrega la tabla region_shards de init.sql a una base de datos existente y asigna todas sus
+-- regiones al shard 0. Se ejecuta justo antes de configurar SHARD_DATABASES, con esta base de
+-- datos como la primera de la lista, así los viajes ya almacenados siguen donde están:
+--
+--   psql -h $POSTGRES_HOST -U $POSTGRES_USER -d $POSTGRES_DB --single-transaction -f migrations/007_region_shards.sql
+
+-- Shard (posición en SHARD_DATABASES) que guarda los viajes de cada región. Solo se usa en la
+-- base de datos de metadatos y cuando hay shards configurados; las asignaciones no cambian
+CREATE TABLE region_shards (
+    region_id INT NOT NULL,
+    shard SMALLINT NOT NULL,
+    PRIMARY KEY (region_id)
+);
+
+CREATE INDEX region_shards_shard_idx ON region_shards (shard);
+
+INSERT INTO region_shards (region_id, shard)
+SELECT region_id, 0 FROM regions
+ON CONFLICT DO NOTHING;
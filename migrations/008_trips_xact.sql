@@ -0,0 +1,59 @@
+-- Agrega la columna xact de init.sql a una base de datos existente (requiere 006). Los viajes
+-- ya almacenados quedan con xact nulo, que los lectores tratan como anteriores a cualquier
+-- lectura: se aplica antes de desplegar la versión de la API y de Celery que la usa:
+--
+--   psql -h $POSTGRES_HOST -U $POSTGRES_USER -d $POSTGRES_DB --single-transaction -f migrations/008_trips_xact.sql
+
+-- pg_current_xact_id() es volátil, con el valor por defecto en el mismo ALTER se reescribiría
+-- la tabla completa
+ALTER TABLE trips ADD COLUMN xact BIGINT;
+ALTER TABLE trips ALTER COLUMN xact SET DEFAULT pg_current_xact_id()::TEXT::BIGINT;
+
+CREATE INDEX trips_xact_idx ON trips USING BRIN (xact) WITH (autosummarize = on);
+
+-- Adjunta como partición del mes `month` una tabla cargada por fuera de la aplicación (por
+-- ejemplo con COPY sobre una tabla creada con LIKE trips INCLUDING DEFAULTS) y agrega
+-- sus viajes a trips_weekly_cells y a trips_sample. El mes no debe tener partición todavía
+CREATE OR REPLACE FUNCTION attach_trips_partition(loaded REGCLASS, month TIMESTAMP) RETURNS BIGINT
+    LANGUAGE plpgsql
+    AS $$
+    DECLARE
+        since TIMESTAMP := DATE_TRUNC('month', month);
+        attached BIGINT;
+    BEGIN
+        -- Los viajes cargados quedan como insertados por esta transacción, así quienes copian
+        -- los viajes los leen aunque la carga se haya confirmado antes de su última lectura
+        EXECUTE format('UPDATE %s SET xact = pg_current_xact_id()::TEXT::BIGINT', loaded);
+
+        -- Con la restricción validada, ATTACH no vuelve a recorrer la tabla
+        EXECUTE format(
+            'ALTER TABLE %s ADD CONSTRAINT %I CHECK (timestamp >= %L AND timestamp < %L)',
+            loaded, trips_partition_name(since) || '_range', since, since + INTERVAL '1 month'
+        );
+        EXECUTE format(
+            'ALTER TABLE trips ATTACH PARTITION %s FOR VALUES FROM (%L) TO (%L)',
+            loaded, since, since + INTERVAL '1 month'
+        );
+        EXECUTE format(
+            'ALTER TABLE %s DROP CONSTRAINT %I', loaded, trips_partition_name(since) || '_range'
+        );
+
+        EXECUTE format(
+            'INSERT INTO trips_weekly_cells
+            SELECT
+                region_id,
+                DATE_TRUNC(''week'', timestamp),
+                trips_grid_cell(origin[0]),
+                trips_grid_cell(origin[1]),
+                trips_grid_cell(destination[0]),
+                trips_grid_cell(destination[1]),
+                COUNT(*)
+            FROM %s
+            GROUP BY 1, 2, 3, 4, 5, 6', loaded
+        );
+        PERFORM sample_trips(loaded);
+
+        EXECUTE format('SELECT COUNT(*) FROM %s', loaded) INTO attached;
+        RETURN attached;
+    END;
+    $$;
@@ -0,0 +1,95 @@
+""" Módulo que define el cache de resultados de /trips/stats, guardado en Redis """
+
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Literal
+
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+
+from optimized_shifts.celery.stats_cache import STATS_CACHE_KEY, STATS_GENERATION_KEY
+from optimized_shifts.schemas.trip import TripsWeeklyAverage
+
+logger = logging.getLogger(__name__)
+
+Point = tuple[float, float]
+CacheStatus = Literal["HIT", "MISS", "BYPASS"]
+
+# Decimales con los que se normalizan las coordenadas del bbox
+BBOX_PRECISION = 6
+
+
+def _week(value: datetime | None) -> str:
+    # El promedio solo depende de la semana que contiene cada fecha
+    if value is None:
+        return ""
+
+    week = value.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=value.weekday())
+    return week.isoformat()
+
+
+def stats_params(bbox: tuple[Point, Point], since: datetime | None, until: datetime | None) -> str:
+    """ Parámetros normalizados de una consulta: las esquinas del bbox ordenadas y redondeadas,
+    y las fechas truncadas a su semana, así consultas equivalentes comparten la misma entrada """
+    p, q = bbox
+    px, qx = sorted((p[0], q[0]))
+    py, qy = sorted((p[1], q[1]))
+    corners = ",".join(f"{round(value, BBOX_PRECISION):g}" for value in (px, py, qx, qy))
+
+    return f"{corners}:{_week(since)}:{_week(until)}"
+
+
+class StatsCache:
+    """
+    Cache de los promedios semanales por región, bbox y rango de fechas. Cada región tiene un
+    contador de generación que Celery y la API incrementan al insertar viajes en ella, las entradas
+    de generaciones anteriores dejan de leerse y expiran a los `ttl` segundos. Si Redis no está
+    disponible el promedio se calcula sin cache
+    """
+    def __init__(self, redis: "aioredis.Redis[bytes]", ttl: int = 300):
+        self.redis = redis
+        self.ttl = ttl
+
+    async def get_or_compute(
+        self,
+        region_id: int,
+        bbox: tuple[Point, Point],
+        since: datetime | None,
+        until: datetime | None,
+        compute: Callable[[], Awaitable[TripsWeeklyAverage]],
+    ) -> tuple[TripsWeeklyAverage, CacheStatus]:
+        try:
+            # La generación se lee antes de calcular, si se invalida mientras tanto el
+            # resultado queda guardado en la generación anterior y no se vuelve a leer
+            generation = await self.redis.get(STATS_GENERATION_KEY.format(region_id=region_id))
+            key = STATS_CACHE_KEY.format(
+                region_id=region_id,
+                generation=int(generation or 0),
+                params=stats_params(bbox, since, until),
+            )
+            cached = await self.redis.get(key)
+        except RedisError:
+            logger.warning("Stats cache unavailable, computing without it")
+            return await compute(), "BYPASS"
+
+        if cached is not None:
+            return TripsWeeklyAverage(**json.loads(cached)), "HIT"
+
+        avg = await compute()
+        try:
+            await self.redis.set(key, avg.model_dump_json(), ex=self.ttl)
+        except RedisError:
+            pass
+
+        return avg, "MISS"
+
+    async def invalidate(self, region_ids: list[int]):
+        """ Invalida los promedios guardados de las regiones """
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for region_id in region_ids:
+                    pipe.incr(STATS_GENERATION_KEY.format(region_id=region_id))
+                await pipe.execute()
+        except RedisError:
+            logger.warning("Unable to invalidate stats cache of regions %s", region_ids)
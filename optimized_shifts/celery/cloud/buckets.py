@@ -1,54 +1,176 @@
+import io
 import os
-from typing import Literal, Protocol, Type
+from typing import IO, Callable, Iterator, Literal, Protocol, Type
 
 import pandas as pd
 
+from ..wkt import parse_points
+
 DataProcesorTypes = Literal["mocked"] | Literal["gcp"]
 
+DEFAULT_CHUNKSIZE = 50_000
+
+ByteRange = tuple[int, int]
+
 
 class DataProcesor(Protocol):
-    def data_to_pandas(self, data: str) -> pd.DataFrame | None:
+    # Rows skipped and bytes of the file read so far by the chunks iterator
+    malformed_rows: int
+    bytes_read: int
+
+    def partitions(self, data: str, partition_size: int) -> list[ByteRange] | None:
+        ...
+
+    def data_to_chunks(
+        self,
+        data: str,
+        chunksize: int = DEFAULT_CHUNKSIZE,
+        byte_range: ByteRange | None = None,
+    ) -> Iterator[pd.DataFrame] | None:
         ...
 
 
 class GcpDataProcesor(DataProcesor):
-    def data_to_pandas(self, data: str) -> pd.DataFrame | None:
+    malformed_rows = 0
+    bytes_read = 0
+
+    def partitions(self, data: str, partition_size: int) -> list[ByteRange] | None:
         return None
 
+    def data_to_chunks(
+        self,
+        data: str,
+        chunksize: int = DEFAULT_CHUNKSIZE,
+        byte_range: ByteRange | None = None,
+    ) -> Iterator[pd.DataFrame] | None:
+        return None
+
+
+class _ByteRangeReader(io.RawIOBase):
+    """Reads the header line of a file followed by the bytes in [start, end)"""
+
+    def __init__(self, path: str, byte_range: ByteRange):
+        start, end = byte_range
+        self._file = open(path, "rb")
+        self._header = self._file.readline()
+        self._file.seek(start)
+        self._remaining = end - start
+        self.consumed = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: bytearray) -> int:  # type: ignore
+        if self._header:
+            size = min(len(buffer), len(self._header))
+            buffer[:size] = self._header[:size]
+            self._header = self._header[size:]
+            return size
+
+        size = min(len(buffer), self._remaining)
+        if size <= 0:
+            return 0
+
+        read = self._file.readinto(memoryview(buffer)[:size])
+        self._remaining -= read
+        self.consumed += read
+        return read
+
+    def close(self):
+        self._file.close()
+        super().close()
+
 
 class MockedDataProcesor(DataProcesor):
-    def data_to_pandas(self, data: str) -> pd.DataFrame | None:
+    columns = {
+        "region": "region",
+        "origin_coord": "origin",
+        "destination_coord": "destination",
+        "datetime": "timestamp",
+        "datasource": "source",
+    }
+
+    def __init__(self):
+        self.malformed_rows = 0
+        self.bytes_read = 0
+
+    def partitions(self, data: str, partition_size: int) -> list[ByteRange] | None:
+        """Splits the rows of the file in byte ranges of about `partition_size` bytes,
+        aligned to line boundaries. Returns None if the file doesn't exists"""
         if not os.path.exists(data):
             return None
 
-        columns = {
-            "region": "region",
-            "origin_coord": "origin",
-            "destination_coord": "destination",
-            "datetime": "timestamp",
-            "datasource": "source",
-        }
+        size = os.path.getsize(data)
+        partitions: list[ByteRange] = []
+        with open(data, "rb") as f:
+            f.readline()
+            start = f.tell()
+            while start < size:
+                f.seek(start + partition_size)
+                f.readline()
+                end = min(f.tell(), size)
+                partitions.append((start, end))
+                start = end
+
+        return partitions
+
+    def data_to_chunks(
+        self,
+        data: str,
+        chunksize: int = DEFAULT_CHUNKSIZE,
+        byte_range: ByteRange | None = None,
+    ) -> Iterator[pd.DataFrame] | None:
+        """Returns a lazy iterator of parsed DataFrames of at most `chunksize` rows,
+        or None if the file doesn't exists. If `byte_range` is given, only the rows
+        inside that range are read"""
+        if not os.path.exists(data):
+            return None
 
-        df = pd.read_csv(data).rename(columns=columns)  # type: ignore
+        if byte_range is None:
+            source = open(data, "rb")
+            return self._read_chunks(source, chunksize, source.tell)
 
-        # Transform point columns to change from 'POINT (. .)' to '(. .)'
-        df["origin"] = df["origin"].str.replace(  # type: ignore
-            r"POINT \((\d+\.\d+) (\d+\.\d+)\)", r"\1 \2", regex=True
-        )
-        df["destination"] = df["destination"].str.replace(  # type: ignore
-            r"POINT \((\d+\.\d+) (\d+\.\d+)\)", r"\1 \2", regex=True
+        reader = _ByteRangeReader(data, byte_range)
+        return self._read_chunks(
+            io.BufferedReader(reader), chunksize, lambda: reader.consumed
         )
+
+    def _read_chunks(
+        self, source: IO[bytes], chunksize: int, position: Callable[[], int]
+    ) -> Iterator[pd.DataFrame]:
+        # Only one chunk is alive at a time, so memory doesn't grow with file size
+        try:
+            with pd.read_csv(  # type: ignore
+                source,
+                usecols=list(self.columns.keys()),
+                dtype={
+                    "region": str,
+                    "origin_coord": str,
+                    "destination_coord": str,
+                    "datasource": str,
+                },
+                chunksize=chunksize,
+            ) as reader:
+                for chunk in reader:
+                    # pandas reads ahead of the rows it returns, so this is an upper bound
+                    self.bytes_read = position()
+                    yield self._transform(chunk.rename(columns=self.columns))  # type: ignore
+        finally:
+            source.close()
+
+    def _transform(self, df: pd.DataFrame) -> pd.DataFrame:
         df["timestamp"] = pd.to_datetime(df["timestamp"], format="%Y-%m-%d %H:%M:%S")  # type: ignore
 
-        df[["origin_x", "origin_y"]] = (
-            df["origin"].str.split(" ", n=1, expand=True).astype(float)  # type: ignore
-        )
-        df[["destination_x", "destination_y"]] = (
-            df["destination"].str.split(" ", n=1, expand=True).astype(float)  # type: ignore
-        )
-        df = df.drop(columns=["origin", "destination"])  # type: ignore
+        origin = parse_points(df["origin"])
+        destination = parse_points(df["destination"])
+        df["origin_x"], df["origin_y"] = origin.x, origin.y
+        df["destination_x"], df["destination_y"] = destination.x, destination.y
+
+        # Rows without valid coordinates cannot be stored, they are counted and skipped
+        malformed = origin.malformed | destination.malformed
+        self.malformed_rows += int(malformed.sum())
 
-        return df
+        return df.drop(columns=["origin", "destination"])[~malformed]  # type: ignore
 
 
 class DataProcesorFactory:
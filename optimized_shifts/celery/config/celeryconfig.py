@@ -8,3 +8,45 @@ CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_RESULT_SERIALIZER = "json"
 
 CELERY_ENABLE_UTC = True
+
+# Rows per chunk read from an ingested file, bounds the worker memory usage
+INGEST_CHUNK_SIZE = int(os.environ.get("INGEST_CHUNK_SIZE", 50_000))
+
+# Bytes of an ingested file processed by each parallel subtask
+INGEST_PARTITION_SIZE = int(os.environ.get("INGEST_PARTITION_SIZE", 64 * 1024 * 1024))
+
+# Minimum seconds between two progress notifications of the same ingestion
+INGEST_PROGRESS_INTERVAL = float(os.environ.get("INGEST_PROGRESS_INTERVAL", 1.0))
+
+# Seconds the last notification of a task is kept to be replayed to late websocket subscribers
+NOTIFICATIONS_REPLAY_TTL = int(os.environ.get("NOTIFICATIONS_REPLAY_TTL", 300))
+
+# Seconds a region name -> id mapping is cached by each API and worker process
+REGION_CACHE_TTL = float(os.environ.get("REGION_CACHE_TTL", 300))
+
+# Connections kept by each worker process, shared by all the tasks it runs. Ingestion holds
+# the trips transaction while creating regions on a second connection, so at least two
+DATABASE_POOL_MIN_SIZE = int(os.environ.get("DATABASE_POOL_MIN_SIZE", 1))
+DATABASE_POOL_MAX_SIZE = max(2, int(os.environ.get("DATABASE_POOL_MAX_SIZE", 4)))
+
+# Trips are grouped when their origins and destinations fall in the same cell of
+# CLUSTER_DISTANCE x CLUSTER_DISTANCE (in coordinate units) and their time of day
+# in the same window of CLUSTER_TIME_WINDOW minutes
+CLUSTER_DISTANCE = float(os.environ.get("CLUSTER_DISTANCE", 0.01))
+CLUSTER_TIME_WINDOW = int(os.environ.get("CLUSTER_TIME_WINDOW", 30))
+
+# Directory shared with the API where trip snapshots are exported after ingestions, unset
+# disables the export. The export runs SNAPSHOT_INTERVAL seconds after the first ingestion
+# that requests it, covering every ingestion finished meanwhile. Only the last SNAPSHOT_KEEP
+# snapshots are kept
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR") or None
+SNAPSHOT_INTERVAL = int(os.environ.get("SNAPSHOT_INTERVAL", 300))
+SNAPSHOT_KEEP = int(os.environ.get("SNAPSHOT_KEEP", 2))
+
+# Side of the cells trips are sorted by in the columnar engine and its snapshots
+COLUMNAR_GRID_SIZE = float(os.environ.get("COLUMNAR_GRID_SIZE", 0.1))
+
+# Comma separated DSNs of the databases that hold the trips, each region is assigned to one of
+# them in the region_shards table of the main database (POSTGRES_*). Unset keeps every trip in
+# the main database. Shards are referenced by position, new ones must be appended at the end
+SHARD_DATABASES = [dsn.strip() for dsn in os.environ.get("SHARD_DATABASES", "").split(",") if dsn.strip()]
@@ -0,0 +1,106 @@
+import asyncio
+import os
+
+import asyncpg
+
+from .config import celeryconfig
+from .shards import ShardRouter
+
+# Each worker process keeps a single event loop and connection pool for its whole
+# lifetime, so tasks don't pay a connection handshake nor leak connections
+_loop: asyncio.AbstractEventLoop | None = None
+_pool: "asyncpg.Pool[asyncpg.Record] | None" = None
+_shards: ShardRouter | None = None
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Returns the event loop of the worker process, creating it if needed"""
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+
+    return _loop
+
+
+async def _create_pool(dsn: str | None = None) -> "asyncpg.Pool[asyncpg.Record]":
+    """Pool of the main database, or of the shard at `dsn`"""
+    if dsn is None:
+        pool = await asyncpg.create_pool(
+            host=os.environ.get("POSTGRES_HOST"),
+            user=os.environ.get("POSTGRES_USER"),
+            password=os.environ.get("POSTGRES_PASSWORD"),
+            database=os.environ.get("POSTGRES_DB"),
+            min_size=celeryconfig.DATABASE_POOL_MIN_SIZE,
+            max_size=celeryconfig.DATABASE_POOL_MAX_SIZE,
+        )
+    else:
+        pool = await asyncpg.create_pool(
+            dsn,
+            min_size=celeryconfig.DATABASE_POOL_MIN_SIZE,
+            max_size=celeryconfig.DATABASE_POOL_MAX_SIZE,
+        )
+    if not pool:
+        raise Exception("Unable to connect with database")
+
+    return pool
+
+
+def _discard_pool(pool: "asyncpg.Pool[asyncpg.Record]"):
+    """Terminates a pool bound to another event loop, as it can't be awaited from this one.
+    When that loop is already closed its connections are released along with it"""
+    if not pool._loop.is_closed():  # type: ignore
+        pool.terminate()
+
+
+async def get_pool() -> "asyncpg.Pool[asyncpg.Record]":
+    """Returns the pool of the worker process. It is created on first use when the
+    worker signals weren't sent (e.g. solo pool or when called outside Celery)"""
+    global _pool
+    if _pool is None or _pool._loop is not asyncio.get_running_loop():  # type: ignore
+        if _pool is not None:
+            _discard_pool(_pool)
+        _pool = await _create_pool()
+
+    return _pool
+
+
+async def get_shards() -> ShardRouter:
+    """Returns the shard router of the worker process, created along with the pools of
+    SHARD_DATABASES the first time it's needed"""
+    global _shards
+    pool = await get_pool()
+    if _shards is None or _shards.metadata is not pool:
+        # The router of a previous event loop still holds the pools of its shards
+        if _shards is not None:
+            for shard_pool in _shards.pools:
+                if shard_pool is not _shards.metadata:
+                    _discard_pool(shard_pool)
+        shards = [await _create_pool(dsn) for dsn in celeryconfig.SHARD_DATABASES]
+        _shards = ShardRouter(pool, shards)
+
+    return _shards
+
+
+def init_database():
+    """Creates the event loop and connection pool of the worker process"""
+    get_loop().run_until_complete(get_shards())
+
+
+def close_database():
+    """Closes the connection pool and the event loop of the worker process"""
+    global _loop, _pool, _shards
+    if _loop is None or _loop.is_closed():
+        return
+
+    if _shards is not None:
+        for pool in _shards.pools:
+            if pool is not _shards.metadata:
+                _loop.run_until_complete(pool.close())
+        _shards = None
+
+    if _pool is not None:
+        _loop.run_until_complete(_pool.close())
+        _pool = None
+
+    _loop.close()
+    _loop = None
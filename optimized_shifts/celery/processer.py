@@ -1,54 +1,282 @@
-import asyncio
 import json
+from datetime import datetime
+from typing import Any
 
 import redis
-from celery import Celery, Task
+from celery import Celery, Task, chord
+from celery.signals import worker_process_init, worker_process_shutdown, worker_shutdown
 
-from .cloud.buckets import DataProcesorTypes
+from .cloud.buckets import ByteRange, DataProcesorFactory, DataProcesorTypes
 from .config import celeryconfig
-from .tasks import process_data_task
+from .database import close_database, get_loop, get_shards, init_database
+from .progress import IngestionProgress
+from .snapshot import export_snapshot_task
+from .stats_cache import invalidate_stats
+from .tasks import attach_partition_task, cluster_trips_task, process_data_task
 
 celery_app = Celery("processer")
 celery_app.config_from_object(celeryconfig)
 
+# Channel where the status of each ingestion is published, the API forwards it to the websocket
+NOTIFICATIONS_CHANNEL = "notifications"
+
+# Key holding the last notification of a task, so any API process can replay it to late subscribers
+LAST_NOTIFICATION_KEY = "notifications:last:{task_id}"
+
+# Set while an export is scheduled and has not started, ingestions finished meanwhile are
+# exported by it. Expires in case the task is lost
+SNAPSHOT_PENDING_KEY = "snapshots:pending"
+
 r = redis.Redis.from_url(celery_app.conf["BROKER_URL"])
-pubsub = r.pubsub(ignore_subscribe_messages=True)
-pubsub.subscribe("notifications")
 
 
-async def _process_data_async(
-    task_id: str | None,
+@worker_process_init.connect
+def _init_worker_process(**_):  # type: ignore
+    init_database()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def _shutdown_worker_process(**_):  # type: ignore
+    close_database()
+
+
+def _publish(r: "redis.Redis[bytes]", notification: dict[str, Any]):
+    message = json.dumps(notification)
+    pipe = r.pipeline(transaction=False)
+    if notification.get("task_id"):
+        pipe.set(
+            LAST_NOTIFICATION_KEY.format(task_id=notification["task_id"]),
+            message,
+            ex=celery_app.conf["NOTIFICATIONS_REPLAY_TTL"],
+        )
+    pipe.publish(NOTIFICATIONS_CHANNEL, message)
+    pipe.execute()
+
+
+def _progress(task_id: str) -> IngestionProgress:
+    return IngestionProgress(
+        r,
+        lambda notification: _publish(r, notification),
+        task_id,
+        celery_app.conf["INGEST_PROGRESS_INTERVAL"],
+    )
+
+
+async def _process_partition_async(
     data_type: DataProcesorTypes,
     data: str,
-    r: "redis.Redis[bytes]",
-):
-    processed = await process_data_task(data_type, data)
-
-    if not processed:
-        r.publish(
-            "notifications",
-            json.dumps(
-                {
-                    "task_id": task_id,
-                    "status": "FAILED",
-                    "message": f"Unable to get data file from {data_type} or file cannot be converted into pandas",
-                }
-            ),
+    byte_range: ByteRange,
+    task_id: str | None = None,
+) -> dict[str, Any]:
+    progress = _progress(task_id) if task_id else None
+    try:
+        processed = await process_data_task(
+            data_type,
+            data,
+            celery_app.conf["INGEST_CHUNK_SIZE"],
+            byte_range=byte_range,
+            cluster_distance=celery_app.conf["CLUSTER_DISTANCE"],
+            cluster_time_window=celery_app.conf["CLUSTER_TIME_WINDOW"],
+            on_progress=progress.update if progress else None,
+        )
+    except Exception as exc:
+        return {"rows": 0, "regions": [], "region_names": [], "error": str(exc)}
+
+    if processed is None:
+        return {
+            "rows": 0,
+            "regions": [],
+            "region_names": [],
+            "error": f"Unable to get data file from {data_type} or file cannot be converted into pandas",
+        }
+
+    # The partition is committed, cached stats of its regions are outdated now
+    invalidate_stats(r, processed.region_ids)
+
+    return {
+        "rows": processed.rows,
+        "regions": processed.region_ids,
+        "region_names": processed.region_names,
+        "error": None,
+    }
+
+
+@celery_app.task(name="process_data", bind=True)
+def process_data(self: Task, data_type: DataProcesorTypes, data: str):  # type: ignore
+    """Splits the file in partitions that are inserted in parallel by `process_partition`
+    subtasks, once all of them finish `notify_ingestion` publishes a single notification"""
+    processor = DataProcesorFactory.create(data_type)
+    partitions = processor.partitions(data, celery_app.conf["INGEST_PARTITION_SIZE"])
+
+    if partitions is None:
+        _publish(
+            r,
+            {
+                "task_id": self.request.id,
+                "status": "FAILED",
+                "message": f"Unable to get data file from {data_type} or file cannot be converted into pandas",
+            },
         )
         return
 
-    r.publish(
-        "notifications",
-        json.dumps(
+    # A file without rows has nothing to fan out
+    if not partitions:
+        notify_ingestion([], self.request.id)
+        return
+
+    # Progress is keyed by the task id, direct calls outside Celery have none
+    if self.request.id:
+        _progress(self.request.id).start(
+            sum(end - start for start, end in partitions), len(partitions)
+        )
+    chord(
+        process_partition.s(data_type, data, partition, self.request.id)
+        for partition in partitions
+    )(notify_ingestion.s(self.request.id))
+
+
+@celery_app.task(name="process_partition")
+def process_partition(  # type: ignore
+    data_type: DataProcesorTypes,
+    data: str,
+    byte_range: list[int],
+    task_id: str | None = None,
+) -> dict[str, Any]:
+    start, end = byte_range
+    return get_loop().run_until_complete(
+        _process_partition_async(data_type, data, (start, end), task_id)
+    )
+
+
+@celery_app.task(name="notify_ingestion")
+def notify_ingestion(results: list[dict[str, Any]], task_id: str | None):  # type: ignore
+    if task_id:
+        _progress(task_id).finish()
+
+    rows = sum(result["rows"] for result in results)
+    errors = [result["error"] for result in results if result["error"]]
+
+    regions = sorted({region for result in results for region in result["regions"]})
+    if regions:
+        compact_weekly_cells.delay(regions)
+        _schedule_snapshot()
+
+    # Region names let websocket clients subscribe to the ingestions of a region
+    region_names = sorted({name for result in results for name in result["region_names"]})
+
+    if errors:
+        _publish(
+            r,
             {
                 "task_id": task_id,
-                "status": "DONE",
-                "message": "Data successfully inserted in postgis",
-            }
-        ),
+                "status": "FAILED",
+                "message": errors[0],
+                "rows": rows,
+                "partitions": len(results),
+                "failed_partitions": len(errors),
+                "regions": region_names,
+            },
+        )
+        return
+
+    _publish(
+        r,
+        {
+            "task_id": task_id,
+            "status": "DONE",
+            "message": "Data successfully inserted in postgis",
+            "rows": rows,
+            "partitions": len(results),
+            "failed_partitions": 0,
+            "regions": region_names,
+        },
     )
 
 
-@celery_app.task(name="process_data", bind=True)
-def process_data(self: Task, data_type: DataProcesorTypes, data: str):  # type: ignore
-    asyncio.run(_process_data_async(self.request.id, data_type, data, r))
+@celery_app.task(name="attach_partition", bind=True)
+def attach_partition(self: Task, table: str, month: str):  # type: ignore
+    """Attaches a table pre-loaded with the trips of `month` (ISO date) as a partition,
+    notifying the result the same way as `process_data`"""
+    try:
+        attached = get_loop().run_until_complete(
+            attach_partition_task(table, datetime.fromisoformat(month))
+        )
+    except Exception as exc:
+        _publish(
+            r,
+            {"task_id": self.request.id, "status": "FAILED", "message": str(exc)},
+        )
+        return
+
+    if attached.region_ids:
+        invalidate_stats(r, attached.region_ids)
+        compact_weekly_cells.delay(attached.region_ids)
+        cluster_trips.delay(attached.region_ids)
+        _schedule_snapshot()
+
+    _publish(
+        r,
+        {
+            "task_id": self.request.id,
+            "status": "DONE",
+            "message": f"Partition {table} attached",
+            "rows": attached.rows,
+            "regions": attached.region_names,
+        },
+    )
+
+
+async def _compact_weekly_cells_async(region_ids: list[int]):
+    shards = await get_shards()
+    for pool, shard_region_ids in await shards.split(region_ids):
+        async with pool.acquire() as conn:
+            for region_id in shard_region_ids:
+                await conn.execute("SELECT compact_trips_weekly_cells($1)", region_id)
+
+
+@celery_app.task(name="compact_weekly_cells")
+def compact_weekly_cells(region_ids: list[int]):  # type: ignore
+    """Merges the weekly counts appended by each insertion of the given regions"""
+    get_loop().run_until_complete(_compact_weekly_cells_async(region_ids))
+
+
+@celery_app.task(name="cluster_trips")
+def cluster_trips(region_ids: list[int]) -> int:  # type: ignore
+    """Groups again all the trips of the given regions by origin, destination and time
+    of day. Ingested trips are grouped as they are inserted, this is only needed for
+    attached partitions or after changing the thresholds"""
+    return get_loop().run_until_complete(
+        cluster_trips_task(
+            region_ids,
+            celery_app.conf["CLUSTER_DISTANCE"],
+            celery_app.conf["CLUSTER_TIME_WINDOW"],
+        )
+    )
+
+
+def _schedule_snapshot():
+    """Schedules an export of the trips in SNAPSHOT_INTERVAL seconds, unless one is already
+    pending, so a burst of ingestions rewrites the snapshot once"""
+    # Snapshots read the trips of the main database, they don't support shards yet
+    if not celery_app.conf["SNAPSHOT_DIR"] or celery_app.conf["SHARD_DATABASES"]:
+        return
+
+    interval = celery_app.conf["SNAPSHOT_INTERVAL"]
+    if r.set(SNAPSHOT_PENDING_KEY, 1, nx=True, ex=2 * interval + 60):
+        export_snapshot.apply_async(countdown=interval)
+
+
+@celery_app.task(name="export_snapshot")
+def export_snapshot() -> dict[str, Any]:  # type: ignore
+    """Exports every trip to a new columnar snapshot in SNAPSHOT_DIR, which API processes
+    memory-map instead of loading the trips from the database"""
+    # Ingestions finishing from now on may not be visible to the export, they schedule another
+    r.delete(SNAPSHOT_PENDING_KEY)
+    return get_loop().run_until_complete(
+        export_snapshot_task(
+            celery_app.conf["SNAPSHOT_DIR"],
+            celery_app.conf["COLUMNAR_GRID_SIZE"],
+            celery_app.conf["SNAPSHOT_KEEP"],
+        )
+    )
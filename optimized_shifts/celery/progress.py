@@ -0,0 +1,86 @@
+import time
+from typing import Any, Callable
+
+import redis
+
+# Counters of an ingestion are kept for at most a day, in case its final notification is never sent
+PROGRESS_TTL = 24 * 60 * 60
+
+_COUNTERS = ("rows_parsed", "rows_inserted", "bytes_read")
+
+
+class IngestionProgress:
+    """Aggregates the progress of all the partitions of an ingestion in a Redis hash, so
+    partitions running in different workers report a single ingestion-wide figure.
+
+    Every `update` is a single round trip, and at most one PROGRESS notification is
+    published every `interval` seconds across all the partitions"""
+
+    def __init__(
+        self,
+        r: "redis.Redis[bytes]",
+        publish: Callable[[dict[str, Any]], None],
+        task_id: str,
+        interval: float,
+    ):
+        self.r = r
+        self.publish = publish
+        self.task_id = task_id
+        self.interval = interval
+        self.key = f"ingestion:{task_id}:progress"
+        self.throttle_key = f"ingestion:{task_id}:throttle"
+
+    def start(self, total_bytes: int, partitions: int):
+        """Resets the counters of the ingestion, called once before the partitions start"""
+        pipe = self.r.pipeline(transaction=False)
+        pipe.delete(self.key, self.throttle_key)
+        pipe.hset(
+            self.key,
+            mapping={
+                "started_at": time.time(),
+                "total_bytes": total_bytes,
+                "partitions": partitions,
+                **{counter: 0 for counter in _COUNTERS},
+            },
+        )
+        pipe.expire(self.key, PROGRESS_TTL)
+        pipe.execute()
+
+    def update(self, rows_parsed: int, rows_inserted: int, bytes_read: int):
+        """Adds the progress of a chunk, publishing the totals if no other partition
+        did it in the last `interval` seconds"""
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hincrby(self.key, "rows_parsed", rows_parsed)
+        pipe.hincrby(self.key, "rows_inserted", rows_inserted)
+        pipe.hincrby(self.key, "bytes_read", bytes_read)
+        pipe.set(self.throttle_key, 1, nx=True, px=max(int(self.interval * 1000), 1))
+        pipe.hgetall(self.key)
+        try:
+            *_, acquired, values = pipe.execute()
+            if acquired:
+                self.publish(self.notification(values))
+        except redis.RedisError:
+            # Progress is best effort, it must never fail the ingestion
+            pass
+
+    def finish(self):
+        self.r.delete(self.key, self.throttle_key)
+
+    def notification(self, values: dict[bytes, bytes]) -> dict[str, Any]:
+        counters = {counter: int(values.get(counter.encode(), 0)) for counter in _COUNTERS}
+        total_bytes = int(values.get(b"total_bytes", 0))
+        elapsed = max(time.time() - float(values.get(b"started_at", time.time())), 1e-6)
+
+        # ETA extrapolates the byte rate, bytes are the only total known before parsing
+        read = counters["bytes_read"]
+        eta = elapsed * (total_bytes - read) / read if read else None
+
+        return {
+            "task_id": self.task_id,
+            "status": "PROGRESS",
+            **counters,
+            "total_bytes": total_bytes,
+            "partitions": int(values.get(b"partitions", 0)),
+            "rows_per_second": round(counters["rows_inserted"] / elapsed, 1),
+            "eta_seconds": round(max(eta, 0), 1) if eta is not None else None,
+        }
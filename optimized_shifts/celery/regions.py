@@ -0,0 +1,111 @@
+import time
+from typing import Iterable
+
+from .config import celeryconfig
+from .connection import Connection
+
+# Inserts the missing names and reads the existing ones in a single statement. The SELECT
+# doesn't see the rows inserted by the CTE, so both halves never return the same region
+UPSERT_REGIONS_STMT = """
+    WITH inserted AS (
+        INSERT INTO regions (region_name)
+        SELECT unnest($1::text[])
+        ON CONFLICT (region_name) DO NOTHING
+        RETURNING region_id, region_name
+    )
+    SELECT region_id, region_name FROM inserted
+    UNION ALL
+    SELECT region_id, region_name FROM regions WHERE region_name = ANY($1::text[])
+"""
+
+SELECT_REGIONS_STMT = """
+    SELECT region_id, region_name FROM regions WHERE region_name = ANY($1::text[])
+"""
+
+
+class RegionCache:
+    """In-process cache of region name -> id. Regions are never renamed nor deleted by the
+    application, entries expire after `ttl` seconds in case it's done by hand"""
+
+    def __init__(self, ttl: float = celeryconfig.REGION_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: dict[str, tuple[int, float]] = {}
+
+    def get(self, name: str) -> int | None:
+        entry = self._entries.get(name)
+        if entry is None or entry[1] <= time.monotonic():
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry[0]
+
+    def get_many(self, names: Iterable[str]) -> tuple[dict[str, int], set[str]]:
+        """Returns the cached ids of `names` and the names that aren't cached"""
+        found: dict[str, int] = {}
+        missing: set[str] = set()
+        for name in names:
+            region_id = self.get(name)
+            if region_id is None:
+                missing.add(name)
+            else:
+                found[name] = region_id
+
+        return found, missing
+
+    def set_many(self, regions: dict[str, int]):
+        expires = time.monotonic() + self.ttl
+        for name, region_id in regions.items():
+            self._entries[name] = (region_id, expires)
+
+    def invalidate(self, name: str | None = None):
+        """Drops a region from the cache, or every region if no name is given"""
+        if name is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(name, None)
+
+    def metrics(self) -> dict[str, int | float]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "ttl": self.ttl,
+        }
+
+
+# Each API and worker process keeps its own cache
+region_cache = RegionCache()
+
+
+async def fetch_regions(
+    conn: Connection, names: set[str]
+) -> dict[str, int]:
+    """Returns the ids of the existing regions in `names` and caches them"""
+    rows = await conn.fetch(SELECT_REGIONS_STMT, list(names))
+    regions = {row["region_name"]: row["region_id"] for row in rows}
+    region_cache.set_many(regions)
+
+    return regions
+
+
+async def fetch_or_create_regions(
+    conn: Connection, names: set[str]
+) -> dict[str, int]:
+    """Returns the ids of `names`, creating the regions that don't exist, and caches them.
+    Safe to run concurrently from several processes creating the same regions"""
+    regions: dict[str, int] = {}
+    missing = set(names)
+
+    # A region committed by another process after this statement started is neither
+    # inserted nor seen by the SELECT, the next attempt reads it
+    while missing:
+        rows = await conn.fetch(UPSERT_REGIONS_STMT, list(missing))
+        fetched = {row["region_name"]: row["region_id"] for row in rows}
+        regions |= fetched
+        missing -= fetched.keys()
+
+    region_cache.set_many(regions)
+    return regions
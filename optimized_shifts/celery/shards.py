@@ -0,0 +1,141 @@
+from typing import Iterable
+
+import asyncpg
+
+from .connection import Connection
+
+# Regions live in the metadata database, the trips of each region (and its weekly cells, sample
+# and groups) in the shard assigned to it in region_shards. Assignments never change, so adding
+# a shard only affects the regions created afterwards
+SELECT_SHARDS_STMT = """
+    SELECT region_id, shard FROM region_shards WHERE region_id = ANY($1::int[])
+"""
+
+COUNT_SHARDS_STMT = """
+    SELECT shard, COUNT(*) AS regions FROM region_shards WHERE shard < $1 GROUP BY shard
+"""
+
+ASSIGN_SHARDS_STMT = """
+    INSERT INTO region_shards (region_id, shard)
+    SELECT * FROM unnest($1::int[], $2::smallint[])
+"""
+
+SELECT_REGIONS_STMT = """
+    SELECT region_id, region_name FROM regions WHERE region_id = ANY($1::int[])
+"""
+
+# Shards keep a copy of their regions with the same ids, required by the foreign keys of trips
+REPLICATE_REGIONS_STMT = """
+    INSERT INTO regions (region_id, region_name) OVERRIDING SYSTEM VALUE
+    SELECT * FROM unnest($1::int[], $2::text[])
+    ON CONFLICT DO NOTHING
+"""
+
+
+async def connect_shards(dsns: Iterable[str]) -> "list[asyncpg.Pool[asyncpg.Record]]":
+    """Creates a connection pool for each shard of `dsns`, in order"""
+    pools: "list[asyncpg.Pool[asyncpg.Record]]" = []
+    for shard, dsn in enumerate(dsns):
+        pool = await asyncpg.create_pool(dsn)
+        if not pool:
+            raise Exception(f"Unable to connect with shard {shard}")
+        pools.append(pool)
+
+    return pools
+
+
+class ShardRouter:
+    """Routes the trips of each region to one of several databases. Without `shards` the
+    metadata database is the only shard and no assignment is stored"""
+
+    def __init__(
+        self,
+        metadata: "asyncpg.Pool[asyncpg.Record]",
+        shards: "list[asyncpg.Pool[asyncpg.Record]] | None" = None,
+    ):
+        self.metadata = metadata
+        self.pools = list(shards) if shards else [metadata]
+        self.sharded = bool(shards)
+        # Assignments are cached for the lifetime of the process
+        self._shards: dict[int, int] = {}
+
+    async def shards_of(self, region_ids: Iterable[int]) -> dict[int, int]:
+        """Returns the shard of each region, assigning the regions that don't have one to
+        the shard with the fewest regions and copying them into it"""
+        region_ids = set(region_ids)
+        if not self.sharded:
+            return dict.fromkeys(region_ids, 0)
+
+        missing = region_ids - self._shards.keys()
+        if missing:
+            await self._load(missing)
+
+        return {region_id: self._shards[region_id] for region_id in region_ids}
+
+    async def pool(self, region_id: int) -> "asyncpg.Pool[asyncpg.Record]":
+        """Returns the database that holds the trips of the region"""
+        return self.pools[(await self.shards_of((region_id,)))[region_id]]
+
+    async def split(
+        self, region_ids: Iterable[int]
+    ) -> "list[tuple[asyncpg.Pool[asyncpg.Record], list[int]]]":
+        """Groups the regions by the database that holds their trips"""
+        grouped: dict[int, list[int]] = {}
+        for region_id, shard in (await self.shards_of(region_ids)).items():
+            grouped.setdefault(shard, []).append(region_id)
+
+        return [(self.pools[shard], sorted(ids)) for shard, ids in sorted(grouped.items())]
+
+    async def _load(self, region_ids: set[int]):
+        async with self.metadata.acquire() as conn:
+            shards = await self._fetch(conn, region_ids)
+
+            if region_ids - shards.keys():
+                async with conn.transaction():
+                    # Serializes the assignments, so concurrent processes balance the shards
+                    # with each other's regions and never assign the same region twice
+                    await conn.execute("SELECT pg_advisory_xact_lock(hashtext('region_shards'))")
+                    shards = await self._fetch(conn, region_ids)
+                    await self._assign(conn, region_ids - shards.keys(), shards)
+
+            regions = await conn.fetch(SELECT_REGIONS_STMT, list(region_ids))
+
+        names = {row["region_id"]: row["region_name"] for row in regions}
+        for shard, pool in enumerate(self.pools):
+            ids = [region_id for region_id, s in shards.items() if s == shard and region_id in names]
+            if ids and pool is not self.metadata:
+                async with pool.acquire() as shard_conn:
+                    await shard_conn.execute(
+                        REPLICATE_REGIONS_STMT, ids, [names[region_id] for region_id in ids]
+                    )
+
+        self._shards.update(shards)
+
+    async def _fetch(
+        self, conn: Connection, region_ids: set[int]
+    ) -> dict[int, int]:
+        rows = await conn.fetch(SELECT_SHARDS_STMT, list(region_ids))
+        return {row["region_id"]: row["shard"] for row in rows}
+
+    async def _assign(
+        self,
+        conn: Connection,
+        region_ids: set[int],
+        shards: dict[int, int],
+    ):
+        """Assigns `region_ids` to the least used shards, adding them to `shards`"""
+        if not region_ids:
+            return
+
+        counts = [0] * len(self.pools)
+        for row in await conn.fetch(COUNT_SHARDS_STMT, len(self.pools)):
+            counts[row["shard"]] = row["regions"]
+
+        assigned: dict[int, int] = {}
+        for region_id in sorted(region_ids):
+            shard = counts.index(min(counts))
+            counts[shard] += 1
+            assigned[region_id] = shard
+
+        await conn.execute(ASSIGN_SHARDS_STMT, list(assigned.keys()), list(assigned.values()))
+        shards.update(assigned)
@@ -0,0 +1,212 @@
+import io
+import json
+import os
+import re
+import shutil
+import time
+from typing import Any
+
+import asyncpg
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+from .connection import Connection
+from .database import get_pool
+
+# Columns of a snapshot, each region is stored as one .npy file per column sorted by `cells`
+# (origin cell y, origin cell x) and then by time, so it can be memory-mapped as is
+COLUMNS = ("trip_id", "ox", "oy", "dx", "dy", "epoch")
+DTYPES: dict[str, Any] = {
+    "trip_id": np.int64,
+    "region": np.int32,
+    "ox": np.float64,
+    "oy": np.float64,
+    "dx": np.float64,
+    "dy": np.float64,
+    "epoch": np.int64,
+}
+SNAPSHOT_VERSION = 2
+
+# Points to the directory of the latest complete snapshot, replaced atomically
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+
+# Each axis of a cell takes 21 bits of the sort key, cells out of range are clipped
+CELL_BITS = 21
+_CELL_OFFSET = 1 << (CELL_BITS - 1)
+_CELL_MASK = (1 << CELL_BITS) - 1
+
+# The epoch is computed by the database treating the timestamp as UTC, as DATE_TRUNC does
+TRIPS_STMT = """
+    SELECT
+        trip_id,
+        region_id,
+        origin[0],
+        origin[1],
+        destination[0],
+        destination[1],
+        EXTRACT(epoch FROM timestamp)::BIGINT
+    FROM trips
+    WHERE region_id IS NOT NULL AND {where}
+    ORDER BY trip_id
+    {limit}
+"""
+
+# Trips of the transactions that had not committed when `snapshot` (the text of a pg_snapshot)
+# was taken. Trip ids are taken before committing, so a lower id may become visible later.
+# The range on xact lets the BRIN index skip the blocks written before the snapshot
+AFTER_SNAPSHOT = (
+    "xact >= pg_snapshot_xmin('{snapshot}'::pg_snapshot)::TEXT::BIGINT"
+    " AND NOT pg_visible_in_snapshot(xact::TEXT::xid8, '{snapshot}'::pg_snapshot)"
+)
+_PG_SNAPSHOT = re.compile(r"\d+:\d+:(\d+(,\d+)*)?")
+
+
+def after_snapshot(snapshot: str) -> str:
+    """Condition of the trips committed after `snapshot` was taken, for `copy_trips`"""
+    if not _PG_SNAPSHOT.fullmatch(snapshot):
+        raise ValueError(f"Invalid pg_snapshot {snapshot!r}")
+
+    return AFTER_SNAPSHOT.format(snapshot=snapshot)
+
+
+def cells(values: "npt.NDArray[np.float64]", grid_size: float) -> "npt.NDArray[np.int64]":
+    return np.clip(np.floor(values / grid_size).astype(np.int64) + _CELL_OFFSET, 0, _CELL_MASK)
+
+
+def cell_keys(
+    ox: "npt.NDArray[np.float64]", oy: "npt.NDArray[np.float64]", grid_size: float
+) -> "npt.NDArray[np.int64]":
+    """Sort key of the origin cell of each trip, rows of cells are contiguous ranges of keys"""
+    return (cells(oy, grid_size) << CELL_BITS) | cells(ox, grid_size)
+
+
+async def copy_trips(
+    conn: Connection, where: str, limit: int | None = None
+) -> pd.DataFrame | None:
+    """Reads the trips matching `where` with COPY, which is much faster than fetching
+    records for millions of rows. Returns None if there are no trips"""
+    buffer = io.BytesIO()
+
+    async def write(data: bytes):
+        buffer.write(data)
+
+    await conn.copy_from_query(
+        TRIPS_STMT.format(where=where, limit=f"LIMIT {int(limit)}" if limit else ""),
+        output=write,
+        format="csv",
+    )
+    if not buffer.tell():
+        return None
+
+    buffer.seek(0)
+    return pd.read_csv(buffer, header=None, names=list(DTYPES), dtype=DTYPES)  # type: ignore
+
+
+def _write_region(path: str, frame: pd.DataFrame, grid_size: float) -> int:
+    keys = cell_keys(frame["ox"].to_numpy(), frame["oy"].to_numpy(), grid_size)
+    order = np.lexsort((frame["epoch"].to_numpy(), keys))
+
+    os.makedirs(path)
+    np.save(os.path.join(path, "cells.npy"), keys[order])
+    for column in COLUMNS:
+        np.save(os.path.join(path, f"{column}.npy"), frame[column].to_numpy()[order])
+
+    return len(order)
+
+
+def _prune(directory: str, keep: int):
+    snapshots = sorted(
+        name for name in os.listdir(directory) if name.startswith("snapshot-")
+    )
+    # Files still mapped by an API process stay readable after being unlinked
+    for name in snapshots[:-keep]:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+async def export_snapshot_task(
+    directory: str,
+    grid_size: float,
+    keep: int = 2,
+    pool: "asyncpg.Pool[asyncpg.Record] | None" = None,
+) -> dict[str, Any]:
+    """Writes every committed trip as a new snapshot in `directory`, one region at a time
+    to bound the memory used, and makes it the current one. Returns its manifest"""
+    if pool is None:
+        pool = await get_pool()
+
+    created_at = time.time()
+    name = f"snapshot-{int(created_at * 1000)}-{os.getpid()}"
+    tmp = os.path.join(directory, f".{name}")
+    os.makedirs(tmp)
+
+    try:
+        async with pool.acquire() as conn, conn.transaction(
+            isolation="repeatable_read", readonly=True
+        ):
+            # Every region is read from the same pg_snapshot, readers catch up from it with
+            # the trips committed afterwards whatever their ids
+            pg_snapshot = await conn.fetchval("SELECT pg_current_snapshot()::TEXT")
+            region_ids = [row["region_id"] for row in await conn.fetch("SELECT region_id FROM regions")]
+
+            regions: dict[str, int] = {}
+            for region_id in region_ids:
+                frame = await copy_trips(conn, f"region_id = {int(region_id)}")
+                if frame is not None:
+                    regions[str(region_id)] = _write_region(
+                        os.path.join(tmp, f"region-{region_id}"), frame, grid_size
+                    )
+
+        manifest = {
+            "version": SNAPSHOT_VERSION,
+            "grid_size": grid_size,
+            "pg_snapshot": pg_snapshot,
+            "created_at": created_at,
+            "regions": regions,
+        }
+        with open(os.path.join(tmp, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f)
+
+        os.rename(tmp, os.path.join(directory, name))
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    with open(os.path.join(directory, f".{CURRENT_FILE}"), "w") as f:
+        f.write(name)
+    os.replace(os.path.join(directory, f".{CURRENT_FILE}"), os.path.join(directory, CURRENT_FILE))
+
+    _prune(directory, keep)
+    return manifest
+
+
+def current_snapshot(directory: str) -> str | None:
+    """Path of the latest complete snapshot in `directory`, if any"""
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as f:
+            return os.path.join(directory, f.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def open_snapshot(
+    path: str,
+) -> tuple[dict[str, Any], dict[int, dict[str, "npt.NDArray[Any]"]]]:
+    """Memory-maps the columns of every region of a snapshot. Pages are read on demand and
+    shared through the page cache by every process mapping the same snapshot"""
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+
+    if manifest["version"] != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {manifest['version']}")
+
+    regions = {
+        int(region_id): {
+            column: np.load(os.path.join(path, f"region-{region_id}", f"{column}.npy"), mmap_mode="r")
+            for column in (*COLUMNS, "cells")
+        }
+        for region_id in manifest["regions"]
+    }
+
+    return manifest, regions
@@ -0,0 +1,21 @@
+from typing import Iterable
+
+import redis
+
+# The API caches /trips/stats results under the current generation of their region. Bumping
+# the generation invalidates every cached result of the region in O(1), old entries expire
+STATS_CACHE_KEY = "stats:{region_id}:{generation}:{params}"
+STATS_GENERATION_KEY = "stats:generation:{region_id}"
+
+
+def invalidate_stats(r: "redis.Redis[bytes]", region_ids: Iterable[int]):
+    """Invalidates the cached stats of the regions where trips were written"""
+    pipe = r.pipeline(transaction=False)
+    for region_id in region_ids:
+        pipe.incr(STATS_GENERATION_KEY.format(region_id=region_id))
+
+    try:
+        pipe.execute()
+    except redis.RedisError:
+        # Nothing is cached either when Redis is unavailable, the API bypasses the cache then
+        pass
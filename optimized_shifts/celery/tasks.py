@@ -1,70 +1,436 @@
-import os
-from typing import cast
+import asyncio
+import contextlib
+from collections import Counter
+from datetime import datetime
+from typing import Any, Callable, Iterator, NamedTuple
 
 import asyncpg
+import numpy as np
+import pandas as pd
 
-from .cloud.buckets import DataProcesorFactory, DataProcesorTypes
+from .cloud.buckets import (
+    DEFAULT_CHUNKSIZE,
+    ByteRange,
+    DataProcesorFactory,
+    DataProcesorTypes,
+)
+from .config import celeryconfig
+from .connection import Connection
+from .database import get_pool, get_shards
+from .regions import fetch_or_create_regions, region_cache
+from .shards import ShardRouter
 
 
-async def process_data_task(
-    data_type: DataProcesorTypes,
-    data: str,
-):  # type: ignore
-    processor = DataProcesorFactory.create(data_type)
+async def _map_regions(
+    pool: "asyncpg.Pool[asyncpg.Record]",
+    regions: set[str],
+    regions_id_mapped: dict[str, int],
+):
+    """Fills `regions_id_mapped` with the ids of `regions`, creating the missing ones"""
+    regions = regions - regions_id_mapped.keys()
+    if not regions:
+        return
 
-    df = processor.data_to_pandas(data)
+    cached, missing = region_cache.get_many(regions)
+    regions_id_mapped.update(cached)
+    if not missing:
+        return
 
-    if df is None:
-        return None
+    # Regions are committed on their own connection, outside of the trips transaction,
+    # so concurrent partitions don't wait on each other to see them
+    async with pool.acquire() as conn:
+        regions_id_mapped.update(await fetch_or_create_regions(conn, missing))
+
+
+async def _ensure_partitions(
+    pool: "asyncpg.Pool[asyncpg.Record]",
+    timestamps: "pd.Series[pd.Timestamp]",
+    ensured_months: set[pd.Period],
+):
+    """Creates the monthly partitions of trips needed by `timestamps` that weren't
+    created yet by this ingestion, keeping track of them in `ensured_months`"""
+    months = set(timestamps.dt.to_period("M").unique()) - ensured_months  # type: ignore
+    if not months:
+        return
+
+    # Same as regions, partitions are created outside of the trips transaction
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "SELECT ensure_trips_partitions($1, $2)",
+            min(months).start_time.to_pydatetime(),
+            max(months).start_time.to_pydatetime(),
+        )
+
+    ensured_months.update(months)
 
-    host = os.environ.get("POSTGRES_HOST")
-    user = os.environ.get("POSTGRES_USER")
-    password = os.environ.get("POSTGRES_PASSWORD")
-    database = os.environ.get("POSTGRES_DB")
 
-    regions = set(df["region"].unique())  # type: ignore
-    regions_id_mapped: dict[str, int | None] = {region: None for region in regions}
+async def _assign_groups(
+    pool: "asyncpg.Pool[asyncpg.Record]",
+    df: pd.DataFrame,
+    regions_id_mapped: dict[str, int],
+    cluster_distance: float,
+    cluster_time_window: int,
+) -> list[int]:
+    """Returns the group of each trip of `df`, in the same order, creating the groups
+    that don't exist yet"""
+    # Same as regions, new groups are committed outside of the trips transaction
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT trip_group_ids($1, $2, $3, $4, $5, $6, $7, $8) AS group_id",
+            df["region"].map(regions_id_mapped).tolist(),  # type: ignore
+            df["origin_x"].tolist(),
+            df["origin_y"].tolist(),
+            df["destination_x"].tolist(),
+            df["destination_y"].tolist(),
+            df["timestamp"].to_numpy().astype("datetime64[us]").tolist(),
+            cluster_distance,
+            cluster_time_window,
+        )
 
-    conn = await asyncpg.connect(
-        host=host, user=user, password=password, database=database
+    return [row["group_id"] for row in rows]
+
+
+async def add_group_sizes(
+    conn: Connection, group_sizes: Counter[int]
+):
+    """Adds the trips inserted in each group to its size, it must run in the same
+    transaction that inserts the trips"""
+    if not group_sizes:
+        return
+
+    await conn.execute(
+        "SELECT add_trip_group_sizes($1, $2)",
+        list(group_sizes.keys()),
+        list(group_sizes.values()),
     )
-    prepared = ", ".join(f"${i+1}" for i in range(len(regions)))
-    stmt = f"""SELECT region_id, region_name FROM regions WHERE region_name in ({prepared})"""
-    rows = await conn.fetch(stmt, *regions)
-    for row in rows:
-        regions_id_mapped[row["region_name"]] = row["region_id"]
-
-    # Insert regions that doesn't exists yet
-    to_insert = [key for key, value in regions_id_mapped.items() if value is None]
+
+
+TRIPS_COLUMNS = ["region_id", "origin", "destination", "timestamp", "source"]
+
+# Probability of a trip being in trips_sample, the lowest level of trips_sample_level in init.sql
+TRIPS_SAMPLE_RATE = 1 / 16
+
+
+def _trips_records(
+    df: pd.DataFrame,
+    regions_id_mapped: dict[str, int],
+    group_ids: list[int] | None = None,
+) -> list[tuple[Any, ...]]:
+    """Builds the trips rows column by column instead of indexing the frame per row"""
+    sources = df["source"].astype(object)
+    columns = [
+        df["region"].map(regions_id_mapped).tolist(),  # type: ignore
+        zip(df["origin_x"].tolist(), df["origin_y"].tolist()),
+        zip(df["destination_x"].tolist(), df["destination_y"].tolist()),
+        df["timestamp"].to_numpy().astype("datetime64[us]").tolist(),
+        sources.where(sources.notna(), None).tolist(),  # type: ignore
+    ]
+    if group_ids is not None:
+        columns.append(group_ids)
+
+    return list(zip(*columns))
+
+
+async def insert_trips(
+    conn: Connection,
+    df: pd.DataFrame,
+    regions_id_mapped: dict[str, int],
+    returning: bool = False,
+    group_ids: list[int] | None = None,
+) -> list[asyncpg.Record] | None:
+    """Inserts the trips of `df` using binary COPY, with their `group_ids` if given.
+    Inserted rows are only sent back when `returning` is set, in which case a regular
+    INSERT is used instead"""
+    records = _trips_records(df, regions_id_mapped, group_ids)
+
+    if returning:
+        stmt = """
+        INSERT INTO trips (region_id, origin, destination, timestamp, source, group_id) (
+            SELECT r.region_id, r.origin, r.destination, r.timestamp, r.source, r.group_id
+            FROM unnest($1::trips[]) as r
+        )
+        RETURNING trip_id, region_id, origin, destination, timestamp, source, group_id
+        """
+        if group_ids is None:
+            return await conn.fetch(stmt, [(None, *record, None, None) for record in records])
+
+        return await conn.fetch(stmt, [(None, *record, None) for record in records])
+
+    columns = TRIPS_COLUMNS if group_ids is None else [*TRIPS_COLUMNS, "group_id"]
+    await conn.copy_records_to_table("trips", records=records, columns=columns)
+    return None
+
+
+async def insert_weekly_cells(
+    conn: Connection,
+    df: pd.DataFrame,
+    regions_id_mapped: dict[str, int],
+):
+    """Adds the trips of `df` to the weekly counts by grid cell used by the stats query,
+    it must run in the same transaction that inserts the trips"""
     stmt = """
-        INSERT INTO regions (region_name) (
-            SELECT r.region_name 
-            FROM unnest($1::regions[]) as r
-        ) 
-        RETURNING region_id, region_name
+    INSERT INTO trips_weekly_cells (
+        SELECT
+            t.region_id,
+            DATE_TRUNC('week', t.timestamp),
+            trips_grid_cell(t.origin_x),
+            trips_grid_cell(t.origin_y),
+            trips_grid_cell(t.destination_x),
+            trips_grid_cell(t.destination_y),
+            COUNT(*)
+        FROM unnest(
+            $1::int[], $2::float8[], $3::float8[], $4::float8[], $5::float8[], $6::timestamp[]
+        ) AS t(region_id, origin_x, origin_y, destination_x, destination_y, timestamp)
+        GROUP BY 1, 2, 3, 4, 5, 6
+    )
     """
-    rows = await conn.fetch(stmt, [(None, name) for name in to_insert])
-    for row in rows:
-        regions_id_mapped[row["region_name"]] = row["region_id"]
+    await conn.execute(
+        stmt,
+        df["region"].map(regions_id_mapped).tolist(),  # type: ignore
+        df["origin_x"].tolist(),
+        df["origin_y"].tolist(),
+        df["destination_x"].tolist(),
+        df["destination_y"].tolist(),
+        df["timestamp"].to_numpy().astype("datetime64[us]").tolist(),
+    )
+
 
+async def insert_trips_sample(
+    conn: Connection,
+    df: pd.DataFrame,
+    regions_id_mapped: dict[str, int],
+):
+    """Adds a Bernoulli sample of the trips of `df` to trips_sample, used by the approximate
+    stats. Only the sampled rows are sent, the level of each one is chosen by the database
+    from the same uniform value, it must run in the same transaction that inserts the trips"""
+    u = np.random.default_rng().random(len(df))
+    sampled = u < TRIPS_SAMPLE_RATE
+    if not sampled.any():
+        return
+
+    rows = df[sampled]
     stmt = """
-    INSERT INTO trips (region_id, origin, destination, timestamp, source) (
-        SELECT r.region_id, r.origin, r.destination, r.timestamp, r.source
-        FROM unnest($1::trips[]) as r
+    INSERT INTO trips_sample (
+        SELECT
+            t.region_id,
+            point(t.origin_x, t.origin_y),
+            point(t.destination_x, t.destination_y),
+            t.timestamp,
+            trips_sample_level(t.u)
+        FROM unnest(
+            $1::int[], $2::float8[], $3::float8[], $4::float8[], $5::float8[], $6::timestamp[], $7::float8[]
+        ) AS t(region_id, origin_x, origin_y, destination_x, destination_y, timestamp, u)
     )
-    RETURNING trip_id, region_id, origin, destination, timestamp, source
     """
-    return await conn.fetch(
+    await conn.execute(
         stmt,
-        [
-            (
-                None,
-                cast(int, regions_id_mapped[df.loc[i, "region"]]),  # type: ignore
-                (df.loc[i, "origin_x"], df.loc[i, "origin_y"]),
-                (df.loc[i, "destination_x"], df.loc[i, "destination_y"]),
-                df.loc[i, "timestamp"],
-                df.loc[i, "source"],
+        rows["region"].map(regions_id_mapped).tolist(),  # type: ignore
+        rows["origin_x"].tolist(),
+        rows["origin_y"].tolist(),
+        rows["destination_x"].tolist(),
+        rows["destination_y"].tolist(),
+        rows["timestamp"].to_numpy().astype("datetime64[us]").tolist(),
+        u[sampled].tolist(),
+    )
+
+
+class IngestionResult(NamedTuple):
+    rows: int
+    region_ids: list[int]
+    region_names: list[str]
+
+
+def _next_chunk(chunks: Iterator[pd.DataFrame]) -> pd.DataFrame | None:
+    return next(chunks, None)
+
+
+# Called after each chunk with the rows parsed, the rows inserted and the bytes read since
+# the previous call
+ProgressCallback = Callable[[int, int, int], None]
+
+
+class _ShardIngestion:
+    """Trips of an ingestion that belong to one shard, inserted in a transaction of
+    their own that is committed once every chunk of the ingestion was inserted"""
+
+    def __init__(
+        self,
+        pool: "asyncpg.Pool[asyncpg.Record]",
+        conn: Connection,
+    ):
+        self.pool = pool
+        self.conn = conn
+        self.ensured_months: set[pd.Period] = set()
+        self.group_sizes: Counter[int] = Counter()
+
+    async def insert(
+        self,
+        df: pd.DataFrame,
+        regions_id_mapped: dict[str, int],
+        cluster_distance: float,
+        cluster_time_window: int,
+    ):
+        await _ensure_partitions(self.pool, df["timestamp"], self.ensured_months)  # type: ignore
+        group_ids = await _assign_groups(
+            self.pool, df, regions_id_mapped, cluster_distance, cluster_time_window
+        )
+        await insert_trips(self.conn, df, regions_id_mapped, group_ids=group_ids)
+        await insert_weekly_cells(self.conn, df, regions_id_mapped)
+        await insert_trips_sample(self.conn, df, regions_id_mapped)
+        self.group_sizes.update(group_ids)
+
+
+async def process_data_task(
+    data_type: DataProcesorTypes,
+    data: str,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    pool: "asyncpg.Pool[asyncpg.Record] | None" = None,
+    byte_range: ByteRange | None = None,
+    cluster_distance: float = celeryconfig.CLUSTER_DISTANCE,
+    cluster_time_window: int = celeryconfig.CLUSTER_TIME_WINDOW,
+    on_progress: ProgressCallback | None = None,
+    shards: ShardRouter | None = None,
+) -> IngestionResult | None:
+    """Streams `data` in chunks of `chunksize` rows into the database, only the rows
+    inside `byte_range` if given. The rows of each chunk are split by the shard of
+    their region and the shards are loaded concurrently. Each trip is assigned to its
+    group of similar trips as it's inserted, and `on_progress` is called once per chunk.
+    Returns the amount of inserted trips and the regions they belong to, or None if
+    data cannot be read"""
+    processor = DataProcesorFactory.create(data_type)
+
+    chunks = processor.data_to_chunks(data, chunksize, byte_range)
+
+    if chunks is None:
+        return None
+
+    if shards is None:
+        shards = ShardRouter(pool) if pool is not None else await get_shards()
+
+    regions_id_mapped: dict[str, int] = {}
+    ingestions: dict[int, _ShardIngestion] = {}
+    inserted = 0
+    malformed = bytes_read = 0
+
+    # Next chunk is parsed in a thread while the current one is being inserted,
+    # so at most two chunks are held in memory at any time
+    pending = asyncio.ensure_future(asyncio.to_thread(_next_chunk, chunks))
+    try:
+        # Each shard is inserted entirely or not at all. Shards commit one after the other,
+        # a failure while committing may leave the partition inserted only in some of them
+        async with contextlib.AsyncExitStack() as stack:
+            while (df := await pending) is not None:
+                pending = asyncio.ensure_future(
+                    asyncio.to_thread(_next_chunk, chunks)
+                )
+
+                await _map_regions(shards.metadata, set(df["region"].unique()), regions_id_mapped)  # type: ignore
+                region_ids = df["region"].map(regions_id_mapped)
+                region_shards = await shards.shards_of(region_ids.unique().tolist())
+                row_shards = region_ids.map(region_shards).to_numpy()
+
+                shard_ids = np.unique(row_shards).tolist()
+                frames = {
+                    shard: df if len(shard_ids) == 1 else df[row_shards == shard]
+                    for shard in shard_ids
+                }
+                for shard in frames:
+                    if shard not in ingestions:
+                        conn = await stack.enter_async_context(shards.pools[shard].acquire())
+                        await stack.enter_async_context(conn.transaction())
+                        ingestions[shard] = _ShardIngestion(shards.pools[shard], conn)
+
+                await asyncio.gather(
+                    *(
+                        ingestions[shard].insert(
+                            frame, regions_id_mapped, cluster_distance, cluster_time_window
+                        )
+                        for shard, frame in frames.items()
+                    )
+                )
+                inserted += len(df)
+
+                if on_progress is not None:
+                    # Malformed rows were parsed but are never inserted
+                    on_progress(
+                        len(df) + processor.malformed_rows - malformed,
+                        len(df),
+                        processor.bytes_read - bytes_read,
+                    )
+                    malformed = processor.malformed_rows
+                    bytes_read = processor.bytes_read
+
+            # Group rows stay locked until commit, so they are updated once at the end
+            await asyncio.gather(
+                *(
+                    add_group_sizes(ingestion.conn, ingestion.group_sizes)
+                    for ingestion in ingestions.values()
+                )
             )
-            for i in range(len(df))
-        ],
+    finally:
+        if not pending.done():
+            await asyncio.wait([pending])
+
+    return IngestionResult(
+        inserted, sorted(regions_id_mapped.values()), sorted(regions_id_mapped.keys())
     )
+
+
+async def attach_partition_task(
+    table: str,
+    month: datetime,
+    pool: "asyncpg.Pool[asyncpg.Record] | None" = None,
+) -> IngestionResult:
+    """Attaches `table`, loaded outside of the application with the rows of `month`,
+    as a partition of trips. Returns the amount of attached trips and their regions.
+    Not available with SHARD_DATABASES, the rows of the table aren't routed by region"""
+    if pool is None:
+        if celeryconfig.SHARD_DATABASES:
+            raise ValueError("Partitions can't be attached when trips are split in shards")
+        pool = await get_pool()
+
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            attached = await conn.fetchval(
+                "SELECT attach_trips_partition($1::regclass, $2)", table, month
+            )
+            regions = await conn.fetch(
+                """
+                SELECT region_id, region_name FROM regions
+                WHERE region_id IN (
+                    SELECT DISTINCT region_id FROM trips
+                    WHERE timestamp >= DATE_TRUNC('month', $1::timestamp) AND
+                        timestamp < DATE_TRUNC('month', $1::timestamp) + INTERVAL '1 month'
+                )
+                ORDER BY region_id
+                """,
+                month,
+            )
+
+    return IngestionResult(
+        attached,
+        [row["region_id"] for row in regions],
+        sorted(row["region_name"] for row in regions),
+    )
+
+
+async def cluster_trips_task(
+    region_ids: list[int],
+    distance: float,
+    time_window: int,
+    pool: "asyncpg.Pool[asyncpg.Record] | None" = None,
+) -> int:
+    """Assigns every trip of `region_ids` to its group of similar trips. Returns the
+    amount of groups of those regions"""
+    shards = ShardRouter(pool) if pool is not None else await get_shards()
+
+    groups = 0
+    for shard_pool, shard_region_ids in await shards.split(region_ids):
+        async with shard_pool.acquire() as conn:
+            # Each region is committed on its own, a failure doesn't undo the others
+            for region_id in shard_region_ids:
+                groups += await conn.fetchval(
+                    "SELECT cluster_trips($1, $2, $3)", region_id, distance, time_window
+                )
+
+    return groups
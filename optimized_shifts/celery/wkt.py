@@ -0,0 +1,74 @@
+from typing import NamedTuple
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+_NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+_POINT_PATTERN = rf"^\s*POINT\s*\(\s*({_NUMBER})\s+({_NUMBER})\s*\)\s*$"
+
+# Token placed after every point when tokenizing, it can't be parsed as a float
+_SEPARATOR = ";"
+
+
+class ParsedPoints(NamedTuple):
+    x: npt.NDArray[np.float64]
+    y: npt.NDArray[np.float64]
+    malformed: npt.NDArray[np.bool_]
+
+
+def _parse_tokens(points: pd.Series) -> ParsedPoints | None:
+    """Parses all the points at once tokenizing them as a single string. Returns None
+    if any point isn't exactly 'POINT ( x y )', as rows cannot be told apart then"""
+    values = points.tolist()
+    if not all(isinstance(value, str) for value in values):
+        return None
+
+    text = f" {_SEPARATOR} ".join(values) + f" {_SEPARATOR}"
+    # Underscores are accepted by float() but not by the WKT grammar
+    if "_" in text or text.count(_SEPARATOR) != len(values):
+        return None
+
+    tokens = text.replace("(", " ( ").replace(")", " ) ").split()
+
+    # Separators only appear between rows, so when every sixth token is one each row holds
+    # exactly five tokens, which must be POINT ( x y )
+    count = len(values)
+    if (
+        len(tokens) != 6 * count
+        or tokens[5::6].count(_SEPARATOR) != count
+        or tokens[0::6].count("POINT") != count
+        or tokens[1::6].count("(") != count
+        or tokens[4::6].count(")") != count
+    ):
+        return None
+
+    try:
+        coords = np.array(tokens[2::6] + tokens[3::6], dtype=np.float64)
+    except ValueError:
+        return None
+
+    x, y = coords[:count], coords[count:]
+    return ParsedPoints(x, y, ~(np.isfinite(x) & np.isfinite(y)))
+
+
+def _parse_regex(points: pd.Series) -> ParsedPoints:
+    coords = points.astype(object).str.extract(_POINT_PATTERN, expand=True)  # type: ignore
+    x = coords[0].astype(np.float64).to_numpy()
+    y = coords[1].astype(np.float64).to_numpy()
+    return ParsedPoints(x, y, ~(np.isfinite(x) & np.isfinite(y)))
+
+
+def parse_points(points: pd.Series) -> ParsedPoints:
+    """Parses a column of WKT 'POINT (x y)' strings into float64 x and y arrays.
+    Rows that aren't a valid point are flagged in `malformed` and have NaN coordinates"""
+    if points.empty:
+        empty = np.empty(0, dtype=np.float64)
+        return ParsedPoints(empty, empty, np.empty(0, dtype=np.bool_))
+
+    # Well formed files take the fast path, a single regex pass flags the bad rows otherwise
+    parsed = _parse_tokens(points)
+    if parsed is None:
+        parsed = _parse_regex(points)
+
+    return parsed
@@ -0,0 +1,342 @@
+""" Módulo que define un motor columnar en memoria para las estadísticas de viajes """
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any
+
+import asyncpg
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+from optimized_shifts.celery.connection import Connection
+from optimized_shifts.celery.snapshot import (
+    CELL_BITS,
+    COLUMNS,
+    after_snapshot,
+    cell_keys,
+    cells,
+    copy_trips,
+    current_snapshot,
+    open_snapshot,
+)
+
+logger = logging.getLogger(__name__)
+
+Point = tuple[float, float]
+
+# Sobre esta cantidad de filas de celdas se filtra la región completa en vez de cada fila
+MAX_CELL_ROWS = 256
+
+
+def _week(epoch: npt.NDArray[np.int64]) -> npt.NDArray[np.int64]:
+    # El 1970-01-01 fue jueves, la semana 0 comienza el lunes 1969-12-29
+    return (epoch // 86_400 + 3) // 7
+
+
+def _epoch(value: datetime) -> int:
+    return int(value.replace(tzinfo=timezone.utc).timestamp())
+
+
+@dataclass(frozen=True)
+class _Segment:
+    """ Columnas de un conjunto de viajes de una región, todas del mismo largo """
+    trip_id: npt.NDArray[np.int64]
+    ox: npt.NDArray[np.float64]
+    oy: npt.NDArray[np.float64]
+    dx: npt.NDArray[np.float64]
+    dy: npt.NDArray[np.float64]
+    epoch: npt.NDArray[np.int64]
+
+    @classmethod
+    def from_columns(cls, columns: dict[str, npt.NDArray[Any]]) -> "_Segment":
+        return cls(**{name: columns[name] for name in COLUMNS})
+
+    @classmethod
+    def concat(cls, segments: "list[_Segment]") -> "_Segment":
+        return cls(
+            **{name: np.concatenate([getattr(s, name) for s in segments]) for name in COLUMNS}
+        )
+
+    def __len__(self) -> int:
+        return len(self.trip_id)
+
+    def take(self, index: npt.NDArray[np.intp]) -> "_Segment":
+        return _Segment(**{name: getattr(self, name)[index] for name in COLUMNS})
+
+
+@dataclass(frozen=True)
+class _Partition:
+    """ Viajes de una región ordenados por celda de origen y época, `cells` es la llave de ese orden """
+    segment: _Segment
+    cells: npt.NDArray[np.int64]
+
+
+@dataclass(frozen=True)
+class _Snapshot:
+    """
+    Estado inmutable del motor: `main` tiene los viajes ordenados de cada región, que pueden estar
+    mapeados desde un snapshot en disco. `delta` guarda sin ordenar, también por región, los viajes
+    leídos desde la última mezcla. `pg_snapshot` es el de la última lectura, None si no hubo ninguna
+    """
+    main: dict[int, _Partition]
+    delta: dict[int, _Segment]
+    pg_snapshot: str | None
+
+    def delta_rows(self) -> int:
+        return sum(len(segment) for segment in self.delta.values())
+
+
+class TripsColumnStore:
+    """
+    Mantiene los viajes en memoria como arreglos de NumPy para calcular el promedio semanal de un
+    bbox sin consultar la base de datos. Los viajes de cada región se ordenan por la celda de su
+    origen en una grilla uniforme de `grid_size` y por fecha, así un bbox solo lee las celdas que toca.
+
+    Los viajes se cargan desde el último snapshot de `snapshot_dir` si existe, o desde la base de
+    datos. Las columnas de un snapshot se mapean en memoria sin copiarlas, así todos los procesos que
+    lo cargan comparten las mismas páginas y el inicio no depende de la cantidad de viajes.
+
+    Cada `refresh_interval` segundos se leen los viajes confirmados después de la lectura anterior,
+    según la transacción que los insertó y no su id, ya que una transacción que tomó ids antes que
+    otra puede confirmarse después. Se filtran completos hasta que superan `delta_rows`, momento en
+    que se mezclan con los ordenados de su región. Cada `reload_interval` segundos se recarga todo,
+    lo que descarta los viajes eliminados directamente en la base de datos
+    """
+    def __init__(
+        self,
+        grid_size: float = 0.1,
+        delta_rows: int = 100_000,
+        load_batch: int = 1_000_000,
+        refresh_interval: float = 5,
+        reload_interval: float = 3600,
+        snapshot_dir: str | None = None,
+    ):
+        self.grid_size = grid_size
+        self.delta_rows = delta_rows
+        self.load_batch = load_batch
+        self.refresh_interval = refresh_interval
+        self.reload_interval = reload_interval
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_path: str | None = None
+        self.loaded_at: float | None = None
+        self._snapshot = _Snapshot({}, {}, None)
+        self._lock = asyncio.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.loaded_at is not None
+
+    def __len__(self) -> int:
+        snapshot = self._snapshot
+        return sum(len(p.segment) for p in snapshot.main.values()) + snapshot.delta_rows()
+
+    def _partitions(self, segments: dict[int, _Segment]) -> dict[int, _Partition]:
+        partitions: dict[int, _Partition] = {}
+        for region_id, segment in segments.items():
+            keys = cell_keys(segment.ox, segment.oy, self.grid_size)
+            order = np.lexsort((segment.epoch, keys))
+            partitions[region_id] = _Partition(segment.take(order), keys[order])
+
+        return partitions
+
+    async def _fetch(self, conn: Connection, where: str) -> dict[int, _Segment]:
+        """ Lee los viajes que cumplen `where` en lotes de `load_batch`, agrupados por región """
+        frames: list[pd.DataFrame] = []
+        after = 0
+        while True:
+            frame = await copy_trips(conn, f"trip_id > {after} AND {where}", self.load_batch)
+            if frame is None:
+                break
+
+            frames.append(frame)
+            after = int(frame["trip_id"].iloc[-1])
+            if len(frame) < self.load_batch:
+                break
+
+        if not frames:
+            return {}
+
+        trips = pd.concat(frames, ignore_index=True)
+        return {
+            int(region_id): _Segment.from_columns({name: group[name].to_numpy() for name in COLUMNS})
+            for region_id, group in trips.groupby("region", sort=False)
+        }
+
+    async def _read(
+        self, db: "asyncpg.Pool[asyncpg.Record]", since: str | None
+    ) -> tuple[dict[int, _Segment], str]:
+        """ Lee los viajes que no eran visibles en el pg_snapshot `since`, o todos si es None, junto
+        con el pg_snapshot de esta lectura. Ambos se obtienen en la misma transacción """
+        async with db.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                pg_snapshot: str = await conn.fetchval("SELECT pg_current_snapshot()::TEXT")
+                segments = await self._fetch(conn, after_snapshot(since) if since else "TRUE")
+
+        return segments, pg_snapshot
+
+    async def load(self, db: "asyncpg.Pool[asyncpg.Record]"):
+        """ Carga todos los viajes, desde el último snapshot si existe, reemplazando lo que había en memoria """
+        path = current_snapshot(self.snapshot_dir) if self.snapshot_dir else None
+        if path is not None:
+            try:
+                await self.load_snapshot(path, db)
+                return
+            except ValueError:
+                logger.warning("Unable to load %s, loading the trips from the database", path, exc_info=True)
+
+        async with self._lock:
+            start = time.perf_counter()
+            segments, pg_snapshot = await self._read(db, None)
+            main = await asyncio.to_thread(self._partitions, segments)
+            self._snapshot = _Snapshot(main, {}, pg_snapshot)
+            # Un snapshot que no se pudo cargar no se vuelve a intentar hasta que aparezca otro
+            self.snapshot_path = path
+            self.loaded_at = time.monotonic()
+            logger.info("Loaded %d trips in %.2fs", len(self), time.perf_counter() - start)
+
+    async def load_snapshot(self, path: str, db: "asyncpg.Pool[asyncpg.Record]"):
+        """ Mapea en memoria el snapshot de `path` y lee desde la base de datos los viajes posteriores """
+        async with self._lock:
+            start = time.perf_counter()
+            manifest, regions = open_snapshot(path)
+            if "pg_snapshot" not in manifest:
+                raise ValueError(f"{path} does not record its pg_snapshot")
+
+            self.grid_size = manifest["grid_size"]
+            main = {
+                region_id: _Partition(_Segment.from_columns(columns), columns["cells"])
+                for region_id, columns in regions.items()
+            }
+            self._snapshot = _Snapshot(main, {}, manifest["pg_snapshot"])
+            self.snapshot_path = path
+            self.loaded_at = time.monotonic()
+
+        await self.refresh(db)
+        logger.info("Loaded %s with %d trips in %.2fs", path, len(self), time.perf_counter() - start)
+
+    async def refresh(self, db: "asyncpg.Pool[asyncpg.Record]"):
+        """ Agrega los viajes confirmados desde la última lectura """
+        async with self._lock:
+            snapshot = self._snapshot
+            segments, pg_snapshot = await self._read(db, snapshot.pg_snapshot)
+
+            delta = dict(snapshot.delta)
+            for region_id, segment in segments.items():
+                delta[region_id] = (
+                    _Segment.concat([delta[region_id], segment]) if region_id in delta else segment
+                )
+
+            snapshot = _Snapshot(snapshot.main, delta, pg_snapshot)
+            if snapshot.delta_rows() > self.delta_rows:
+                # Solo se copian las regiones con viajes nuevos, el resto sigue mapeado desde el snapshot
+                merged = await asyncio.to_thread(
+                    self._partitions,
+                    {
+                        region_id: _Segment.concat([snapshot.main[region_id].segment, segment])
+                        if region_id in snapshot.main
+                        else segment
+                        for region_id, segment in delta.items()
+                    },
+                )
+                snapshot = _Snapshot({**snapshot.main, **merged}, {}, pg_snapshot)
+
+            self._snapshot = snapshot
+
+    async def reload(self, db: "asyncpg.Pool[asyncpg.Record]"):
+        """ Recarga todo, salvo que el último snapshot sea el que ya está cargado """
+        path = current_snapshot(self.snapshot_dir) if self.snapshot_dir else None
+        if path is not None and path == self.snapshot_path:
+            self.loaded_at = time.monotonic()
+            await self.refresh(db)
+            return
+
+        await self.load(db)
+
+    async def run(self, db: "asyncpg.Pool[asyncpg.Record]"):
+        """ Refresca el motor periódicamente hasta ser cancelado. Recarga todo cada `reload_interval`,
+        o apenas aparece un snapshot nuevo """
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                path = current_snapshot(self.snapshot_dir) if self.snapshot_dir else None
+                expired = self.loaded_at is None or time.monotonic() - self.loaded_at >= self.reload_interval
+                if expired or (path is not None and path != self.snapshot_path):
+                    await self.reload(db)
+                else:
+                    await self.refresh(db)
+            except (OSError, ValueError, asyncpg.PostgresError):
+                logger.exception("Unable to refresh the trips column store")
+
+    def _candidates(self, partition: _Partition, px: float, py: float, qx: float, qy: float) -> _Segment:
+        """ Viajes de la región en las celdas de origen que toca el bbox """
+        cell_x = cells(np.array([px, qx]), self.grid_size)
+        cell_y = cells(np.array([py, qy]), self.grid_size)
+        rows = np.arange(cell_y[0], cell_y[1] + 1, dtype=np.int64)
+
+        if len(rows) > MAX_CELL_ROWS:
+            return partition.segment
+
+        # Cada fila de celdas es un rango contiguo de la partición
+        lo = np.searchsorted(partition.cells, (rows << CELL_BITS) | cell_x[0])
+        hi = np.searchsorted(partition.cells, (rows << CELL_BITS) | cell_x[1], side="right")
+        index = [np.arange(l, h) for l, h in zip(lo, hi) if h > l]
+
+        return partition.segment.take(np.concatenate(index) if index else np.empty(0, np.intp))
+
+    def _weeks(
+        self,
+        segment: _Segment,
+        px: float,
+        py: float,
+        qx: float,
+        qy: float,
+        since: int | None,
+        until: int | None,
+    ) -> npt.NDArray[np.int64]:
+        """ Semanas de los viajes del segmento con origen y destino en el bbox """
+        mask = (
+            (segment.ox >= px) & (segment.ox <= qx) & (segment.oy >= py) & (segment.oy <= qy)
+            & (segment.dx >= px) & (segment.dx <= qx) & (segment.dy >= py) & (segment.dy <= qy)
+        )
+
+        weeks = _week(segment.epoch[mask])
+        if since is not None:
+            weeks = weeks[weeks >= since]
+        if until is not None:
+            weeks = weeks[weeks <= until]
+
+        return weeks
+
+    def weekly_average(
+        self,
+        bbox: tuple[Point, Point],
+        region_id: int,
+        since: datetime | None = None,
+        until: datetime | None = None,
+    ) -> float | None:
+        """ Promedio semanal de viajes en el bbox, con la misma semántica que WEEKLY_AVERAGE_ROLLUP_STMT:
+        solo se promedian las semanas con viajes, desde la que contiene `since` hasta la de `until` """
+        snapshot = self._snapshot
+        p, q = bbox
+        px, qx = sorted((p[0], q[0]))
+        py, qy = sorted((p[1], q[1]))
+        since_week = int(_week(np.array(_epoch(since)))) if since else None
+        until_week = int(_week(np.array(_epoch(until)))) if until else None
+
+        weeks = [np.empty(0, dtype=np.int64)]
+        if region_id in snapshot.main:
+            candidates = self._candidates(snapshot.main[region_id], px, py, qx, qy)
+            weeks.append(self._weeks(candidates, px, py, qx, qy, since_week, until_week))
+        if region_id in snapshot.delta:
+            weeks.append(self._weeks(snapshot.delta[region_id], px, py, qx, qy, since_week, until_week))
+
+        selected = np.concatenate(weeks)
+        if not len(selected):
+            return None
+
+        counts = np.bincount(selected - selected.min())
+        return float(counts[counts > 0].mean())
@@ -0,0 +1,70 @@
+from optimized_shifts.celery.shards import ShardRouter
+from optimized_shifts.schemas.group import TripGroupInDB
+from optimized_shifts.schemas.trip import TripInDB
+from optimized_shifts.state import Database
+
+GROUP_COLUMNS = """
+    group_id,
+    region_id,
+    distance,
+    time_window,
+    point((origin_cell_x + 0.5) * distance, (origin_cell_y + 0.5) * distance) AS origin,
+    point((destination_cell_x + 0.5) * distance, (destination_cell_y + 0.5) * distance) AS destination,
+    TIME '00:00' + time_bucket * time_window * INTERVAL '1 minute' AS time_from,
+    TIME '00:00' + (time_bucket + 1) * time_window * INTERVAL '1 minute' AS time_to,
+    size
+"""
+
+
+class GroupsRepository:
+    @staticmethod
+    async def get_by_region(
+        region_id: int,
+        db: Database,
+        limit: int = 100,
+        offset: int = 0,
+        shards: ShardRouter | None = None,
+    ) -> list[TripGroupInDB]:
+        """Groups of a region, largest first. With `shards` they are read from the shard of the region"""
+        stmt = f"""
+            SELECT {GROUP_COLUMNS}
+            FROM trip_groups
+            WHERE region_id = $1
+            ORDER BY size DESC, group_id
+            LIMIT $2 OFFSET $3
+        """
+        if shards is not None:
+            db = await shards.pool(region_id)
+
+        async with db.acquire() as conn:
+            rows = await conn.fetch(stmt, region_id, limit, offset)
+
+        return [TripGroupInDB(**row) for row in rows]
+
+    @staticmethod
+    async def get_by_id(group_id: int, db: Database) -> TripGroupInDB | None:
+        stmt = f"""SELECT {GROUP_COLUMNS} FROM trip_groups WHERE group_id = $1"""
+        async with db.acquire() as conn:
+            row = await conn.fetchrow(stmt, group_id)
+
+        if not row:
+            return None
+
+        return TripGroupInDB(**row)
+
+    @staticmethod
+    async def get_trips(
+        group_id: int, db: Database, limit: int = 100, offset: int = 0
+    ) -> list[TripInDB]:
+        """Trips that belong to a group, oldest first"""
+        stmt = """
+            SELECT trip_id, region_id, origin, destination, timestamp, source, group_id
+            FROM trips
+            WHERE group_id = $1
+            ORDER BY timestamp, trip_id
+            LIMIT $2 OFFSET $3
+        """
+        async with db.acquire() as conn:
+            rows = await conn.fetch(stmt, group_id, limit, offset)
+
+        return [TripInDB(**row) for row in rows]
@@ -1,3 +1,5 @@
+from optimized_shifts.celery.regions import fetch_or_create_regions, fetch_regions, region_cache
+from optimized_shifts.celery.shards import ShardRouter
 from optimized_shifts.schemas.region import RegionInDB
 from optimized_shifts.state import Database
 
@@ -12,28 +14,6 @@ class RegionRepository:
 
         return RegionInDB(**row) if row else None
 
-    @staticmethod
-    async def create_multiple(names: list[str], db: Database) -> list[RegionInDB]:
-        """Insert multiple regions into database, returns RegionInDB list if success, or None instead"""
-        stmt = """
-            INSERT INTO regions (region_name) (
-                SELECT r.region_name 
-                FROM unnest($1::regions[]) as r
-            ) 
-            RETURNING region_id, region_name
-        """
-        async with db.acquire() as conn:
-            rows = await conn.fetch(stmt, [(None, name) for name in names])
-
-        return list(
-            map(
-                lambda row: RegionInDB(
-                    **row,
-                ),
-                rows,
-            )
-        )
-
     @staticmethod
     async def get_by_id(region_id: str, db: Database) -> RegionInDB | None:
         stmt = """SELECT region_id, region_name FROM regions WHERE region_id=$1"""
@@ -57,11 +37,39 @@ class RegionRepository:
         return RegionInDB(**row)
 
     @staticmethod
-    async def get_by_name_multiple(names: set[str], db: Database) -> list[RegionInDB]:
-        prepared = ", ".join(f"${i+1}" for i in range(len(names)))
-        stmt = f"""SELECT region_id, region_name FROM regions WHERE region_name in ({prepared})"""
+    async def get_id_by_name(region_name: str, db: Database) -> int | None:
+        """Returns the id of a region using the in-process cache, or None if it doesn't exists"""
+        region_id = region_cache.get(region_name)
+        if region_id is not None:
+            return region_id
+
+        async with db.acquire() as conn:
+            regions = await fetch_regions(conn, {region_name})
+
+        return regions.get(region_name)
+
+    @staticmethod
+    async def get_ids_by_name(names: set[str], db: Database) -> dict[str, int]:
+        """Returns the ids of the existing regions using the in-process cache"""
+        regions, missing = region_cache.get_many(names)
+        if not missing:
+            return regions
 
         async with db.acquire() as conn:
-            rows = await conn.fetch(stmt, *names)
+            return regions | await fetch_regions(conn, missing)
+
+    @staticmethod
+    async def get_or_create_multiple(
+        names: set[str], db: Database, shards: ShardRouter | None = None
+    ) -> dict[str, int]:
+        """Returns the ids of the regions, creating the ones that doesn't exists. With `shards`
+        new regions are also assigned to a shard and copied into it"""
+        regions, missing = region_cache.get_many(names)
+        if missing:
+            async with db.acquire() as conn:
+                regions |= await fetch_or_create_regions(conn, missing)
+
+        if shards is not None:
+            await shards.shards_of(regions.values())
 
-        return list(map(lambda row: RegionInDB(**row), rows))
+        return regions
@@ -1,78 +1,539 @@
-from optimized_shifts.schemas.trip import TripCreate, TripInDB
+import asyncio
+import math
+from collections import Counter
+from datetime import datetime
+from typing import Any, AsyncIterator, Literal
+
+from optimized_shifts.celery.config import celeryconfig
+from optimized_shifts.celery.shards import ShardRouter
+from optimized_shifts.columnar import TripsColumnStore
+from optimized_shifts.schemas.trip import (
+    TripCreate,
+    TripInDB,
+    TripsStatsBucket,
+    TripsWeeklyAverage,
+    TripsWeeklyEstimate,
+)
 from optimized_shifts.state import Database
 
 Point = tuple[float, float]
 
+# Las celdas completamente contenidas en el bbox se leen desde trips_weekly_cells, solo los
+# viajes con origen o destino en las celdas del borde se cuentan desde trips. Las franjas
+# del borde tienen media celda de holgura para que el índice GiST las cubra por completo,
+# trips_grid_interior descarta lo que ya fue contado en el rollup. Los filtros de fecha se
+# agregan solo cuando se piden, así el planificador descarta las particiones fuera del rango
+WEEKLY_AVERAGE_ROLLUP_STMT = """
+    WITH rollup AS (
+        SELECT week, SUM(count) AS count
+        FROM trips_weekly_cells
+        WHERE region_id = {region_id} AND
+            origin_cell_x BETWEEN trips_grid_cell({px}) + 1 AND trips_grid_cell({qx}) - 1 AND
+            origin_cell_y BETWEEN trips_grid_cell({py}) + 1 AND trips_grid_cell({qy}) - 1 AND
+            destination_cell_x BETWEEN trips_grid_cell({px}) + 1 AND trips_grid_cell({qx}) - 1 AND
+            destination_cell_y BETWEEN trips_grid_cell({py}) + 1 AND trips_grid_cell({qy}) - 1
+            {rollup_period}
+        GROUP BY week
+    ),
+    raw AS (
+        SELECT DATE_TRUNC('week', timestamp) AS week, COUNT(*) AS count
+        FROM trips
+        WHERE region_id = {region_id} AND
+            origin <@ box(point({px}, {py}), point({qx}, {qy})) AND
+            destination <@ box(point({px}, {py}), point({qx}, {qy})) AND
+            (
+                origin <@ box(point({px}, {py}), point(trips_grid_snap({px}, 1.5), {qy})) OR
+                origin <@ box(point(trips_grid_snap({qx}, -0.5), {py}), point({qx}, {qy})) OR
+                origin <@ box(point({px}, {py}), point({qx}, trips_grid_snap({py}, 1.5))) OR
+                origin <@ box(point({px}, trips_grid_snap({qy}, -0.5)), point({qx}, {qy})) OR
+                destination <@ box(point({px}, {py}), point(trips_grid_snap({px}, 1.5), {qy})) OR
+                destination <@ box(point(trips_grid_snap({qx}, -0.5), {py}), point({qx}, {qy})) OR
+                destination <@ box(point({px}, {py}), point({qx}, trips_grid_snap({py}, 1.5))) OR
+                destination <@ box(point({px}, trips_grid_snap({qy}, -0.5)), point({qx}, {qy}))
+            ) AND
+            NOT (
+                trips_grid_interior(origin, {px}, {py}, {qx}, {qy}) AND
+                trips_grid_interior(destination, {px}, {py}, {qx}, {qy})
+            )
+            {raw_period}
+        GROUP BY week
+    )
+    SELECT
+        AVG(count) AS result,
+        EXISTS(SELECT 1 FROM rollup) AS from_rollup,
+        EXISTS(SELECT 1 FROM raw) AS from_raw
+    FROM (
+        SELECT week, SUM(count) AS count
+        FROM (SELECT * FROM rollup UNION ALL SELECT * FROM raw) AS weekly
+        GROUP BY week
+        -- conteo semanal de viajes
+    ) AS weekly_count
+"""
+
+# Columnas del bbox y la región en WEEKLY_AVERAGE_ROLLUP_STMT, para una consulta son los primeros
+# parámetros y para un lote las columnas de cada fila de WEEKLY_AVERAGE_BATCH_STMT
+SINGLE_BBOX_COLUMNS = {"px": "$1", "py": "$2", "qx": "$3", "qy": "$4", "region_id": "$5"}
+BATCH_BBOX_COLUMNS = {"px": "q.px", "py": "q.py", "qx": "q.qx", "qy": "q.qy", "region_id": "q.region_id"}
+
+# Calcula el promedio de cada bbox de un lote en una sola sentencia, en el orden recibido
+WEEKLY_AVERAGE_BATCH_STMT = """
+    SELECT average.*
+    FROM unnest($1::float8[], $2::float8[], $3::float8[], $4::float8[], $5::int[])
+        WITH ORDINALITY AS q(px, py, qx, qy, region_id, n)
+    CROSS JOIN LATERAL ({weekly_average}) AS average
+    ORDER BY q.n
+"""
+
+# Conteos por semana, por hora del día y por día de la semana (1 = lunes) del bbox, calculados en
+# una sola lectura de los viajes con GROUPING SETS. trips_weekly_cells no guarda la hora, por lo que
+# se leen siempre los viajes; cada fila trae solo la columna de su agrupación, las demás son NULL
+STATS_SERIES_STMT = """
+    SELECT week, hour, weekday, COUNT(*) AS count
+    FROM (
+        SELECT
+            DATE_TRUNC('week', timestamp) AS week,
+            EXTRACT(hour FROM timestamp)::INT AS hour,
+            EXTRACT(isodow FROM timestamp)::INT AS weekday
+        FROM trips
+        WHERE origin <@ box(point($1, $2), point($3, $4)) AND
+            destination <@ box(point($1, $2), point($3, $4)) AND
+            region_id = $5
+            {raw_period}
+    ) AS filtered
+    GROUP BY GROUPING SETS ((week), (hour), (weekday))
+    -- primero las semanas, luego las horas y al final los días
+    ORDER BY week NULLS LAST, hour NULLS LAST, weekday
+"""
+
+# Filas que el cursor de STATS_SERIES_STMT trae desde la base de datos en cada viaje
+STATS_SERIES_PREFETCH = 500
+
+# Viajes del bbox en los niveles de trips_sample desde $6, que forman una muestra de Bernoulli
+# con tasa 16^-$6. Los niveles más altos son particiones más pequeñas
+SAMPLE_COUNT_STMT = """
+    SELECT COUNT(*) AS sampled, COUNT(DISTINCT DATE_TRUNC('week', timestamp)) AS sampled_weeks
+    FROM trips_sample
+    WHERE origin <@ box(point($1, $2), point($3, $4)) AND
+        destination <@ box(point($1, $2), point($3, $4)) AND
+        region_id = $5 AND
+        level >= $6
+        {raw_period}
+"""
+
+# Fracción del lado de la celda `{cell}` que queda entre ${lo} y ${hi}
+CELL_FRACTION = (
+    "GREATEST(LEAST(({cell} + 1) * trips_grid_size(), ${hi}) - "
+    "GREATEST({cell} * trips_grid_size(), ${lo}), 0) / trips_grid_size()"
+)
+
+# Fracción de los viajes de cada fila de trips_weekly_cells que cae en el bbox, suponiendo que
+# los orígenes y destinos se reparten uniformemente dentro de sus celdas: 1 en las celdas
+# interiores y la fracción del área cubierta por el bbox en las de los bordes
+SAMPLE_CELL_FRACTION = " * ".join(
+    CELL_FRACTION.format(cell=cell, lo=lo, hi=hi)
+    for cell, lo, hi in (
+        ("origin_cell_x", 1, 3),
+        ("origin_cell_y", 2, 4),
+        ("destination_cell_x", 1, 3),
+        ("destination_cell_y", 2, 4),
+    )
+)
+
+# Semanas con viajes del bbox estimadas desde trips_weekly_cells, sin leer viajes. Con `expected`
+# viajes esperados en el bbox, una semana tiene alguno con probabilidad 1 - e^-expected (Poisson);
+# las semanas con viajes en celdas interiores cuentan como una
+SAMPLE_WEEKS_STMT = """
+    SELECT COALESCE(SUM(1 - EXP(-LEAST(expected, 50))), 0) AS weeks
+    FROM (
+        SELECT week, SUM(count * {cell_fraction}) AS expected
+        FROM trips_weekly_cells
+        WHERE region_id = $5 AND
+            origin_cell_x BETWEEN trips_grid_cell($1) AND trips_grid_cell($3) AND
+            origin_cell_y BETWEEN trips_grid_cell($2) AND trips_grid_cell($4) AND
+            destination_cell_x BETWEEN trips_grid_cell($1) AND trips_grid_cell($3) AND
+            destination_cell_y BETWEEN trips_grid_cell($2) AND trips_grid_cell($4)
+            {rollup_period}
+        GROUP BY week
+    ) AS weekly_cells
+"""
+
+# Niveles de trips_sample, del más pequeño al más grande, con la tasa de muestreo de cada uno
+SAMPLE_LEVELS = ((3, 16**-3), (2, 16**-2), (1, 16**-1))
+
+# Cuantil normal del intervalo de confianza del 95%
+SAMPLE_Z = 1.96
+
+# Rango de semanas opcional de WEEKLY_AVERAGE_ROLLUP_STMT, `{}` es el número del parámetro
+ROLLUP_SINCE = "AND week >= DATE_TRUNC('week', ${}::timestamp)"
+ROLLUP_UNTIL = "AND week <= DATE_TRUNC('week', ${}::timestamp)"
+RAW_SINCE = "AND timestamp >= DATE_TRUNC('week', ${}::timestamp)"
+RAW_UNTIL = "AND timestamp < DATE_TRUNC('week', ${}::timestamp) + INTERVAL '1 week'"
+
+# Agrega los conteos de los viajes insertados a trips_weekly_cells y su muestra a trips_sample
+# en la misma sentencia
+CREATE_MULTIPLE_STMT = """
+    WITH inserted AS (
+        INSERT INTO trips (region_id, origin, destination, timestamp, source, group_id) (
+            SELECT r.region_id, r.origin, r.destination, r.timestamp, r.source, r.group_id
+            FROM unnest($1::trips[]) as r
+        )
+        RETURNING trip_id, region_id, origin, destination, timestamp, source, group_id
+    ),
+    cells AS (
+        INSERT INTO trips_weekly_cells (
+            SELECT
+                region_id,
+                DATE_TRUNC('week', timestamp),
+                trips_grid_cell(origin[0]),
+                trips_grid_cell(origin[1]),
+                trips_grid_cell(destination[0]),
+                trips_grid_cell(destination[1]),
+                COUNT(*)
+            FROM inserted
+            GROUP BY 1, 2, 3, 4, 5, 6
+        )
+    ),
+    sampled AS (
+        INSERT INTO trips_sample (
+            SELECT region_id, origin, destination, timestamp, level
+            FROM (
+                SELECT region_id, origin, destination, timestamp, trips_sample_level(random()) AS level
+                FROM inserted
+            ) AS candidates
+            WHERE level IS NOT NULL
+        )
+    )
+    SELECT * FROM inserted
+"""
+
+
+def _sorted_bbox(bbox: tuple[Point, Point]) -> tuple[float, float, float, float]:
+    p, q = bbox
+
+    px, qx = sorted((p[0], q[0]))
+    py, qy = sorted((p[1], q[1]))
+
+    return px, py, qx, qy
+
+
+def _weekly_average_stmt(
+    columns: dict[str, str],
+    args: list[Any],
+    since: datetime | None,
+    until: datetime | None,
+) -> str:
+    """ Arma WEEKLY_AVERAGE_ROLLUP_STMT con las columnas del bbox, agregando a `args` las fechas pedidas """
+    rollup_period: list[str] = []
+    raw_period: list[str] = []
+    for value, rollup, raw in ((since, ROLLUP_SINCE, RAW_SINCE), (until, ROLLUP_UNTIL, RAW_UNTIL)):
+        if value is None:
+            continue
+
+        args.append(value)
+        rollup_period.append(rollup.format(len(args)))
+        raw_period.append(raw.format(len(args)))
+
+    return WEEKLY_AVERAGE_ROLLUP_STMT.format(
+        **columns, rollup_period=" ".join(rollup_period), raw_period=" ".join(raw_period)
+    )
+
+
+def _raw_period(
+    args: list[Any],
+    since: datetime | None,
+    until: datetime | None,
+    filters: tuple[str, str] = (RAW_SINCE, RAW_UNTIL),
+) -> str:
+    """ Filtro de fechas sobre `timestamp` (o `week` con ROLLUP_SINCE y ROLLUP_UNTIL), agregando a
+    `args` las fechas pedidas """
+    raw_period: list[str] = []
+    for value, raw in zip((since, until), filters):
+        if value is not None:
+            args.append(value)
+            raw_period.append(raw.format(len(args)))
+
+    return " ".join(raw_period)
+
+
+async def _region_db(db: Database, shards: ShardRouter | None, region_id: int) -> Database:
+    """ Base de datos con los viajes de la región, `db` si no hay shards """
+    return db if shards is None else await shards.pool(region_id)
+
+
+def _weekly_average(row: Any) -> TripsWeeklyAverage:
+    source: Literal["raw", "rollup", "mixed"]
+    if row["from_rollup"] and row["from_raw"]:
+        source = "mixed"
+    elif row["from_rollup"]:
+        source = "rollup"
+    else:
+        source = "raw"
+
+    return TripsWeeklyAverage(mean=row["result"], source=source)
+
 
 class TripsRepository:
     @staticmethod
     async def get_count_weekly_average_by_bbox_and_region(
-        bbox: tuple[Point, Point], region_id: int, db: Database
-    ) -> float | None:
-        p, q = bbox
+        bbox: tuple[Point, Point],
+        region_id: int,
+        db: Database,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        store: TripsColumnStore | None = None,
+        shards: ShardRouter | None = None,
+    ) -> TripsWeeklyAverage:
+        """ Promedio semanal de viajes en el bbox, `since` y `until` limitan el cálculo a las
+        semanas que los contienen (ambas incluidas). Con `store` cargado se calcula en memoria,
+        con `shards` se consulta el shard de la región """
+        if store is not None and store.ready:
+            return TripsWeeklyAverage(
+                mean=store.weekly_average(bbox, region_id, since, until), source="columnar"
+            )
+
+        db = await _region_db(db, shards, region_id)
+        px, py, qx, qy = _sorted_bbox(bbox)
 
-        px, py = p
-        qx, qy = q
+        args: list[float | int | datetime] = [px, py, qx, qy, region_id]
+        stmt = _weekly_average_stmt(SINGLE_BBOX_COLUMNS, args, since, until)
 
         async with db.acquire() as conn:
-            mean_row = await conn.fetchrow(
-                """
-                SELECT AVG(count) AS result
-                FROM (
-                    SELECT COUNT(*)
-                    FROM (
-                        SELECT * 
-                        FROM trips 
-                        WHERE origin[0] >= $1 AND origin[0] <= $3 AND -- px, qx
-                            destination[0] >= $1 AND destination[0] <= $3 AND -- px, qx
-                            origin[1] >= $2 AND origin[1] <= $4 AND -- py, qy
-                            destination[1] >= $2 AND destination[1] <= $4 AND -- py, qy
-                            region_id = $5
-                        -- Tabla filtrada por bbox y region
-                    ) AS filtered 
-                    GROUP BY DATE_TRUNC('week', timestamp) 
-                    -- conteo semanal de viajes
-                ) AS weekly_count 
-            """,
-                *(
-                    px,
-                    py,
-                    qx,
-                    qy,
-                    region_id,
-                ),
+            mean_row = await conn.fetchrow(stmt, *args)
+
+        if not mean_row:
+            return TripsWeeklyAverage(mean=None, source="raw")
+
+        return _weekly_average(mean_row)
+
+    @staticmethod
+    async def get_count_weekly_average_by_bboxes(
+        queries: list[tuple[tuple[Point, Point], int]],
+        db: Database,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        store: TripsColumnStore | None = None,
+        shards: ShardRouter | None = None,
+    ) -> list[TripsWeeklyAverage]:
+        """ Promedio semanal de viajes de cada par (bbox, región), calculados en una sola sentencia
+        por shard y retornados en el mismo orden. Con `store` cargado se calculan en memoria """
+        if not queries:
+            return []
+
+        if store is not None and store.ready:
+            return [
+                TripsWeeklyAverage(
+                    mean=store.weekly_average(bbox, region_id, since, until), source="columnar"
+                )
+                for bbox, region_id in queries
+            ]
+
+        if shards is None or not shards.sharded:
+            return await TripsRepository._weekly_averages(queries, db, since, until)
+
+        # Las consultas de cada shard se calculan en paralelo y se reordenan según su posición
+        region_shards = await shards.shards_of(region_id for _, region_id in queries)
+        positions: dict[int, list[int]] = {}
+        for i, (_, region_id) in enumerate(queries):
+            positions.setdefault(region_shards[region_id], []).append(i)
+
+        shard_results = await asyncio.gather(
+            *(
+                TripsRepository._weekly_averages(
+                    [queries[i] for i in indexes], shards.pools[shard], since, until
+                )
+                for shard, indexes in positions.items()
             )
+        )
+
+        results: list[TripsWeeklyAverage] = [None] * len(queries)  # type: ignore
+        for indexes, averages in zip(positions.values(), shard_results):
+            for i, average in zip(indexes, averages):
+                results[i] = average
 
-        return mean_row.get("result") if mean_row else None
+        return results
 
     @staticmethod
-    async def create(trip: TripCreate, db: Database) -> TripInDB | None:
-        stmt = """
-            INSERT INTO trips (region_id, origin, destination, timestamp, source)
-            VALUES ($1, $2, $3, $4, $5)
-            )        
-        """
+    async def _weekly_averages(
+        queries: list[tuple[tuple[Point, Point], int]],
+        db: Database,
+        since: datetime | None,
+        until: datetime | None,
+    ) -> list[TripsWeeklyAverage]:
+        bboxes = [_sorted_bbox(bbox) for bbox, _ in queries]
+        args: list[list[float] | list[int] | datetime] = [
+            *(list(column) for column in zip(*bboxes)),
+            [region_id for _, region_id in queries],
+        ]
+        weekly_average = _weekly_average_stmt(BATCH_BBOX_COLUMNS, args, since, until)  # type: ignore
 
         async with db.acquire() as conn:
-            row = await conn.fetchrow(stmt, *trip.model_dump().values())
+            rows = await conn.fetch(
+                WEEKLY_AVERAGE_BATCH_STMT.format(weekly_average=weekly_average), *args
+            )
 
-        return TripInDB(**row) if row else None
+        return [_weekly_average(row) for row in rows]
+
+    @staticmethod
+    async def get_count_weekly_estimate_by_bbox_and_region(
+        bbox: tuple[Point, Point],
+        region_id: int,
+        db: Database,
+        max_error: float,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        shards: ShardRouter | None = None,
+    ) -> TripsWeeklyEstimate:
+        """ Estimación del promedio semanal de viajes en el bbox desde trips_sample, con un intervalo
+        de confianza del 95% cuyo error relativo no supera `max_error`. Se prueba desde la muestra más
+        pequeña a la más grande; si ni la de 1/16 alcanza el error pedido, el bbox tiene a lo más unos
+        (SAMPLE_Z / max_error)^2 * 16 viajes y se calcula exacto. Las semanas con viajes se estiman
+        desde trips_weekly_cells, ya que la muestra no ve las semanas con pocos viajes; el intervalo
+        solo considera el error del total """
+        db = await _region_db(db, shards, region_id)
+        px, py, qx, qy = _sorted_bbox(bbox)
+
+        weeks_args: list[float | int | datetime] = [px, py, qx, qy, region_id]
+        weeks_stmt = SAMPLE_WEEKS_STMT.format(
+            cell_fraction=SAMPLE_CELL_FRACTION,
+            rollup_period=_raw_period(weeks_args, since, until, (ROLLUP_SINCE, ROLLUP_UNTIL)),
+        )
+        args: list[float | int | datetime] = [px, py, qx, qy, region_id, 0]
+        stmt = SAMPLE_COUNT_STMT.format(raw_period=_raw_period(args, since, until))
+
+        async with db.acquire() as conn:
+            estimated_weeks: float = await conn.fetchval(weeks_stmt, *weeks_args)
+
+            for level, rate in SAMPLE_LEVELS:
+                args[5] = level
+                sample = await conn.fetchrow(stmt, *args)
+                sampled, sampled_weeks = sample["sampled"], sample["sampled_weeks"]  # type: ignore
+                if not sampled:
+                    continue
+
+                # El total de la muestra sigue una binomial. Las semanas vistas en la muestra
+                # tienen viajes, aunque las celdas estimen menos
+                total = sampled / rate
+                total_half_width = SAMPLE_Z * math.sqrt(sampled * (1 - rate)) / rate
+                if total_half_width <= max_error * total:
+                    weeks = max(estimated_weeks, sampled_weeks)
+                    return TripsWeeklyEstimate(
+                        mean=total / weeks,
+                        lower=(total - total_half_width) / weeks,
+                        upper=(total + total_half_width) / weeks,
+                        sample_rate=rate,
+                        source="sample",
+                    )
+
+        exact = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
+            bbox, region_id, db, since, until
+        )
+        return TripsWeeklyEstimate(
+            mean=exact.mean, lower=exact.mean, upper=exact.mean, sample_rate=1, source=exact.source
+        )
+
+    @staticmethod
+    async def iter_stats_series(
+        bbox: tuple[Point, Point],
+        region_id: int,
+        db: Database,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        shards: ShardRouter | None = None,
+    ) -> AsyncIterator[TripsStatsBucket]:
+        """ Conteos de viajes en el bbox por semana, por hora y por día de la semana, entregados a
+        medida que llegan desde la base de datos. La conexión se mantiene hasta agotar el iterador """
+        db = await _region_db(db, shards, region_id)
+        px, py, qx, qy = _sorted_bbox(bbox)
+
+        args: list[float | int | datetime] = [px, py, qx, qy, region_id]
+        stmt = STATS_SERIES_STMT.format(raw_period=_raw_period(args, since, until))
+
+        async with db.acquire() as conn:
+            # Los cursores de asyncpg solo existen dentro de una transacción
+            async with conn.transaction():
+                async for row in conn.cursor(stmt, *args, prefetch=STATS_SERIES_PREFETCH):
+                    if row["week"] is not None:
+                        yield TripsStatsBucket(breakdown="week", key=row["week"], count=row["count"])
+                    elif row["hour"] is not None:
+                        yield TripsStatsBucket(breakdown="hour", key=row["hour"], count=row["count"])
+                    else:
+                        yield TripsStatsBucket(breakdown="weekday", key=row["weekday"], count=row["count"])
 
     @staticmethod
     async def create_multiple(
-        trips: list[TripCreate], db: Database
+        trips: list[TripCreate],
+        db: Database,
+        cluster_distance: float = celeryconfig.CLUSTER_DISTANCE,
+        cluster_time_window: int = celeryconfig.CLUSTER_TIME_WINDOW,
+        shards: ShardRouter | None = None,
     ) -> list[TripInDB] | None:
-        stmt = """
-            INSERT INTO trips (region_id, origin, destination, timestamp, source) (
-                SELECT r.region_id, r.origin, r.destination, r.timestamp, r.source
-                FROM unnest($1::trips[]) as r
+        """ Inserta los viajes asignando cada uno a su grupo de viajes similares, solo se
+        actualizan los grupos de los viajes insertados. Con `shards` los viajes de cada shard
+        se insertan en paralelo, cada uno en su propia transacción, y se retornan agrupados
+        por shard """
+        if not trips:
+            return []
+
+        if shards is None or not shards.sharded:
+            return await TripsRepository._create_multiple(
+                trips, db, cluster_distance, cluster_time_window
             )
-            RETURNING trip_id, region_id, origin, destination, timestamp, source
-            """
+
+        region_shards = await shards.shards_of(trip.region_id for trip in trips)
+        by_shard: dict[int, list[TripCreate]] = {}
+        for trip in trips:
+            by_shard.setdefault(region_shards[trip.region_id], []).append(trip)
+
+        inserted = await asyncio.gather(
+            *(
+                TripsRepository._create_multiple(
+                    shard_trips, shards.pools[shard], cluster_distance, cluster_time_window
+                )
+                for shard, shard_trips in by_shard.items()
+            )
+        )
+        return [trip for shard_trips in inserted for trip in shard_trips]
+
+    @staticmethod
+    async def _create_multiple(
+        trips: list[TripCreate],
+        db: Database,
+        cluster_distance: float,
+        cluster_time_window: int,
+    ) -> list[TripInDB]:
+        timestamps = [trip.timestamp for trip in trips]
 
         async with db.acquire() as conn:
-            rows = await conn.fetch(
-                stmt, [(None, *trip.model_dump().values()) for trip in trips]
+            await conn.execute(
+                "SELECT ensure_trips_partitions($1, $2)", min(timestamps), max(timestamps)
             )
+            # Los grupos nuevos se confirman antes de insertar, igual que en la ingesta de archivos
+            groups = await conn.fetch(
+                "SELECT trip_group_ids($1, $2, $3, $4, $5, $6, $7, $8) AS group_id",
+                [trip.region_id for trip in trips],
+                [trip.origin[0] for trip in trips],
+                [trip.origin[1] for trip in trips],
+                [trip.destination[0] for trip in trips],
+                [trip.destination[1] for trip in trips],
+                timestamps,
+                cluster_distance,
+                cluster_time_window,
+            )
+            group_ids = [row["group_id"] for row in groups]
+            group_sizes = Counter(group_ids)
+
+            async with conn.transaction():
+                rows = await conn.fetch(
+                    CREATE_MULTIPLE_STMT,
+                    [
+                        (None, *trip.model_dump().values(), group_id, None)
+                        for trip, group_id in zip(trips, group_ids)
+                    ],
+                )
+                await conn.execute(
+                    "SELECT add_trip_group_sizes($1, $2)",
+                    list(group_sizes.keys()),
+                    list(group_sizes.values()),
+                )
 
         return [TripInDB(**row) for row in rows]
@@ -8,9 +8,34 @@ async def get_db():
 
     yield db
 
+async def get_shards():
+    shards = state.get("shards")
+    if not shards:
+        raise ValueError("No shard router in global state")
+
+    yield shards
+
 async def get_ws_manager():
     manager = state.get("manager")
     if not manager:
         raise ValueError("No websocket manager in global state")
 
-    yield manager
\ No newline at end of file
+    yield manager
+
+async def get_replay_cache():
+    replay = state.get("replay")
+    if not replay:
+        raise ValueError("No replay cache in global state")
+
+    yield replay
+
+async def get_stats_cache():
+    stats_cache = state.get("stats_cache")
+    if not stats_cache:
+        raise ValueError("No stats cache in global state")
+
+    yield stats_cache
+
+async def get_column_store():
+    # Solo existe con STATS_BACKEND=columnar, sin él las estadísticas se calculan en la base de datos
+    yield state.get("column_store")
@@ -32,8 +32,9 @@ def handle_pydantic_validation_exception(req: Request, exc: RequestValidationErr
     errors = exc.errors()
     missing = list(filter(_filter_missing_type_error, errors))
 
-    if len(missing) != 0:
-        query_params = reduce(_get_query_params, missing, [])
+    # Only query parameters get a specific message, errors in the body are reported as they come
+    query_params = reduce(_get_query_params, missing, [])
+    if len(query_params) != 0:
         query_params.sort()
 
         return JSONResponse(
@@ -43,8 +44,8 @@ def handle_pydantic_validation_exception(req: Request, exc: RequestValidationErr
 
     wrong_format = list(filter(_filter_string_format_type_error, errors))
 
-    if len(wrong_format) != 0:
-        query_params = reduce(_get_query_params, wrong_format, [])
+    query_params = reduce(_get_query_params, wrong_format, [])
+    if len(query_params) != 0:
         query_params.sort()
 
         return JSONResponse(
@@ -1,18 +1,28 @@
 """ Módulo que define el comportamiento de inicio y cierre de la aplicación """
 
+import asyncio
 import contextlib
 import os
 
 import asyncpg
 from fastapi import FastAPI
+from redis import asyncio as aioredis
 
+from optimized_shifts.cache import StatsCache
+from optimized_shifts.celery.config import celeryconfig
+from optimized_shifts.celery.shards import ShardRouter, connect_shards
+from optimized_shifts.columnar import TripsColumnStore
+from optimized_shifts.notifications import ReplayCache, listen_notifications
 from optimized_shifts.state import state
 from optimized_shifts.ws import ConnectionManager
 
 
 @contextlib.asynccontextmanager
 async def lifespan(app: FastAPI):
-    """ Inicializa la base de datos y los estados globales, una vez finalizada cierra la conexión con la base de datos"""
+    """ Inicializa la base de datos, los estados globales y la tarea que distribuye las notificaciones,
+    una vez finalizada cierra la conexión con la base de datos y con Redis. Con STATS_BACKEND=columnar
+    carga los viajes en memoria antes de recibir peticiones (desde el último snapshot de SNAPSHOT_DIR
+    si existe) y los refresca en segundo plano. Con SHARD_DATABASES abre también un pool por shard """
     host = os.environ.get("POSTGRES_HOST")
     user = os.environ.get("POSTGRES_USER")
     password = os.environ.get("POSTGRES_PASSWORD")
@@ -42,9 +52,48 @@ async def lifespan(app: FastAPI):
     if not pool:
         raise Exception("Unable to connect with database")
 
+    # Con SHARD_DATABASES los viajes de cada región se leen y escriben en su shard, la base de
+    # datos principal guarda las regiones y la asignación de shards
+    shards = ShardRouter(pool, await connect_shards(celeryconfig.SHARD_DATABASES))
+    if shards.sharded and os.environ.get("STATS_BACKEND", "sql") == "columnar":
+        raise ValueError("STATS_BACKEND=columnar requires a single database, unset SHARD_DATABASES")
+
+    manager = ConnectionManager(
+        max_queue_size=int(os.environ.get("WS_QUEUE_SIZE", 100)),
+        slow_client_policy=os.environ.get("WS_SLOW_CLIENT_POLICY", "drop_oldest"),  # type: ignore
+    )
+    redis = aioredis.Redis.from_url(celeryconfig.BROKER_URL)
     state["database"] = pool
-    state["manager"] = ConnectionManager()
+    state["shards"] = shards
+    state["manager"] = manager
+    state["replay"] = ReplayCache(redis)
+    state["stats_cache"] = StatsCache(redis, ttl=int(os.environ.get("STATS_CACHE_TTL", 300)))
+
+    notifications = asyncio.create_task(listen_notifications(redis, manager))
+    background = [notifications]
+
+    if os.environ.get("STATS_BACKEND", "sql") == "columnar":
+        store = TripsColumnStore(
+            grid_size=celeryconfig.COLUMNAR_GRID_SIZE,
+            refresh_interval=float(os.environ.get("COLUMNAR_REFRESH_INTERVAL", 5)),
+            reload_interval=float(os.environ.get("COLUMNAR_RELOAD_INTERVAL", 3600)),
+            snapshot_dir=celeryconfig.SNAPSHOT_DIR,
+        )
+        await store.load(pool)
+        state["column_store"] = store
+        background.append(asyncio.create_task(store.run(pool)))
 
     yield
 
+    for task in background:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+    state["column_store"] = None
+    await redis.close()
+    await manager.close()
+
+    for shard_pool in shards.pools:
+        if shard_pool is not pool:
+            await shard_pool.close()
     await pool.close()
@@ -0,0 +1,41 @@
+""" Módulo para leer cuerpos NDJSON (un documento JSON por línea) a medida que llegan """
+
+from typing import AsyncIterator
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+
+async def iter_lines(
+    chunks: AsyncIterator[bytes], max_line_size: int
+) -> AsyncIterator[tuple[int, bytes | None]]:
+    """
+    Separa en líneas un cuerpo recibido por partes, entregando el número de cada línea (desde 1)
+    junto a su contenido. Solo se guarda la línea en curso, por lo que la memoria no depende del
+    tamaño del cuerpo. Las líneas de más de `max_line_size` bytes se descartan y se entregan como None
+    """
+    buffer = bytearray()
+    line_number = 0
+    oversized = False
+
+    async for chunk in chunks:
+        start = 0
+        while (end := chunk.find(b"\n", start)) != -1:
+            line_number += 1
+            if oversized or len(buffer) + end - start > max_line_size:
+                yield line_number, None
+            else:
+                buffer += chunk[start:end]
+                yield line_number, bytes(buffer)
+
+            buffer.clear()
+            oversized = False
+            start = end + 1
+
+        if not oversized:
+            buffer += chunk[start:]
+            if len(buffer) > max_line_size:
+                oversized = True
+                buffer.clear()
+
+    if buffer or oversized:
+        yield line_number + 1, None if oversized else bytes(buffer)
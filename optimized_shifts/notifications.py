@@ -0,0 +1,93 @@
+""" Módulo que distribuye las notificaciones de procesamiento publicadas por Celery en Redis """
+
+import asyncio
+import json
+import logging
+from typing import Any
+
+from redis import asyncio as aioredis
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from optimized_shifts.celery.processer import LAST_NOTIFICATION_KEY, NOTIFICATIONS_CHANNEL
+from optimized_shifts.ws import ConnectionManager
+
+logger = logging.getLogger(__name__)
+
+# Segundos de espera antes de volver a subscribirse si se pierde la conexión con Redis
+RECONNECT_DELAY = 1.0
+
+
+class ReplayCache:
+    """
+    Último estado notificado de cada tarea, se reenvía a los clientes que se subscriben a una
+    tarea después de que esta notificó. Celery lo guarda en Redis junto con cada notificación
+    (con expiración), así cualquier proceso o réplica de la API puede reenviarlo
+    """
+    def __init__(self, redis: "aioredis.Redis[bytes]"):
+        self.redis = redis
+
+    async def get(self, task_id: str) -> str | None:
+        data = await self.redis.get(LAST_NOTIFICATION_KEY.format(task_id=task_id))
+        if data is None:
+            return None
+
+        return format_notification(data)
+
+
+def task_topic(task_id: str) -> str:
+    return f"task:{task_id}"
+
+
+def region_topic(region: str) -> str:
+    return f"region:{region}"
+
+
+def format_notification(data: bytes) -> str:
+    """ Mensaje enviado a los clientes del websocket por cada notificación """
+    return json.dumps({"type": "notification", "data": data.decode()})
+
+
+def notification_topics(notification: dict[str, Any]) -> list[str]:
+    """ Tópicos en los que se publica una notificación: su tarea y sus regiones """
+    topics: list[str] = []
+    if notification.get("task_id"):
+        topics.append(task_topic(notification["task_id"]))
+
+    topics.extend(region_topic(region) for region in notification.get("regions") or [])
+    return topics
+
+
+async def dispatch_notification(data: bytes, manager: ConnectionManager):
+    """ Envía una notificación a los clientes de este proceso subscritos a ella """
+    message = format_notification(data)
+    try:
+        notification = json.loads(data)
+    except ValueError:
+        notification = None
+
+    if not isinstance(notification, dict):
+        await manager.broadcast(message)
+        return
+
+    await manager.publish(message, notification_topics(notification))
+
+
+async def listen_notifications(redis: "aioredis.Redis[bytes]", manager: ConnectionManager):
+    """
+    Se subscribe al canal de notificaciones y reenvía cada mensaje una única vez a los
+    clientes subscritos a su tarea o región. Corre como una sola tarea por proceso de la API,
+    despertando solo cuando Redis entrega un mensaje. Cada proceso solo conoce a sus propios
+    clientes, y Redis entrega cada mensaje a todos los procesos y réplicas subscritos
+    """
+    while True:
+        try:
+            async with redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                await pubsub.subscribe(NOTIFICATIONS_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+
+                    await dispatch_notification(message["data"], manager)
+        except RedisConnectionError:
+            logger.warning("Lost connection with Redis, subscribing again")
+            await asyncio.sleep(RECONNECT_DELAY)
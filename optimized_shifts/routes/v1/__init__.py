@@ -1,6 +1,10 @@
 from fastapi import APIRouter
 
+from .groups import router as groups_router
+from .regions import router as regions_router
 from .trips import router as trips_router
 
 router = APIRouter(prefix="/v1")
 router.include_router(trips_router)
+router.include_router(groups_router)
+router.include_router(regions_router)
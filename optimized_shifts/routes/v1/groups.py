@@ -0,0 +1,76 @@
+""" Módulo que define las rutas de grupos de viajes similares """
+
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import JSONResponse
+
+from optimized_shifts.crud.groups import GroupsRepository
+from optimized_shifts.crud.region import RegionRepository
+from optimized_shifts.celery.shards import ShardRouter
+from optimized_shifts.dependencies import get_db, get_shards
+from optimized_shifts.state import Database
+
+router = APIRouter()
+
+
+@router.get("/groups")
+async def handle_groups_request(
+    region: Annotated[
+        str,
+        Query(
+            title="Region",
+            description="Region in where groups are located",
+        ),
+    ],
+    limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+    offset: Annotated[int, Query(ge=0)] = 0,
+    db: Database = Depends(get_db),
+    shards: ShardRouter = Depends(get_shards),
+):
+    """ Lista los grupos de viajes similares de una región, de mayor a menor cantidad de viajes """
+    region_id = await RegionRepository.get_id_by_name(region, db)
+    if region_id is None:
+        return JSONResponse({"message": f"Region {region} not found"}, status_code=400)
+
+    groups = await GroupsRepository.get_by_region(region_id, db, limit, offset, shards)
+
+    return {"groups": [group.model_dump(mode="json") for group in groups]}
+
+
+@router.get("/groups/{group_id}/trips")
+async def handle_group_trips_request(
+    group_id: int,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 100,
+    offset: Annotated[int, Query(ge=0)] = 0,
+    region: Annotated[
+        str | None,
+        Query(
+            title="Region",
+            description="Region of the group, required when trips are split in shards",
+        ),
+    ] = None,
+    db: Database = Depends(get_db),
+    shards: ShardRouter = Depends(get_shards),
+):
+    """ Lista los viajes que pertenecen a un grupo. Los ids de grupos son propios de cada shard,
+    con SHARD_DATABASES se indica la región para leer el grupo desde su shard """
+    region_id = None
+    if region is not None:
+        region_id = await RegionRepository.get_id_by_name(region, db)
+        if region_id is None:
+            return JSONResponse({"message": f"Region {region} not found"}, status_code=400)
+        db = await shards.pool(region_id)
+    elif shards.sharded:
+        return JSONResponse({"message": "region is required when trips are split in shards"}, status_code=400)
+
+    group = await GroupsRepository.get_by_id(group_id, db)
+    if not group or region_id not in (None, group.region_id):
+        return JSONResponse({"message": f"Group {group_id} not found"}, status_code=404)
+
+    trips = await GroupsRepository.get_trips(group_id, db, limit, offset)
+
+    return {
+        "group": group.model_dump(mode="json"),
+        "trips": [trip.model_dump(mode="json") for trip in trips],
+    }
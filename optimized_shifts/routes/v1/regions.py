@@ -0,0 +1,29 @@
+""" Módulo que define las rutas de regiones """
+
+from typing import Annotated
+
+from fastapi import APIRouter, Query
+
+from optimized_shifts.celery.regions import region_cache
+
+router = APIRouter()
+
+
+@router.get("/regions/cache")
+async def handle_region_cache_request():
+    """ Métricas del cache de regiones del proceso que atiende la petición: tamaño, aciertos y fallos """
+    return region_cache.metrics()
+
+
+@router.delete("/regions/cache", status_code=204)
+async def handle_region_cache_invalidation(
+    region: Annotated[
+        str | None,
+        Query(
+            title="Region",
+            description="Region to drop from the cache, every region is dropped if not given",
+        ),
+    ] = None,
+):
+    """ Invalida el cache de regiones del proceso que atiende la petición """
+    region_cache.invalidate(region)
@@ -1,47 +1,118 @@
 """ Módulo que define las rutas de viajes """
 
-import asyncio
 import json
-from typing import Annotated, cast
+import os
+from datetime import datetime
+from functools import cached_property, partial
+from typing import Annotated, Any, AsyncIterator, Callable, Coroutine, Literal
 
-from fastapi import APIRouter, Depends, Query, WebSocket, WebSocketDisconnect
-from fastapi.responses import JSONResponse
+from asyncpg import PostgresError
+from fastapi import APIRouter, Depends, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
+from pydantic import ValidationError
 
-from optimized_shifts.celery.processer import process_data, pubsub
+from optimized_shifts.celery.processer import compact_weekly_cells, process_data
 from optimized_shifts.crud.region import RegionRepository
-from optimized_shifts.crud.trips import TripsRepository
-from optimized_shifts.dependencies import get_db, get_ws_manager
-from optimized_shifts.schemas.api import TripsInsertRequest
-from optimized_shifts.schemas.trip import TripCreate
+from optimized_shifts.crud.trips import Point, TripsRepository
+from optimized_shifts.cache import StatsCache
+from optimized_shifts.celery.shards import ShardRouter
+from optimized_shifts.columnar import TripsColumnStore
+from optimized_shifts.dependencies import (
+    get_column_store,
+    get_db,
+    get_replay_cache,
+    get_shards,
+    get_stats_cache,
+    get_ws_manager,
+)
+from optimized_shifts.notifications import ReplayCache, region_topic, task_topic
+from optimized_shifts.ndjson import NDJSON_CONTENT_TYPES, iter_lines
+from optimized_shifts.schemas.api import (
+    TripsBatchResult,
+    TripsInsertRequest,
+    TripsLineError,
+    TripsStatsBatchRequest,
+    TripsStatsBatchResponse,
+    TripsStreamInsertResponse,
+)
+from optimized_shifts.schemas.trip import TripCreate, TripRequest
 from optimized_shifts.state import Database
 from optimized_shifts.ws import ConnectionManager
 
 router = APIRouter()
 
+# Bytes de una línea NDJSON y errores reportados por lote, acotan la memoria y el tamaño de la respuesta
+MAX_LINE_SIZE = 64 * 1024
+MAX_BATCH_ERRORS = 20
+# Solo se reportan los lotes con fallos, así la respuesta no crece con el tamaño del cuerpo
+MAX_REPORTED_BATCHES = 100
+
 
 @router.websocket("/trips/live")
-async def message_stream(websocket: WebSocket, manager: ConnectionManager = Depends(get_ws_manager)):
+async def message_stream(
+    websocket: WebSocket,
+    manager: ConnectionManager = Depends(get_ws_manager),
+    replay: ReplayCache = Depends(get_replay_cache),
+):
     """ 
-    Websocket que se subscribe a una cola redis y envia a los usuarios una notificación cuando recibe un
-    mensaje desde Celery informando el estado de un procesamiento.
+    Websocket que notifica a los usuarios el estado de los procesamientos de Celery. Las notificaciones
+    las envía la tarea iniciada en `lifespan`, aquí se registra al cliente y se atienden sus subscripciones.
+
+    Un cliente sin subscripciones recibe todas las notificaciones. Para recibir solo algunas envía
+    `{"type": "subscribe", "task_id": ...}` o `{"type": "subscribe", "region": ...}` (y `unsubscribe`
+    para dejar de recibirlas). Al subscribirse a una tarea que ya notificó se reenvía su último estado.
     """
     await manager.connect(websocket)
 
     try:
         while True:
-            if not await manager.is_websocket_active(websocket):
-                raise WebSocketDisconnect()
-            
-            message = pubsub.get_message()
-            if message:
-                notification = message["data"].decode()
-                await manager.broadcast(json.dumps({ "type": "notification", "data": notification }))
-                    
-            await asyncio.sleep(0.1)
+            await handle_subscription(websocket, manager, replay, await websocket.receive_text())
     except WebSocketDisconnect:
         print("Client disconnected")
         await manager.disconnect(websocket)
 
+
+async def handle_subscription(
+    websocket: WebSocket, manager: ConnectionManager, replay: ReplayCache, text: str
+):
+    """ Atiende un mensaje de subscripción de un cliente, los mensajes no reconocidos se ignoran """
+    try:
+        request = json.loads(text)
+    except ValueError:
+        return
+
+    if not isinstance(request, dict) or request.get("type") not in ("subscribe", "unsubscribe"):
+        return
+
+    task_id, region = request.get("task_id"), request.get("region")
+    if isinstance(task_id, str):
+        topic = task_topic(task_id)
+    elif isinstance(region, str):
+        topic = region_topic(region)
+    else:
+        return
+
+    if request["type"] == "unsubscribe":
+        manager.unsubscribe(websocket, topic)
+        manager.send(websocket, json.dumps({"type": "unsubscribed", "topic": topic}))
+        return
+
+    manager.subscribe(websocket, topic)
+    manager.send(websocket, json.dumps({"type": "subscribed", "topic": topic}))
+
+    last_status = await replay.get(task_id) if isinstance(task_id, str) else None
+    if last_status:
+        manager.send(websocket, last_status)
+
+
+@router.get("/trips/live/metrics")
+async def handle_live_metrics_request(manager: ConnectionManager = Depends(get_ws_manager)):
+    """ Métricas de las colas de envío del websocket: conexiones, mensajes encolados y descartados.
+    Son del proceso que atiende la petición, `pid` lo identifica al correr con varios workers """
+    return {"pid": os.getpid(), **manager.metrics()}
+
+
 @router.get("/trips/stats")
 async def handle_travels_request(
     nortest: Annotated[
@@ -67,29 +138,209 @@ async def handle_travels_request(
             description="Region in where trips are located",
         ),
     ],
+    response: Response,
+    since: Annotated[
+        datetime | None,
+        Query(
+            title="Since",
+            description="Only weeks from the one containing this date are averaged",
+        ),
+    ] = None,
+    until: Annotated[
+        datetime | None,
+        Query(
+            title="Until",
+            description="Only weeks up to the one containing this date are averaged",
+        ),
+    ] = None,
+    series: Annotated[
+        bool,
+        Query(
+            title="Series",
+            description="Stream the weekly, hourly and day of week trip counts as NDJSON, ending with the mean",
+        ),
+    ] = False,
+    mode: Annotated[
+        Literal["exact", "approx"],
+        Query(
+            title="Mode",
+            description="Estimate the mean from a sample of the trips, with a 95% confidence interval",
+        ),
+    ] = "exact",
+    max_error: Annotated[
+        float,
+        Query(
+            title="Max error",
+            description="Maximum relative error of the approximate mean, as a fraction of it",
+            gt=0,
+            lt=1,
+        ),
+    ] = 0.05,
     db: Database = Depends(get_db),
+    stats_cache: StatsCache = Depends(get_stats_cache),
+    store: TripsColumnStore | None = Depends(get_column_store),
+    shards: ShardRouter = Depends(get_shards),
 ):
-    """ Gestiona la petición de estadisticas de un viaje """
+    """ Gestiona la petición de estadisticas de un viaje, la cabecera X-Stats-Source indica si
+    el promedio se obtuvo desde los conteos precalculados (rollup), desde los viajes (raw) o ambos (mixed).
+    Con `since` y `until` solo se leen las particiones de viajes de ese rango. Los resultados se
+    guardan en cache hasta que se insertan viajes en la región, la cabecera X-Cache indica si
+    se leyó desde el cache (HIT), se calculó (MISS) o el cache no estaba disponible (BYPASS).
+    Con el motor columnar el promedio se calcula en memoria (columnar) y no pasa por el cache.
+    Con `series` la respuesta es NDJSON con los conteos por semana, hora y día de la semana, y una
+    última línea con el promedio; se envía a medida que llegan las filas y no pasa por el cache.
+    Con `mode=approx` el promedio se estima desde la muestra de viajes (sample) con un intervalo de
+    confianza cuyo error relativo no supera `max_error`, o se calcula exacto si el bbox tiene pocos
+    viajes; tampoco pasa por el cache """
+    if since and until and since > until:
+        return JSONResponse({"message": "since must be before until"}, status_code=400)
+
+    if series and mode == "approx":
+        return JSONResponse({"message": "series are only available in exact mode"}, status_code=400)
+
     px, py = southest.split(",")
     qx, qy = nortest.split(",")
 
     bbox = ((float(px), float(py)), (float(qx), float(qy)))
-    region_db = await RegionRepository.get_by_name(region, db)
-    if not region_db:
+    region_id = await RegionRepository.get_id_by_name(region, db)
+    if region_id is None:
         return JSONResponse({"message": f"Region {region} not found"}, status_code=400)
 
-    avg = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
-        bbox, region_db.id, db
+    if series:
+        return StreamingResponse(
+            _stats_series_lines(bbox, region_id, db, since, until, shards),
+            media_type=NDJSON_CONTENT_TYPES[0],
+            headers={"X-Stats-Source": "raw"},
+        )
+
+    if mode == "approx":
+        estimate = await TripsRepository.get_count_weekly_estimate_by_bbox_and_region(
+            bbox, region_id, db, max_error, since, until, shards
+        )
+        response.headers["X-Stats-Source"] = estimate.source
+        response.headers["X-Cache"] = "BYPASS"
+        return estimate.model_dump(include={"mean", "lower", "upper", "sample_rate"})
+
+    if store is not None and store.ready:
+        # El motor puede ir hasta un refresco atrás de la base de datos, guardar sus resultados
+        # en el cache los mantendría hasta la siguiente invalidación
+        avg = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
+            bbox, region_id, db, since, until, store
+        )
+        response.headers["X-Stats-Source"] = avg.source
+        response.headers["X-Cache"] = "BYPASS"
+        return {"mean": avg.mean}
+
+    avg, cache_status = await stats_cache.get_or_compute(
+        region_id,
+        bbox,
+        since,
+        until,
+        partial(
+            TripsRepository.get_count_weekly_average_by_bbox_and_region,
+            bbox,
+            region_id,
+            db,
+            since,
+            until,
+            shards=shards,
+        ),
+    )
+    response.headers["X-Stats-Source"] = avg.source
+    response.headers["X-Cache"] = cache_status
+
+    return {"mean": avg.mean}
+
+
+async def _stats_series_lines(
+    bbox: tuple[Point, Point],
+    region_id: int,
+    db: Database,
+    since: datetime | None,
+    until: datetime | None,
+    shards: ShardRouter,
+) -> AsyncIterator[str]:
+    """ Líneas NDJSON de los conteos del bbox; el promedio se calcula con los conteos semanales
+    a medida que pasan, sin volver a consultar la base de datos """
+    weeks = 0
+    total = 0
+    async for bucket in TripsRepository.iter_stats_series(
+        bbox, region_id, db, since, until, shards
+    ):
+        if bucket.breakdown == "week":
+            weeks += 1
+            total += bucket.count
+        yield bucket.model_dump_json() + "\n"
+
+    yield json.dumps({"mean": total / weeks if weeks else None}) + "\n"
+
+
+@router.post("/trips/stats/batch", response_model=TripsStatsBatchResponse)
+async def handle_travels_batch_request(
+    batch_request: TripsStatsBatchRequest,
+    db: Database = Depends(get_db),
+    store: TripsColumnStore | None = Depends(get_column_store),
+    shards: ShardRouter = Depends(get_shards),
+):
+    """ Gestiona la petición de estadisticas de varios bounding box (de una o más regiones). Todos los
+    promedios se calculan en una sola consulta a la base de datos y se retornan en el orden recibido """
+    since, until = batch_request.since, batch_request.until
+    if since and until and since > until:
+        return JSONResponse({"message": "since must be before until"}, status_code=400)
+
+    names = {bbox.region for bbox in batch_request.bboxes}
+    regions = await RegionRepository.get_ids_by_name(names, db)
+    missing = sorted(names - regions.keys())
+    if missing:
+        return JSONResponse({"message": f"Region {', '.join(missing)} not found"}, status_code=400)
+
+    results = await TripsRepository.get_count_weekly_average_by_bboxes(
+        [((bbox.southest, bbox.nortest), regions[bbox.region]) for bbox in batch_request.bboxes],
+        db,
+        since,
+        until,
+        store,
+        shards,
     )
 
-    return {"mean": avg}
+    return TripsStatsBatchResponse(results=results)
+
+
+class TripsInsertRoute(APIRoute):
+    """ Ruta de POST /trips que atiende los cuerpos NDJSON con handle_travels_stream_insertion.
+    FastAPI lee el cuerpo completo para validarlo antes de llamar a la ruta, así que el NDJSON se
+    despacha según su Content-Type antes de ese paso y se lee a medida que llega """
+
+    @cached_property
+    def stream_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        return APIRoute(
+            self.path,
+            handle_travels_stream_insertion,
+            methods=["POST"],
+            status_code=201,
+            response_model=TripsStreamInsertResponse,
+            dependency_overrides_provider=self.dependency_overrides_provider,
+        ).get_route_handler()
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            if _content_type(request) in NDJSON_CONTENT_TYPES:
+                return await self.stream_handler(request)
+            return await handler(request)
+
+        return route_handler
 
 
-@router.post("/trips")
 async def handle_travels_insertion(
-    insert_request: TripsInsertRequest, db: Database = Depends(get_db)
+    insert_request: TripsInsertRequest,
+    db: Database = Depends(get_db),
+    stats_cache: StatsCache = Depends(get_stats_cache),
+    shards: ShardRouter = Depends(get_shards),
 ):
-    """ Gestiona la petición de inserción de viajes """
+    """ Gestiona la petición de inserción de viajes. Con un Content-Type NDJSON el cuerpo se
+    inserta en streaming, igual que en POST /trips/ndjson """
     
     if insert_request.data_type != "json":
         result = process_data.delay(
@@ -103,25 +354,144 @@ async def handle_travels_insertion(
             },
         )
 
-    data = insert_request.data
+    region_ids = await insert_trip_requests(insert_request.data, db, shards)
+    await refresh_trip_stats(region_ids, stats_cache)
+
+    return JSONResponse(
+        status_code=201,
+        content={"message": "Points inserted"},
+    )
 
-    regions = set(map(lambda trip: trip.region, data))
-    regions_id_mapped: dict[str, int | None] = {region: None for region in regions}
 
-    regions_db = await RegionRepository.get_by_name_multiple(regions, db)
+router.add_api_route(
+    "/trips",
+    handle_travels_insertion,
+    methods=["POST"],
+    route_class_override=TripsInsertRoute,
+    # Documenta el cuerpo NDJSON junto al JSON que FastAPI obtiene de TripsInsertRequest
+    openapi_extra={
+        "requestBody": {"content": {content_type: {} for content_type in NDJSON_CONTENT_TYPES}}
+    },
+)
+
+
+@router.post("/trips/ndjson", status_code=201, response_model=TripsStreamInsertResponse)
+async def handle_travels_stream_insertion(
+    request: Request,
+    batch_size: Annotated[
+        int,
+        Query(
+            title="Batch size",
+            description="Trips validated and inserted together",
+            ge=1,
+            le=10_000,
+        ),
+    ] = 1_000,
+    db: Database = Depends(get_db),
+    stats_cache: StatsCache = Depends(get_stats_cache),
+    shards: ShardRouter = Depends(get_shards),
+):
+    """
+    Gestiona la inserción de viajes enviados como NDJSON (un viaje por línea). Las líneas se validan
+    e insertan en lotes de `batch_size` a medida que llega el cuerpo, por lo que la memoria usada no
+    depende del tamaño de la petición. Las líneas inválidas se reportan y no detienen la inserción,
+    la respuesta detalla solo los primeros `MAX_REPORTED_BATCHES` lotes con fallos
+    """
+    if _content_type(request) not in NDJSON_CONTENT_TYPES:
+        return JSONResponse(
+            status_code=415,
+            content={"message": f"Content-Type must be one of: {', '.join(NDJSON_CONTENT_TYPES)}"},
+        )
+
+    batches: list[TripsBatchResult] = []
+    batch: list[TripRequest] = []
+    errors: list[TripsLineError] = []
+    failed = 0
+    first_line = 1
+    batch_count = total_inserted = total_failed = 0
+    # Las estadísticas de las regiones insertadas se actualizan una vez, al terminar el cuerpo
+    region_ids: set[int] = set()
 
-    for region_db in regions_db:
-        regions_id_mapped[region_db.name] = region_db.id
+    async def flush(last_line: int):
+        nonlocal batch, errors, failed, first_line, batch_count, total_inserted, total_failed
+        inserted = 0
+        try:
+            region_ids.update(await insert_trip_requests(batch, db, shards))
+            inserted = len(batch)
+        except PostgresError as exc:
+            failed += len(batch)
+            errors.append(TripsLineError(line=first_line, message=f"Batch not inserted: {exc}"))
 
-    # Insert regions that doesn't exists yet
-    to_insert = [key for key, value in regions_id_mapped.items() if value is None]
-    inserted = await RegionRepository.create_multiple(to_insert, db)
-    for region_db in inserted:
-        regions_id_mapped[region_db.name] = region_db.id
+        batch_count += 1
+        total_inserted += inserted
+        total_failed += failed
+        if failed and len(batches) < MAX_REPORTED_BATCHES:
+            batches.append(
+                TripsBatchResult(
+                    batch=batch_count,
+                    first_line=first_line,
+                    last_line=last_line,
+                    inserted=inserted,
+                    failed=failed,
+                    errors=errors[:MAX_BATCH_ERRORS],
+                )
+            )
+        batch, errors, failed, first_line = [], [], 0, last_line + 1
+
+    line_number = 0
+    try:
+        async for line_number, line in iter_lines(request.stream(), MAX_LINE_SIZE):
+            if line is None:
+                failed += 1
+                errors.append(TripsLineError(line=line_number, message=f"Line longer than {MAX_LINE_SIZE} bytes"))
+            elif line.strip():
+                try:
+                    batch.append(TripRequest.model_validate_json(line))
+                except ValidationError as exc:
+                    failed += 1
+                    errors.append(TripsLineError(line=line_number, message=_validation_message(exc)))
+
+            if len(batch) + failed >= batch_size:
+                await flush(line_number)
+
+        if batch or failed:
+            await flush(line_number)
+    finally:
+        # Los lotes ya insertados quedan aunque el cliente se desconecte a mitad del cuerpo
+        await refresh_trip_stats(region_ids, stats_cache)
+
+    return TripsStreamInsertResponse(
+        inserted=total_inserted, failed=total_failed, batch_count=batch_count, batches=batches
+    )
+
+
+def _content_type(request: Request) -> str:
+    return request.headers.get("content-type", "").split(";")[0].strip().lower()
+
+
+def _validation_message(exc: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(map(str, error['loc'])) or 'line'}: {error['msg']}" for error in exc.errors()
+    )
+
+
+async def insert_trip_requests(
+    data: list[TripRequest],
+    db: Database,
+    shards: ShardRouter | None = None,
+) -> set[int]:
+    """ Inserta los viajes recibidos por la API creando las regiones que no existan, retorna las
+    regiones de los viajes insertados. Con `shards` los viajes se escriben en el shard de su región """
+    if not data:
+        return set()
+
+    regions_id_mapped = await RegionRepository.get_or_create_multiple(
+        set(map(lambda trip: trip.region, data)), db, shards
+    )
 
     points_to_be_inserted = [
         TripCreate(
-            region_id=cast(int, regions_id_mapped[t.region]),
+            region_id=regions_id_mapped[t.region],
             origin=t.origin,
             destination=t.destination,
             timestamp=t.timestamp,
@@ -130,9 +500,17 @@ async def handle_travels_insertion(
         for t in data
     ]
 
-    await TripsRepository.create_multiple(points_to_be_inserted, db)
+    await TripsRepository.create_multiple(points_to_be_inserted, db, shards=shards)
 
-    return JSONResponse(
-        status_code=201,
-        content={"message": "Points inserted"},
-    )
+    return set(regions_id_mapped.values())
+
+
+async def refresh_trip_stats(region_ids: set[int], stats_cache: StatsCache):
+    """ Invalida las estadísticas guardadas de las regiones con viajes nuevos y compacta sus conteos
+    semanales en segundo plano, igual que al procesar archivos. El motor columnar los lee en su
+    próximo refresco periódico """
+    if not region_ids:
+        return
+
+    await stats_cache.invalidate(list(region_ids))
+    compact_weekly_cells.delay(list(region_ids))
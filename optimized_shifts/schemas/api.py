@@ -1,11 +1,12 @@
 """ Módulo que define esquemas para las peticiones de la API """
 
+from datetime import datetime
 from typing import Annotated, Literal
 
 from fastapi import Body
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
-from optimized_shifts.schemas.trip import TripRequest
+from optimized_shifts.schemas.trip import Point, TripRequest, TripsWeeklyAverage
 
 
 class TripsFileInsertRequest(BaseModel):
@@ -20,6 +21,49 @@ class TripsJsonInsertRequest(BaseModel):
     data: list[TripRequest]
 
 
+class TripsLineError(BaseModel):
+    """ Error de una línea de una inserción NDJSON """
+    line: int
+    message: str
+
+
+class TripsBatchResult(BaseModel):
+    """ Resultado de un lote de una inserción NDJSON """
+    batch: int
+    first_line: int
+    last_line: int
+    inserted: int
+    failed: int
+    errors: list[TripsLineError]
+
+
+class TripsStreamInsertResponse(BaseModel):
+    """ Respuesta de una inserción NDJSON, con los totales y el resultado de los lotes con fallos """
+    inserted: int
+    failed: int
+    batch_count: int
+    batches: list[TripsBatchResult]
+
+
 TripsInsertRequest = Annotated[
     TripsJsonInsertRequest | TripsFileInsertRequest, Body(discriminator="data_type")
 ]
+
+
+class TripsStatsBbox(BaseModel):
+    """ Bounding box y región de una consulta de estadísticas en lote """
+    nortest: Point
+    southest: Point
+    region: str
+
+
+class TripsStatsBatchRequest(BaseModel):
+    """ Esquema de petición de estadísticas de varios bounding box, el rango de fechas es común a todos """
+    bboxes: list[TripsStatsBbox] = Field(..., min_length=1, max_length=1000)
+    since: datetime | None = None
+    until: datetime | None = None
+
+
+class TripsStatsBatchResponse(BaseModel):
+    """ Promedio semanal de cada bounding box, en el orden de la petición """
+    results: list[TripsWeeklyAverage]
@@ -0,0 +1,19 @@
+""" Módulo que define los esquemas de un grupo de viajes similares """
+
+from datetime import time
+
+from pydantic import BaseModel, Field
+
+
+class TripGroupInDB(BaseModel):
+    """ Esquema que representa un grupo de viajes en la base de datos. `origin` y `destination`
+    son el centro de las celdas que agrupa, y `time_from` / `time_to` su ventana horaria """
+    id: int = Field(..., alias="group_id")
+    region_id: int
+    distance: float
+    time_window: int
+    origin: tuple[float, float]
+    destination: tuple[float, float]
+    time_from: time
+    time_to: time
+    size: int
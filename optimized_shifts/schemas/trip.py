@@ -1,43 +1,29 @@
 """ Módulo que define los esquemas del modelo Trip, el cual representa un viaje de una persona """
 
-import json
 from datetime import datetime
-from typing import Any
+from typing import Annotated, Literal
 
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, Json, NaiveDatetime, TypeAdapter
+
+
+# Un punto puede venir como lista `[x, y]` o como string JSON `"[x, y]"`. Ambas formas se validan
+# en pydantic-core, sin pasar por Python por cada campo
+Point = Annotated[
+    tuple[float, float] | Json[tuple[float, float]], Field(union_mode="left_to_right")
+]
 
 
 class TripRequest(BaseModel):
     """ Esquema para la petición de la API de crear un viaje """
     region: str
-    origin: tuple[float, float]
-    destination: tuple[float, float]
-    timestamp: datetime
+    origin: Point
+    destination: Point
+    timestamp: NaiveDatetime
     source: str
 
-    @field_validator("origin", "destination", mode="before")
-    @classmethod
-    def validate_string_point(cls, raw: str | list[Any]) -> tuple[float, float]:
-        if isinstance(raw, str):
-            try:
-                raw = json.loads(raw)
-            except (json.JSONDecodeError, TypeError) as exc:
-                raise ValueError("Input is not a tuple of numbers") from exc
-
-            if not isinstance(raw, list):
-                raise ValueError("Input is not a tuple of numbers")
-
-        if len(raw) != 2:  # type: ignore # noqa # sabemos que point es list, da lo mismo el valor dentro solo necesitamos el length
-            raise ValueError("Point must have two values, x and y")
-
-        x, y = float(raw[0]), float(raw[1])  # type: ignore
 
-        return (x, y)
-
-    @field_validator("timestamp", mode="before")
-    @classmethod
-    def validate_timestamp(cls, raw: str) -> datetime:
-        return datetime.strptime(raw, "%Y-%m-%d %H:%M:%S")
+# Valida un arreglo completo de viajes en una sola llamada a pydantic-core
+TripRequestList = TypeAdapter(list[TripRequest])
 
 
 class TripCreate(BaseModel):
@@ -56,4 +42,27 @@ class TripInDB(BaseModel):
     origin: tuple[float, float]
     destination: tuple[float, float]
     timestamp: datetime
-    source: str
+    source: str | None
+    group_id: int | None = None
+
+
+class TripsWeeklyAverage(BaseModel):
+    """ Promedio semanal de viajes en un bbox, junto a la fuente desde donde se calculó """
+    mean: float | None
+    source: Literal["raw", "rollup", "mixed", "columnar", "sample"]
+
+
+class TripsWeeklyEstimate(TripsWeeklyAverage):
+    """ Promedio semanal de viajes estimado desde una muestra, con su intervalo de confianza del 95%
+    y la fracción de los viajes leída (1 si se calculó exacto) """
+    lower: float | None
+    upper: float | None
+    sample_rate: float
+
+
+class TripsStatsBucket(BaseModel):
+    """ Conteo de viajes de una semana (inicio de la semana), una hora del día (0 a 23) o un día de
+    la semana (1 = lunes a 7 = domingo) """
+    breakdown: Literal["week", "hour", "weekday"]
+    key: datetime | int
+    count: int
@@ -1,6 +1,10 @@
 """ Modulo que define el estado global de la aplicación """
 
 from typing import TypeAlias, TypedDict
+from optimized_shifts.cache import StatsCache
+from optimized_shifts.celery.shards import ShardRouter
+from optimized_shifts.columnar import TripsColumnStore
+from optimized_shifts.notifications import ReplayCache
 from optimized_shifts.ws import ConnectionManager
 
 import asyncpg
@@ -13,7 +17,18 @@ DatabaseConnection: TypeAlias = "asyncpg.Connection[asyncpg.Record]"
 class State(TypedDict):
     """ Estado global de la aplicación """
     database: DatabaseState
+    shards: ShardRouter | None
     manager: ConnectionManager | None 
+    replay: ReplayCache | None
+    stats_cache: StatsCache | None
+    column_store: TripsColumnStore | None
 
 
-state: State = {"database": None, "manager": None}
+state: State = {
+    "database": None,
+    "shards": None,
+    "manager": None,
+    "replay": None,
+    "stats_cache": None,
+    "column_store": None,
+}
@@ -1,41 +1,182 @@
 """ Módulo que contiene las especificaciones para websocket de la aplicación """
 
 import asyncio
+import contextlib
+from dataclasses import dataclass, field
+from typing import Literal, get_args
+
 from fastapi import WebSocket
 from starlette.websockets import WebSocketState
 
+SlowClientPolicy = Literal["drop_oldest", "disconnect"]
+
+
+@dataclass
+class _Client:
+    """ Cliente conectado, con su cola de mensajes pendientes y la tarea que se los envía """
+    websocket: WebSocket
+    queue: "asyncio.Queue[str]"
+    writer: "asyncio.Task[None] | None" = None
+    dropped: int = 0
+    topics: set[str] = field(default_factory=set)
+
+
 class ConnectionManager:
-    """ Administrador de conexiones vía WebSocket """
-    def __init__(self):
-        self.__MAX_TIMEOUT = 5
-        self.active_connections: list[WebSocket] = []
+    """
+    Administrador de conexiones vía WebSocket. Cada cliente tiene una cola de a lo más
+    `max_queue_size` mensajes y una tarea que se los envía, así un cliente lento no retrasa
+    al resto. Cuando la cola de un cliente se llena, `slow_client_policy` define si se descarta
+    su mensaje más antiguo (`drop_oldest`) o se le desconecta (`disconnect`).
+
+    Los clientes pueden subscribirse a tópicos para recibir solo los mensajes publicados en
+    ellos, los clientes sin subscripciones reciben todos los mensajes
+    """
+    def __init__(self, max_queue_size: int = 100, slow_client_policy: SlowClientPolicy = "drop_oldest"):
+        if slow_client_policy not in get_args(SlowClientPolicy):
+            raise ValueError(f"Unknown slow client policy: {slow_client_policy}")
+
+        self.max_queue_size = max_queue_size
+        self.slow_client_policy = slow_client_policy
+        self.clients: dict[WebSocket, _Client] = {}
+        self.subscribers: dict[str, set[WebSocket]] = {}
+        self.dropped_messages = 0
+        self.slow_disconnections = 0
+        self._closing: set["asyncio.Task[None]"] = set()
+
+    @property
+    def active_connections(self) -> list[WebSocket]:
+        return list(self.clients)
 
     async def connect(self, websocket: WebSocket):
         """ Inicia la conexión con un cliente y lo almacena en un estado interno """
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = _Client(websocket, asyncio.Queue(self.max_queue_size))
+        client.writer = asyncio.create_task(self._write(client))
+        self.clients[websocket] = client
 
     async def disconnect(self, websocket: WebSocket):
-        """ Cierra la conexión con un cliente y lo elimina del estado interno """
-        await websocket.close()
-        self.active_connections.remove(websocket)
+        """ Cierra la conexión con un cliente (si sigue abierta) y lo elimina del estado interno """
+        await self._shutdown(websocket, self._remove(websocket))
+
+    def subscribe(self, websocket: WebSocket, topic: str):
+        """ Subscribe a un cliente a un tópico """
+        client = self.clients.get(websocket)
+        if not client:
+            return
+
+        client.topics.add(topic)
+        self.subscribers.setdefault(topic, set()).add(websocket)
+
+    def unsubscribe(self, websocket: WebSocket, topic: str):
+        """ Elimina la subscripción de un cliente a un tópico """
+        client = self.clients.get(websocket)
+        if client:
+            client.topics.discard(topic)
+
+        subscribers = self.subscribers.get(topic)
+        if subscribers is None:
+            return
+
+        subscribers.discard(websocket)
+        if not subscribers:
+            del self.subscribers[topic]
+
+    def send(self, websocket: WebSocket, message: str):
+        """ Encola un mensaje para un cliente """
+        client = self.clients.get(websocket)
+        if client:
+            self._enqueue(client, message)
+
+    async def publish(self, message: str, topics: list[str]):
+        """ Encola un mensaje para los clientes subscritos a alguno de los tópicos y para los
+        clientes sin subscripciones, cada uno lo recibe una sola vez """
+        recipients = {
+            websocket
+            for websocket, client in self.clients.items()
+            if not client.topics
+        }
+        for topic in topics:
+            recipients.update(self.subscribers.get(topic, ()))
+
+        for websocket in recipients:
+            self.send(websocket, message)
 
     async def broadcast(self, message: str):
-        """ Envia un mensaje a todos los clientes conectados """
-        for connection in self.active_connections:
-            await connection.send_text(message)
-
-    async def is_websocket_active(self, ws: WebSocket) -> bool:
-        """ Comprueba si un cliente sigue conectado, para esto
-            envía un mensaje de tipo 'ping', si recibe una respuesta de tipo 'pong' entonces
-            retornará True, de lo contrario, retornará false
-        """
-        if not (ws.application_state == WebSocketState.CONNECTED and ws.client_state == WebSocketState.CONNECTED):
-            return False
+        """ Encola un mensaje para todos los clientes conectados sin esperar a que se envíe """
+        for client in list(self.clients.values()):
+            self._enqueue(client, message)
+
+    def metrics(self) -> dict[str, int | str]:
+        """ Métricas de las colas de envío de los clientes conectados """
+        depths = [client.queue.qsize() for client in self.clients.values()]
+        return {
+            "connections": len(depths),
+            "topics": len(self.subscribers),
+            "queued_messages": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "max_queue_size": self.max_queue_size,
+            "slow_client_policy": self.slow_client_policy,
+            "dropped_messages": self.dropped_messages,
+            "slow_disconnections": self.slow_disconnections,
+        }
+
+    async def close(self):
+        """ Desconecta a todos los clientes """
+        for websocket in list(self.clients):
+            await self.disconnect(websocket)
+
+        if self._closing:
+            await asyncio.wait(self._closing)
+
+    def _enqueue(self, client: _Client, message: str):
         try:
-            await asyncio.wait_for(ws.send_json({'type': 'ping'}), self.__MAX_TIMEOUT)
-            message = await asyncio.wait_for(ws.receive_json(), self.__MAX_TIMEOUT)
-            assert message['type'] == 'pong'
-        except BaseException: 
-            return False
-        return True
\ No newline at end of file
+            client.queue.put_nowait(message)
+            return
+        except asyncio.QueueFull:
+            pass
+
+        if self.slow_client_policy == "disconnect":
+            self.slow_disconnections += 1
+            self._disconnect_later(client)
+            return
+
+        client.queue.get_nowait()
+        client.queue.put_nowait(message)
+        client.dropped += 1
+        self.dropped_messages += 1
+
+    def _remove(self, websocket: WebSocket) -> _Client | None:
+        client = self.clients.pop(websocket, None)
+        if client:
+            for topic in list(client.topics):
+                self.unsubscribe(websocket, topic)
+
+        return client
+
+    async def _write(self, client: _Client):
+        while True:
+            message = await client.queue.get()
+            try:
+                await client.websocket.send_text(message)
+            except Exception:
+                await self.disconnect(client.websocket)
+                return
+
+    async def _shutdown(self, websocket: WebSocket, client: _Client | None):
+        if client and client.writer and client.writer is not asyncio.current_task():
+            client.writer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await client.writer
+
+        if websocket.application_state == WebSocketState.CONNECTED:
+            try:
+                await websocket.close()
+            except RuntimeError:
+                pass
+
+    def _disconnect_later(self, client: _Client):
+        # Cerrar la conexión de un cliente lento puede tardar, no se espera en el broadcast
+        self._remove(client.websocket)
+        task = asyncio.create_task(self._shutdown(client.websocket, client))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
@@ -0,0 +1,47 @@
+from datetime import datetime
+
+import pytest
+import redis
+from redis import asyncio as aioredis
+
+from optimized_shifts.cache import StatsCache, stats_params
+from optimized_shifts.celery.config import celeryconfig
+from optimized_shifts.celery.stats_cache import invalidate_stats
+from optimized_shifts.schemas.trip import TripsWeeklyAverage
+
+
+def test_stats_params_are_normalized():
+    assert stats_params(((1.0, 2.0), (0.5, 0.25)), None, None) == stats_params(
+        ((0.5000000001, 0.25), (1, 2)), None, None
+    )
+    # Dates are truncated to the monday of their week
+    assert stats_params(((0, 0), (1, 1)), datetime(2023, 1, 12, 10), None) == stats_params(
+        ((0, 0), (1, 1)), datetime(2023, 1, 9), None
+    )
+
+
+@pytest.mark.asyncio
+async def test_ingestion_invalidates_cached_stats():
+    r = redis.Redis.from_url(celeryconfig.BROKER_URL)
+    cache = StatsCache(aioredis.Redis.from_url(celeryconfig.BROKER_URL))
+    bbox = ((0.0, 0.0), (1.0, 1.0))
+    means = iter([1.0, 2.0])
+
+    async def compute():
+        return TripsWeeklyAverage(mean=next(means), source="raw")
+
+    try:
+        assert await cache.get_or_compute(-1, bbox, None, None, compute) == (
+            TripsWeeklyAverage(mean=1.0, source="raw"),
+            "MISS",
+        )
+        assert (await cache.get_or_compute(-1, bbox, None, None, compute))[1] == "HIT"
+
+        # Workers invalidate the regions of every committed partition
+        invalidate_stats(r, [-1])
+
+        avg, status = await cache.get_or_compute(-1, bbox, None, None, compute)
+        assert (avg.mean, status) == (2.0, "MISS")
+    finally:
+        await cache.redis.close()
+        r.close()
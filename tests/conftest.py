@@ -5,10 +5,14 @@ import aiofiles
 import asyncpg
 import pytest
 import pytest_asyncio
+import redis
 from asgi_lifespan import LifespanManager
 from httpx import AsyncClient
 
 from main import app
+from optimized_shifts.celery.config import celeryconfig
+from optimized_shifts.celery.regions import region_cache
+from optimized_shifts.celery.shards import ShardRouter
 
 
 @pytest.fixture(scope="session")
@@ -75,6 +79,22 @@ async def initialize_test_database():
     await sys_conn.close()
 
 
+@pytest.fixture(autouse=True)
+def clear_region_cache():
+    # Tests truncate regions directly, cached ids from previous tests would be stale
+    region_cache.invalidate()
+
+
+@pytest.fixture(autouse=True)
+def clear_stats_cache():
+    # Region ids are reused between test runs, results cached by a previous run would be stale
+    r = redis.Redis.from_url(celeryconfig.BROKER_URL)
+    keys = list(r.scan_iter("stats:*"))
+    if keys:
+        r.delete(*keys)
+    r.close()
+
+
 @pytest_asyncio.fixture()  # type: ignore  # noqa
 async def test_db():
     host = os.environ.get("POSTGRES_HOST")
@@ -100,3 +120,56 @@ async def test_app():
     async with LifespanManager(app):
         async with AsyncClient(app=app, base_url="http://test") as ac:
             yield ac
+
+
+@pytest_asyncio.fixture()  # type: ignore  # noqa
+async def test_pool():
+    host = os.environ.get("POSTGRES_HOST")
+    user = os.environ.get("POSTGRES_USER")
+    password = os.environ.get("POSTGRES_PASSWORD")
+    database = os.environ.get("POSTGRES_DB")
+
+    assert (
+        database == "test"
+    ), "Attempt to run tests in a non-test database, aborting..."
+
+    pool = await asyncpg.create_pool(
+        host=host, user=user, password=password, database=database
+    )
+
+    yield pool
+
+    await pool.close()
+
+
+@pytest_asyncio.fixture()  # type: ignore  # noqa
+async def shards(test_pool: "asyncpg.Pool[asyncpg.Record]"):
+    """Router with the test database as shard 0 and a second database as shard 1"""
+    user = os.environ.get("POSTGRES_USER")
+    password = os.environ.get("POSTGRES_PASSWORD")
+    database = "test_shard"
+
+    sys_conn = await asyncpg.connect(
+        host=os.environ.get("POSTGRES_HOST"), database="template1", user=user, password=password
+    )
+    await sys_conn.execute(f'DROP DATABASE IF EXISTS "{database}"')
+    await sys_conn.execute(f'CREATE DATABASE "{database}" OWNER "{user}"')
+
+    shard_pool = await asyncpg.create_pool(
+        host=os.environ.get("POSTGRES_HOST"), user=user, password=password, database=database
+    )
+    if not shard_pool:
+        raise ValueError("Unable to create connection with database")
+
+    async with aiofiles.open(os.path.join(os.getcwd(), "init.sql")) as f:
+        await shard_pool.execute(await f.read())
+
+    tables = "regions, region_shards, trips, trips_weekly_cells, trip_groups, trips_sample"
+    await test_pool.execute(f"TRUNCATE TABLE {tables}")
+
+    yield ShardRouter(test_pool, [test_pool, shard_pool])
+
+    await test_pool.execute(f"TRUNCATE TABLE {tables}")
+    await shard_pool.close()
+    await sys_conn.execute(f'DROP DATABASE IF EXISTS "{database}"')
+    await sys_conn.close()
@@ -0,0 +1,58 @@
+import asyncio
+
+import asyncpg
+import pytest
+from httpx import AsyncClient
+
+from optimized_shifts.celery.regions import fetch_or_create_regions, region_cache
+from optimized_shifts.crud.region import RegionRepository
+from optimized_shifts.state import DatabaseConnection
+
+
+@pytest.mark.asyncio
+async def test_concurrent_region_creation(
+    test_pool: "asyncpg.Pool[asyncpg.Record]", test_db: DatabaseConnection
+):
+    names = {f"Concurrent {i}" for i in range(20)}
+
+    async def create():
+        async with test_pool.acquire() as conn:
+            async with conn.transaction():
+                return await fetch_or_create_regions(conn, names)
+
+    results = await asyncio.gather(*(create() for _ in range(4)))
+
+    assert all(result == results[0] for result in results)
+    assert results[0].keys() == names
+    count = await test_db.fetchval(
+        "SELECT count(*) FROM regions WHERE region_name = ANY($1::text[])", list(names)
+    )
+    assert count == len(names)
+
+
+@pytest.mark.asyncio
+async def test_region_ids_are_cached(test_pool: "asyncpg.Pool[asyncpg.Record]"):
+    created = await RegionRepository.get_or_create_multiple({"Cached"}, test_pool)
+    hits, misses = region_cache.hits, region_cache.misses
+
+    assert await RegionRepository.get_id_by_name("Cached", test_pool) == created["Cached"]
+    assert (region_cache.hits, region_cache.misses) == (hits + 1, misses)
+
+    region_cache.invalidate("Cached")
+
+    assert await RegionRepository.get_id_by_name("Cached", test_pool) == created["Cached"]
+    assert (region_cache.hits, region_cache.misses) == (hits + 1, misses + 1)
+    assert await RegionRepository.get_id_by_name("Unknown", test_pool) is None
+
+
+@pytest.mark.asyncio
+async def test_region_cache_routes(test_app: AsyncClient):
+    region_cache.set_many({"Turin": 1})
+
+    response = await test_app.get("/api/v1/regions/cache")
+    assert response.status_code == 200
+    assert response.json()["size"] == 1
+
+    response = await test_app.delete("/api/v1/regions/cache", params={"region": "Turin"})
+    assert response.status_code == 204
+    assert region_cache.metrics()["size"] == 0
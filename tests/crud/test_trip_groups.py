@@ -0,0 +1,152 @@
+from datetime import datetime
+
+import pytest
+import pytest_asyncio
+
+from optimized_shifts.celery.tasks import cluster_trips_task
+from optimized_shifts.crud.groups import GroupsRepository
+from optimized_shifts.crud.trips import TripsRepository
+from optimized_shifts.schemas.trip import TripCreate
+from optimized_shifts.state import Database, DatabaseConnection
+
+
+@pytest_asyncio.fixture  # type: ignore # noqa
+async def clustered_region(test_db: DatabaseConnection):
+    region_id = await test_db.fetchval(
+        "INSERT INTO regions (region_name) VALUES ('Clustered') RETURNING region_id"
+    )
+    await test_db.execute(
+        "SELECT ensure_trips_partitions($1, $2)", datetime(2023, 3, 1), datetime(2023, 3, 31)
+    )
+    trips = {
+        # Same cells and same half hour, on different days
+        "a": ((0.101, 0.101), (0.2, 0.2), datetime(2023, 3, 1, 8, 5)),
+        "b": ((0.105, 0.108), (0.203, 0.204), datetime(2023, 3, 8, 8, 20)),
+        # Same cells, but another half hour
+        "c": ((0.101, 0.101), (0.2, 0.2), datetime(2023, 3, 1, 9, 10)),
+        # Far away origin
+        "d": ((0.5, 0.5), (0.2, 0.2), datetime(2023, 3, 1, 8, 10)),
+    }
+    for name, (origin, destination, timestamp) in trips.items():
+        await test_db.execute(
+            """
+            INSERT INTO trips (region_id, origin, destination, timestamp, source)
+            VALUES ($1, $2, $3, $4, $5)
+            """,
+            region_id,
+            origin,
+            destination,
+            timestamp,
+            name,
+        )
+
+    yield region_id
+
+    await test_db.execute("TRUNCATE TABLE regions, trips, trips_weekly_cells, trip_groups")
+
+
+async def _groups_by_source(test_db: DatabaseConnection, region_id: int) -> dict[str, int]:
+    rows = await test_db.fetch(
+        "SELECT source, group_id FROM trips WHERE region_id = $1", region_id
+    )
+    return {row["source"]: row["group_id"] for row in rows}
+
+
+@pytest.mark.asyncio
+async def test_cluster_trips_groups_by_cells_and_time_of_day(
+    test_db: DatabaseConnection, test_pool: Database, clustered_region: int
+):
+    groups = await cluster_trips_task([clustered_region], 0.01, 30, pool=test_pool)
+    assigned = await _groups_by_source(test_db, clustered_region)
+
+    assert groups == 3
+    assert None not in assigned.values()
+    assert assigned["a"] == assigned["b"]
+    assert len({assigned["a"], assigned["c"], assigned["d"]}) == 3
+
+    group = await GroupsRepository.get_by_id(assigned["a"], test_pool)
+    assert group is not None
+    assert group.size == 2
+    assert group.origin == pytest.approx((0.105, 0.105))
+    assert group.time_from.isoformat() == "08:00:00"
+    assert group.time_to.isoformat() == "08:30:00"
+
+    members = await GroupsRepository.get_trips(assigned["a"], test_pool)
+    assert [trip.source for trip in members] == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_cluster_trips_again_with_other_thresholds_replaces_groups(
+    test_db: DatabaseConnection, test_pool: Database, clustered_region: int
+):
+    await cluster_trips_task([clustered_region], 0.01, 30, pool=test_pool)
+    before = await _groups_by_source(test_db, clustered_region)
+
+    # Clustering twice with the same thresholds keeps the groups
+    await cluster_trips_task([clustered_region], 0.01, 30, pool=test_pool)
+    assert await _groups_by_source(test_db, clustered_region) == before
+
+    groups = await cluster_trips_task([clustered_region], 0.1, 120, pool=test_pool)
+    assigned = await _groups_by_source(test_db, clustered_region)
+
+    assert groups == 2
+    assert assigned["a"] == assigned["b"] == assigned["c"] != assigned["d"]
+    assert (
+        await test_db.fetchval(
+            "SELECT COUNT(*) FROM trip_groups WHERE region_id = $1", clustered_region
+        )
+        == 2
+    )
+
+
+@pytest.mark.asyncio
+async def test_create_multiple_assigns_groups_incrementally(
+    test_db: DatabaseConnection, test_pool: Database
+):
+    region_id = await test_db.fetchval(
+        "INSERT INTO regions (region_name) VALUES ('Incremental') RETURNING region_id"
+    )
+    trip = TripCreate(
+        region_id=region_id,
+        origin=(0.101, 0.101),
+        destination=(0.2, 0.2),
+        timestamp=datetime(2023, 4, 3, 8, 5),
+        source="first",
+    )
+
+    try:
+        first = await TripsRepository.create_multiple([trip], test_pool, 0.01, 30)
+        second = await TripsRepository.create_multiple(
+            [
+                trip.model_copy(update={"timestamp": datetime(2023, 4, 4, 8, 25), "source": "same"}),
+                trip.model_copy(update={"timestamp": datetime(2023, 4, 4, 9, 25), "source": "other"}),
+            ],
+            test_pool,
+            0.01,
+            30,
+        )
+        assert first is not None and second is not None
+
+        # The new batch joins the existing group instead of creating another one
+        assert first[0].group_id is not None
+        assert second[0].group_id == first[0].group_id
+        assert second[1].group_id != first[0].group_id
+
+        sizes = await test_db.fetch(
+            """
+            SELECT g.size, COUNT(t.trip_id) AS trips
+            FROM trip_groups g LEFT JOIN trips t USING (group_id)
+            WHERE g.region_id = $1
+            GROUP BY g.group_id
+            """,
+            region_id,
+        )
+        assert sorted(row["size"] for row in sizes) == [1, 2]
+        assert all(row["size"] == row["trips"] for row in sizes)
+
+        # A full recompute with the same thresholds agrees with the incremental one
+        assigned = await _groups_by_source(test_db, region_id)
+        await cluster_trips_task([region_id], 0.01, 30, pool=test_pool)
+        assert await _groups_by_source(test_db, region_id) == assigned
+    finally:
+        await test_db.execute("TRUNCATE TABLE regions, trips, trips_weekly_cells, trip_groups")
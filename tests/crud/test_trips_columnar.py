@@ -0,0 +1,127 @@
+import random
+from datetime import datetime, timedelta
+
+import asyncpg
+import pytest
+import pytest_asyncio
+
+from optimized_shifts.columnar import TripsColumnStore
+from optimized_shifts.crud.region import RegionRepository
+from optimized_shifts.crud.trips import TripsRepository
+from optimized_shifts.schemas.trip import TripCreate
+
+
+def random_trips(region_id: int, count: int, seed: int) -> list[TripCreate]:
+    rng = random.Random(seed)
+    start = datetime(2023, 1, 1)
+    return [
+        TripCreate(
+            region_id=region_id,
+            origin=(rng.uniform(0, 2), rng.uniform(0, 2)),
+            destination=(rng.uniform(0, 2), rng.uniform(0, 2)),
+            timestamp=start + timedelta(seconds=rng.randrange(60 * 60 * 24 * 90)),
+            source="columnar",
+        )
+        for _ in range(count)
+    ]
+
+
+@pytest_asyncio.fixture  # type: ignore # noqa
+async def regions(test_pool: "asyncpg.Pool[asyncpg.Record]"):
+    # Other tests may leave trips behind, the store reads every region
+    await test_pool.execute("TRUNCATE TABLE regions, trips, trips_weekly_cells, trip_groups")
+    regions = await RegionRepository.get_or_create_multiple({"Turin", "Hamburg"}, test_pool)
+    await TripsRepository.create_multiple(random_trips(regions["Turin"], 2_000, 0), test_pool)
+    await TripsRepository.create_multiple(random_trips(regions["Hamburg"], 500, 1), test_pool)
+
+    yield regions
+
+    await test_pool.execute("TRUNCATE TABLE regions, trips, trips_weekly_cells, trip_groups")
+
+
+@pytest.mark.asyncio
+async def test_column_store_matches_sql(
+    test_pool: "asyncpg.Pool[asyncpg.Record]", regions: dict[str, int]
+):
+    store = TripsColumnStore(grid_size=0.25, load_batch=700)
+    await store.load(test_pool)
+    assert len(store) == 2_500
+
+    rng = random.Random(2)
+    for _ in range(30):
+        x, y = rng.uniform(-0.5, 2), rng.uniform(-0.5, 2)
+        bbox = ((x, y), (x + rng.uniform(0, 2), y + rng.uniform(0, 2)))
+        since = rng.choice([None, datetime(2023, 2, 1, 13)])
+        until = rng.choice([None, datetime(2023, 3, 8)])
+
+        for region_id in regions.values():
+            expected = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
+                bbox, region_id, test_pool, since, until
+            )
+            result = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
+                bbox, region_id, test_pool, since, until, store
+            )
+            assert result.source == "columnar"
+            assert result.mean == pytest.approx(expected.mean)
+
+
+@pytest.mark.asyncio
+async def test_column_store_refreshes_new_trips(
+    test_pool: "asyncpg.Pool[asyncpg.Record]", regions: dict[str, int]
+):
+    store = TripsColumnStore(grid_size=0.25, delta_rows=150)
+    await store.load(test_pool)
+    bbox = ((0, 0), (2, 2))
+
+    for seed in (3, 4):
+        await TripsRepository.create_multiple(random_trips(regions["Hamburg"], 100, seed), test_pool)
+        await store.refresh(test_pool)
+        # Trips already read are not read again
+        await store.refresh(test_pool)
+
+        expected = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
+            bbox, regions["Hamburg"], test_pool
+        )
+        assert store.weekly_average(bbox, regions["Hamburg"]) == pytest.approx(expected.mean)
+
+    # The second refresh exceeded delta_rows and merged the new trips into the sorted ones
+    assert len(store) == 2_700
+    assert len(store._snapshot.delta) == 0
+
+
+@pytest.mark.asyncio
+async def test_column_store_refreshes_trips_committed_out_of_order(
+    test_pool: "asyncpg.Pool[asyncpg.Record]", regions: dict[str, int]
+):
+    store = TripsColumnStore(grid_size=0.25)
+    await store.load(test_pool)
+    bbox = ((0, 0), (2, 2))
+    stmt = """
+    INSERT INTO trips (region_id, origin, destination, timestamp, source)
+    SELECT $1, point(1, 1), point(1.5, 1.5), '2023-01-10'::timestamp, 'columnar'
+    FROM generate_series(1, $2)
+    RETURNING trip_id
+    """
+
+    async with test_pool.acquire() as first, test_pool.acquire() as second:
+        transaction = first.transaction()
+        await transaction.start()
+        lower = await first.fetch(stmt, regions["Hamburg"], 30)
+        higher = await second.fetch(stmt, regions["Hamburg"], 20)
+        assert max(row["trip_id"] for row in lower) < min(row["trip_id"] for row in higher)
+
+        await store.refresh(test_pool)
+        assert len(store) == 2_520
+
+        # The trips with lower ids are committed after the store read the higher ones
+        await transaction.commit()
+
+    await store.refresh(test_pool)
+    assert len(store) == 2_550
+
+    # The trips are inserted without their weekly cells, a full load is the reference
+    loaded = TripsColumnStore(grid_size=0.25)
+    await loaded.load(test_pool)
+    assert store.weekly_average(bbox, regions["Hamburg"]) == pytest.approx(
+        loaded.weekly_average(bbox, regions["Hamburg"])
+    )
@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytest_asyncio
+
+from optimized_shifts.crud.trips import SINGLE_BBOX_COLUMNS, TripsRepository, _weekly_average_stmt
+from optimized_shifts.state import Database, DatabaseConnection
+
+
+@pytest_asyncio.fixture  # type: ignore # noqa
+async def region_with_trips(test_db: DatabaseConnection):
+    region_id = await test_db.fetchval(
+        "INSERT INTO regions (region_name) VALUES ('Indexed') RETURNING region_id"
+    )
+    await test_db.execute(
+        "SELECT ensure_trips_partitions($1, $2)", datetime(2023, 1, 1), datetime(2023, 3, 31)
+    )
+    await test_db.copy_records_to_table(
+        "trips",
+        records=[
+            (
+                region_id,
+                (i % 100 / 10, i // 100 / 10),
+                (i % 50 / 10, i // 50 / 10),
+                datetime(2023, 1, 1) + timedelta(hours=i),
+                "index_test",
+            )
+            for i in range(2000)
+        ],
+        columns=["region_id", "origin", "destination", "timestamp", "source"],
+    )
+    await test_db.execute(
+        """
+        INSERT INTO trips_weekly_cells
+        SELECT region_id, DATE_TRUNC('week', timestamp), trips_grid_cell(origin[0]),
+            trips_grid_cell(origin[1]), trips_grid_cell(destination[0]),
+            trips_grid_cell(destination[1]), COUNT(*)
+        FROM trips
+        WHERE region_id = $1
+        GROUP BY 1, 2, 3, 4, 5, 6
+        """,
+        region_id,
+    )
+    await test_db.execute("ANALYZE trips")
+
+    yield region_id
+
+    await test_db.execute("TRUNCATE TABLE regions, trips, trips_weekly_cells")
+
+
+@pytest.mark.asyncio
+async def test_weekly_average_uses_spatial_index(
+    test_db: DatabaseConnection, region_with_trips: int
+):
+    args: list[object] = [1.0, 1.0, 2.0, 2.0, region_with_trips]
+    stmt = _weekly_average_stmt(SINGLE_BBOX_COLUMNS, args, None, None)
+
+    # Seq scans are discouraged so the plan shows whether the indexes can be used at all
+    await test_db.execute("SET enable_seqscan = off")
+    try:
+        rows = await test_db.fetch(f"EXPLAIN {stmt}", *args)
+    finally:
+        await test_db.execute("RESET enable_seqscan")
+
+    plan = "\n".join(row[0] for row in rows)
+
+    # The edge cells of the bbox are counted from the trips
+    assert "Seq Scan on trips" not in plan, plan
+    # Each partition has its own copy of the indexes, named after the partition
+    assert "_origin_idx" in plan or "_destination_idx" in plan, plan
+
+
+@pytest.mark.asyncio
+async def test_weekly_average_filters_by_bbox(
+    test_db: DatabaseConnection, test_pool: Database, region_with_trips: int
+):
+    avg = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
+        ((0.0, 0.0), (0.45, 0.1)), region_with_trips, test_pool
+    )
+    expected = await test_db.fetchval(
+        """
+        SELECT AVG(count) FROM (
+            SELECT COUNT(*) FROM trips
+            WHERE origin[0] BETWEEN 0.0 AND 0.45 AND origin[1] BETWEEN 0.0 AND 0.1 AND
+                destination[0] BETWEEN 0.0 AND 0.45 AND destination[1] BETWEEN 0.0 AND 0.1 AND
+                region_id = $1
+            GROUP BY DATE_TRUNC('week', timestamp)
+        ) AS weekly_count
+        """,
+        region_with_trips,
+    )
+
+    assert expected is not None
+    assert avg.mean == pytest.approx(float(expected))
@@ -0,0 +1,171 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytest_asyncio
+
+from optimized_shifts.crud.trips import (
+    RAW_SINCE,
+    RAW_UNTIL,
+    ROLLUP_SINCE,
+    ROLLUP_UNTIL,
+    SINGLE_BBOX_COLUMNS,
+    WEEKLY_AVERAGE_ROLLUP_STMT,
+    TripsRepository,
+)
+from optimized_shifts.schemas.trip import TripCreate
+from optimized_shifts.state import Database, DatabaseConnection
+
+
+@pytest_asyncio.fixture  # type: ignore # noqa
+async def partitioned_region(test_db: DatabaseConnection, test_pool: Database):
+    region_id = await test_db.fetchval(
+        "INSERT INTO regions (region_name) VALUES ('Partitioned') RETURNING region_id"
+    )
+
+    await TripsRepository.create_multiple(
+        [
+            TripCreate(
+                region_id=region_id,
+                origin=(i % 10 / 10, i % 7 / 10),
+                destination=(i % 5 / 10, i % 3 / 10),
+                timestamp=datetime(2022, 1, 1) + timedelta(days=i),
+                source="partition_test",
+            )
+            for i in range(90)
+        ],
+        test_pool,
+    )
+
+    yield region_id
+
+    await test_db.execute("TRUNCATE TABLE regions, trips, trips_weekly_cells")
+
+
+async def _partitions(test_db: DatabaseConnection) -> set[str]:
+    rows = await test_db.fetch(
+        "SELECT inhrelid::regclass::text AS name FROM pg_inherits WHERE inhparent = 'trips'::regclass"
+    )
+    return {row["name"] for row in rows}
+
+
+@pytest.mark.asyncio
+async def test_create_multiple_creates_monthly_partitions(
+    test_db: DatabaseConnection, partitioned_region: int
+):
+    partitions = await _partitions(test_db)
+
+    assert {"trips_2022_01", "trips_2022_02", "trips_2022_03"} <= partitions
+    assert await test_db.fetchval("SELECT COUNT(*) FROM trips_default") == 0
+    assert await test_db.fetchval("SELECT COUNT(*) FROM trips_2022_02") == 28
+
+
+@pytest.mark.asyncio
+async def test_ensure_partitions_moves_rows_out_of_default_partition(
+    test_db: DatabaseConnection, partitioned_region: int
+):
+    await test_db.execute(
+        "INSERT INTO trips (region_id, origin, destination, timestamp) VALUES ($1, $2, $3, $4)",
+        partitioned_region,
+        (0.1, 0.1),
+        (0.2, 0.2),
+        datetime(2021, 6, 15),
+    )
+    assert await test_db.fetchval("SELECT COUNT(*) FROM trips_default") == 1
+
+    await test_db.execute(
+        "SELECT ensure_trips_partitions($1, $2)", datetime(2021, 6, 1), datetime(2021, 6, 1)
+    )
+
+    assert await test_db.fetchval("SELECT COUNT(*) FROM trips_default") == 0
+    assert await test_db.fetchval("SELECT COUNT(*) FROM trips_2021_06") == 1
+
+
+@pytest.mark.asyncio
+async def test_weekly_average_with_period_only_reads_its_partitions(
+    test_db: DatabaseConnection, partitioned_region: int
+):
+    stmt = WEEKLY_AVERAGE_ROLLUP_STMT.format(
+        **SINGLE_BBOX_COLUMNS,
+        rollup_period=f"{ROLLUP_SINCE.format(6)} {ROLLUP_UNTIL.format(7)}",
+        raw_period=f"{RAW_SINCE.format(6)} {RAW_UNTIL.format(7)}",
+    )
+    rows = await test_db.fetch(
+        f"EXPLAIN {stmt}",
+        0.0,
+        0.0,
+        1.0,
+        1.0,
+        partitioned_region,
+        datetime(2022, 2, 9),
+        datetime(2022, 2, 16),
+    )
+    plan = "\n".join(row[0] for row in rows)
+
+    assert "trips_2022_02" in plan, plan
+    assert "trips_2022_01" not in plan, plan
+    assert "trips_2022_03" not in plan, plan
+    assert "trips_default" not in plan, plan
+
+
+@pytest.mark.asyncio
+async def test_weekly_average_with_period_matches_filtered_rows(
+    test_db: DatabaseConnection, test_pool: Database, partitioned_region: int
+):
+    since, until = datetime(2022, 1, 20), datetime(2022, 2, 20)
+
+    avg = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
+        ((0.0, 0.0), (1.0, 1.0)), partitioned_region, test_pool, since, until
+    )
+    expected = await test_db.fetchval(
+        """
+        SELECT AVG(count) FROM (
+            SELECT COUNT(*) FROM trips
+            WHERE region_id = $1 AND
+                DATE_TRUNC('week', timestamp) BETWEEN DATE_TRUNC('week', $2::timestamp) AND DATE_TRUNC('week', $3::timestamp)
+            GROUP BY DATE_TRUNC('week', timestamp)
+        ) AS weekly_count
+        """,
+        partitioned_region,
+        since,
+        until,
+    )
+
+    assert avg.mean == pytest.approx(float(expected))
+
+
+@pytest.mark.asyncio
+async def test_attach_preloaded_partition(
+    test_db: DatabaseConnection, partitioned_region: int
+):
+    await test_db.execute("CREATE TABLE trips_preloaded (LIKE trips INCLUDING DEFAULTS)")
+    await test_db.copy_records_to_table(
+        "trips_preloaded",
+        records=[
+            (
+                partitioned_region,
+                (0.5, 0.5),
+                (0.6, 0.6),
+                datetime(2022, 6, 1) + timedelta(hours=i),
+                "preloaded",
+            )
+            for i in range(100)
+        ],
+        columns=["region_id", "origin", "destination", "timestamp", "source"],
+    )
+
+    attached = await test_db.fetchval(
+        "SELECT attach_trips_partition('trips_preloaded', $1)", datetime(2022, 6, 1)
+    )
+
+    assert attached == 100
+    assert "trips_preloaded" in await _partitions(test_db)
+    assert (
+        await test_db.fetchval("SELECT COUNT(*) FROM trips WHERE source = 'preloaded'")
+        == 100
+    )
+    assert (
+        await test_db.fetchval(
+            "SELECT SUM(count) FROM trips_weekly_cells WHERE week >= '2022-05-30'"
+        )
+        == 100
+    )
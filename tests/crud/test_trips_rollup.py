@@ -0,0 +1,130 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+import pytest_asyncio
+
+from optimized_shifts.crud.trips import TripsRepository
+from optimized_shifts.schemas.trip import TripCreate
+from optimized_shifts.state import Database, DatabaseConnection
+
+# Weekly average read from the trips alone, the reference the rollup is compared against
+WEEKLY_AVERAGE_STMT = """
+    SELECT AVG(count) AS result
+    FROM (
+        SELECT COUNT(*)
+        FROM trips
+        WHERE origin <@ box(point($1, $2), point($3, $4)) AND
+            destination <@ box(point($1, $2), point($3, $4)) AND
+            region_id = $5
+        GROUP BY DATE_TRUNC('week', timestamp)
+    ) AS weekly_count
+"""
+
+
+@pytest_asyncio.fixture  # type: ignore # noqa
+async def rollup_region(test_db: DatabaseConnection, test_pool: Database):
+    region_id = await test_db.fetchval(
+        "INSERT INTO regions (region_name) VALUES ('Rollup') RETURNING region_id"
+    )
+
+    rng = random.Random(7)
+    trips = [
+        TripCreate(
+            region_id=region_id,
+            origin=(rng.uniform(0.0, 0.2), rng.uniform(0.0, 0.2)),
+            destination=(rng.uniform(0.0, 0.2), rng.uniform(0.0, 0.2)),
+            timestamp=datetime(2023, 1, 1) + timedelta(hours=rng.randint(0, 24 * 60)),
+            source="rollup_test",
+        )
+        for _ in range(3000)
+    ]
+    # Inserted in several batches so the rollup holds repeated keys
+    for i in range(0, len(trips), 1000):
+        await TripsRepository.create_multiple(trips[i : i + 1000], test_pool)
+
+    yield region_id
+
+    await test_db.execute("TRUNCATE TABLE regions, trips, trips_weekly_cells")
+
+
+@pytest.mark.asyncio
+async def test_create_multiple_updates_weekly_cells(
+    test_db: DatabaseConnection, rollup_region: int
+):
+    counted = await test_db.fetchval(
+        "SELECT SUM(count) FROM trips_weekly_cells WHERE region_id = $1", rollup_region
+    )
+
+    assert counted == 3000
+
+
+@pytest.mark.asyncio
+async def test_weekly_average_from_rollup_matches_raw_rows(
+    test_db: DatabaseConnection, test_pool: Database, rollup_region: int
+):
+    bboxes = [
+        ((0.0, 0.0), (0.2, 0.2)),
+        ((0.01, 0.02), (0.15, 0.19)),
+        ((0.013, 0.027), (0.1555, 0.1999)),
+        ((0.05, 0.05), (0.051, 0.059)),
+        ((0.15, 0.19), (0.013, 0.027)),
+    ]
+
+    for p, q in bboxes:
+        avg = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
+            (p, q), rollup_region, test_pool
+        )
+        px, qx = sorted((p[0], q[0]))
+        py, qy = sorted((p[1], q[1]))
+        expected = await test_db.fetchval(
+            WEEKLY_AVERAGE_STMT, px, py, qx, qy, rollup_region
+        )
+
+        if expected is None:
+            assert avg.mean is None, (p, q)
+        else:
+            assert avg.mean == pytest.approx(float(expected)), (p, q)
+
+
+@pytest.mark.asyncio
+async def test_weekly_average_reports_source(test_pool: Database, rollup_region: int):
+    # Bbox inside a single cell, there are no complete cells to read from the rollup
+    small = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
+        ((0.051, 0.051), (0.059, 0.059)), rollup_region, test_pool
+    )
+    assert small.source == "raw"
+
+    # Bbox with complete cells and trips in the edge cells
+    large = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
+        ((0.0, 0.0), (0.2, 0.2)), rollup_region, test_pool
+    )
+    assert large.source == "mixed"
+
+
+@pytest.mark.asyncio
+async def test_compact_weekly_cells_keeps_counts(
+    test_db: DatabaseConnection, rollup_region: int
+):
+    before = await test_db.fetch(
+        """
+        SELECT week, origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, SUM(count) AS count
+        FROM trips_weekly_cells WHERE region_id = $1
+        GROUP BY 1, 2, 3, 4, 5
+        ORDER BY 1, 2, 3, 4, 5
+        """,
+        rollup_region,
+    )
+
+    await test_db.execute("SELECT compact_trips_weekly_cells($1)", rollup_region)
+
+    after = await test_db.fetch(
+        """
+        SELECT week, origin_cell_x, origin_cell_y, destination_cell_x, destination_cell_y, count
+        FROM trips_weekly_cells WHERE region_id = $1
+        ORDER BY 1, 2, 3, 4, 5
+        """,
+        rollup_region,
+    )
+
+    assert [tuple(row) for row in after] == [tuple(row) for row in before]
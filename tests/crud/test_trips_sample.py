@@ -0,0 +1,194 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+import pytest_asyncio
+
+from optimized_shifts.crud.trips import TripsRepository
+from optimized_shifts.schemas.trip import TripCreate
+from optimized_shifts.state import Database, DatabaseConnection
+
+
+@pytest_asyncio.fixture  # type: ignore # noqa
+async def sample_region(test_db: DatabaseConnection):
+    await test_db.execute("TRUNCATE TABLE regions, trips, trips_weekly_cells, trips_sample")
+    region_id = await test_db.fetchval(
+        "INSERT INTO regions (region_name) VALUES ('Sample') RETURNING region_id"
+    )
+
+    yield region_id
+
+    await test_db.execute("TRUNCATE TABLE regions, trips, trips_weekly_cells, trips_sample")
+
+
+@pytest.mark.asyncio
+async def test_create_multiple_samples_the_inserted_trips(
+    test_db: DatabaseConnection, test_pool: Database, sample_region: int
+):
+    rng = random.Random(3)
+    trips = [
+        TripCreate(
+            region_id=sample_region,
+            origin=(rng.uniform(0, 1), rng.uniform(0, 1)),
+            destination=(rng.uniform(0, 1), rng.uniform(0, 1)),
+            timestamp=datetime(2023, 1, 1) + timedelta(hours=rng.randint(0, 24 * 60)),
+            source="sample_test",
+        )
+        for _ in range(4000)
+    ]
+    await TripsRepository.create_multiple(trips, test_pool)
+
+    # 250 trips are expected in the sample, far more than 6 standard deviations away is a bug
+    sampled = await test_db.fetchval("SELECT COUNT(*) FROM trips_sample WHERE region_id = $1", sample_region)
+    assert 160 < sampled < 340
+
+    await test_db.execute("SELECT rebuild_trips_sample()")
+    sampled = await test_db.fetchval("SELECT COUNT(*) FROM trips_sample WHERE region_id = $1", sample_region)
+    assert 160 < sampled < 340
+
+
+@pytest.mark.asyncio
+async def test_estimate_from_the_smallest_sample_within_the_error(
+    test_db: DatabaseConnection, test_pool: Database, sample_region: int
+):
+    # 2000 trips at the deepest level stand for 2000 * 16^3 trips in two weeks
+    await test_db.execute(
+        """
+        INSERT INTO trips_sample
+        SELECT $1, point(0.5, 0.5), point(0.6, 0.6), $2::timestamp + (i % 2) * INTERVAL '1 week', 3
+        FROM generate_series(1, 2000) AS i
+        """,
+        sample_region,
+        datetime(2023, 1, 2),
+    )
+    await test_db.execute(
+        """
+        INSERT INTO trips_weekly_cells
+        SELECT $1, $2::timestamp + i * INTERVAL '1 week', 50, 50, 60, 60, 1000 * 16^3
+        FROM generate_series(0, 1) AS i
+        """,
+        sample_region,
+        datetime(2023, 1, 2),
+    )
+    bbox = ((0, 0), (1, 1))
+
+    estimate = await TripsRepository.get_count_weekly_estimate_by_bbox_and_region(
+        bbox, sample_region, test_pool, 0.05
+    )
+    assert estimate.source == "sample"
+    assert estimate.sample_rate == 16**-3
+    assert estimate.mean == pytest.approx(1000 * 16**3)
+    assert estimate.lower < estimate.mean < estimate.upper  # type: ignore
+    assert estimate.upper - estimate.mean <= 0.05 * estimate.mean  # type: ignore
+
+    # Half of the sample is left in the second week, a larger error is needed
+    estimate = await TripsRepository.get_count_weekly_estimate_by_bbox_and_region(
+        bbox, sample_region, test_pool, 0.1, since=datetime(2023, 1, 9)
+    )
+    assert estimate.source == "sample"
+    assert estimate.mean == pytest.approx(1000 * 16**3)
+
+    # No sample is large enough for this error, the exact mean is read from the weekly cells
+    estimate = await TripsRepository.get_count_weekly_estimate_by_bbox_and_region(
+        bbox, sample_region, test_pool, 0.01
+    )
+    assert estimate.source == "rollup"
+    assert estimate.sample_rate == 1
+    assert estimate.mean == 1000 * 16**3
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("weekly_trips, max_error", [(200, 0.1), (44, 0.05)])
+async def test_estimate_intervals_cover_the_mean_of_sparse_samples(
+    test_db: DatabaseConnection,
+    test_pool: Database,
+    sample_region: int,
+    weekly_trips: int,
+    max_error: float,
+):
+    # Ten years of trips, sparse enough that many weeks have no trip in the sample
+    await test_db.execute(
+        """
+        INSERT INTO trips (region_id, origin, destination, timestamp, source)
+        SELECT $1, point(0.5, 0.5), point(0.6, 0.6), $2::timestamp + i * INTERVAL '1 hour' * 168 / $3, 'sparse'
+        FROM generate_series(0, 520 * $3 - 1) AS i
+        """,
+        sample_region,
+        datetime(2013, 1, 7),
+        weekly_trips,
+    )
+    await test_db.execute(
+        """
+        INSERT INTO trips_weekly_cells
+        SELECT region_id, DATE_TRUNC('week', timestamp), 50, 50, 60, 60, COUNT(*)
+        FROM trips
+        GROUP BY 1, 2
+        """
+    )
+
+    covered = 0
+    for seed in range(20):
+        # The sample depends on random(), seeded on the connection that rebuilds it
+        await test_db.execute("SELECT setseed($1)", seed / 20)
+        await test_db.execute("SELECT rebuild_trips_sample()")
+
+        estimate = await TripsRepository.get_count_weekly_estimate_by_bbox_and_region(
+            ((0, 0), (1, 1)), sample_region, test_pool, max_error
+        )
+        covered += estimate.lower <= weekly_trips <= estimate.upper  # type: ignore
+
+    # 19 of 20 intervals are expected to cover the mean, a biased estimator covers none
+    assert covered >= 16
+
+
+@pytest.mark.asyncio
+async def test_estimate_bbox_smaller_than_a_cell_from_the_sample(
+    test_db: DatabaseConnection, test_pool: Database, sample_region: int
+):
+    # Ten weeks of 16000 trips spread over a single cell of the grid
+    await test_db.execute("SELECT setseed(0.5)")
+    await test_db.execute(
+        """
+        INSERT INTO trips (region_id, origin, destination, timestamp, source)
+        SELECT
+            $1,
+            point(0.5 + random() * 0.01, 0.5 + random() * 0.01),
+            point(0.5 + random() * 0.01, 0.5 + random() * 0.01),
+            $2::timestamp + (i % 10) * INTERVAL '1 week',
+            'sub_cell'
+        FROM generate_series(1, 160000) AS i
+        """,
+        sample_region,
+        datetime(2023, 1, 2),
+    )
+    await test_db.execute(
+        """
+        INSERT INTO trips_weekly_cells
+        SELECT
+            region_id,
+            DATE_TRUNC('week', timestamp),
+            trips_grid_cell(origin[0]),
+            trips_grid_cell(origin[1]),
+            trips_grid_cell(destination[0]),
+            trips_grid_cell(destination[1]),
+            COUNT(*)
+        FROM trips
+        GROUP BY 1, 2, 3, 4, 5, 6
+        """
+    )
+    await test_db.execute("SELECT rebuild_trips_sample()")
+
+    # A quarter of the cell, 1/16 of the trips have both points in it
+    bbox = ((0.5, 0.5), (0.505, 0.505))
+    exact = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
+        bbox, sample_region, test_pool
+    )
+    estimate = await TripsRepository.get_count_weekly_estimate_by_bbox_and_region(
+        bbox, sample_region, test_pool, 0.1
+    )
+
+    assert estimate.source == "sample"
+    assert estimate.sample_rate == 16**-1
+    assert estimate.lower < estimate.mean < estimate.upper  # type: ignore
+    assert estimate.upper - estimate.mean <= 0.1 * estimate.mean  # type: ignore
+    assert estimate.lower <= exact.mean <= estimate.upper  # type: ignore
@@ -0,0 +1,56 @@
+import random
+
+import pytest
+
+from optimized_shifts.celery.shards import ShardRouter
+from optimized_shifts.crud.region import RegionRepository
+from optimized_shifts.crud.trips import TripsRepository
+from tests.crud.test_trips_columnar import random_trips
+
+
+@pytest.mark.asyncio
+async def test_regions_are_balanced_between_shards_and_copied_into_them(shards: ShardRouter):
+    regions = await RegionRepository.get_or_create_multiple(
+        {"Turin", "Hamburg", "Prague", "Bremen"}, shards.metadata, shards
+    )
+    assigned = await shards.shards_of(regions.values())
+    assert sorted(assigned.values()) == [0, 0, 1, 1]
+
+    copied = await shards.pools[1].fetch("SELECT region_id, region_name FROM regions")
+    assert {row["region_name"]: row["region_id"] for row in copied} == {
+        name: region_id for name, region_id in regions.items() if assigned[region_id] == 1
+    }
+
+    # Assignments are read back from region_shards by other processes
+    other = ShardRouter(shards.metadata, shards.pools)
+    assert await other.shards_of(regions.values()) == assigned
+
+
+@pytest.mark.asyncio
+async def test_trips_are_read_and_written_in_the_shard_of_their_region(shards: ShardRouter):
+    regions = await RegionRepository.get_or_create_multiple({"Turin", "Hamburg"}, shards.metadata, shards)
+    trips = random_trips(regions["Turin"], 300, 0) + random_trips(regions["Hamburg"], 200, 1)
+    random.Random(2).shuffle(trips)
+
+    inserted = await TripsRepository.create_multiple(trips, shards.metadata, shards=shards)
+    assert len(inserted or []) == 500
+
+    for name, count in (("Turin", 300), ("Hamburg", 200)):
+        pool = await shards.pool(regions[name])
+        assert await pool.fetchval("SELECT COUNT(*) FROM trips WHERE region_id = $1", regions[name]) == count
+        assert await pool.fetchval(
+            "SELECT SUM(count) FROM trips_weekly_cells WHERE region_id = $1", regions[name]
+        ) == count
+
+    bboxes = [((0.1, 0.2), (1.8, 1.9)), ((0, 0), (2, 2)), ((1, 1), (0.5, 0.3))]
+    queries = [(bbox, region_id) for bbox in bboxes for region_id in regions.values()]
+    batch = await TripsRepository.get_count_weekly_average_by_bboxes(queries, shards.metadata, shards=shards)
+    for (bbox, region_id), result in zip(queries, batch):
+        pool = await shards.pool(region_id)
+        expected = await TripsRepository.get_count_weekly_average_by_bbox_and_region(bbox, region_id, pool)
+        assert result.mean == pytest.approx(expected.mean)
+
+        single = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
+            bbox, region_id, shards.metadata, shards=shards
+        )
+        assert single.mean == pytest.approx(expected.mean)
@@ -0,0 +1,13 @@
+import pytest
+
+from optimized_shifts.celery.database import get_pool
+
+
+@pytest.mark.asyncio
+async def test_worker_pool_is_reused_between_tasks():
+    pool = await get_pool()
+
+    assert pool is await get_pool()
+
+    async with pool.acquire() as conn:
+        assert await conn.fetchval("SELECT 1") == 1
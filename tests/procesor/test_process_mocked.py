@@ -1,8 +1,13 @@
 import tempfile
+from datetime import datetime
 
+import pandas as pd
 import pytest
 
-from optimized_shifts.celery.tasks import process_data_task
+from optimized_shifts.celery.cloud.buckets import DataProcesorFactory
+from optimized_shifts.celery.shards import ShardRouter
+from optimized_shifts.celery.tasks import insert_trips, process_data_task
+from optimized_shifts.crud.region import RegionRepository
 from optimized_shifts.state import DatabaseConnection
 
 
@@ -31,3 +36,237 @@ Prague,POINT (14.32427345662177 50.00002074358429),POINT (14.47767895969969 50.0
 
     finally:
         csv.close()
+
+
+@pytest.mark.asyncio
+async def test_process_mocked_csv_in_chunks(test_db: DatabaseConnection):
+    csv = tempfile.NamedTemporaryFile(mode="w", encoding="utf-8")
+    try:
+        csv.write(
+            """region,origin_coord,destination_coord,datetime,datasource
+Hamburg,POINT (9.787455838019875 53.63248750881082),POINT (9.952829082918497 53.6168131103541),2018-05-06 01:01:28,cheap_mobile
+Hamburg,POINT (10.07149105254751 53.56269091054201),POINT (10.01811787209153 53.66542006950087),2018-05-29 23:00:56,cheap_mobile
+Hamburg,POINT (9.92094432063025 53.63201802432398),POINT (9.930148315113082 53.53573232787218),2018-05-17 12:07:54,baba_car
+Stuttgart,POINT (9.22092316838693 48.75287706839298),POINT (9.1338512201045 48.71891648012767),2018-05-15 13:21:45,funny_car
+Stuttgart,POINT (9.18391853831226 48.77022516287567),POINT (9.13808573412354 48.69879958622434),2018-05-20 19:39:10,cheap_mobile"""
+        )
+        csv.seek(0)
+
+        before = await test_db.fetchval("SELECT count(*) FROM trips")
+        inserted = await process_data_task("mocked", csv.name, chunksize=2)
+
+        assert inserted is not None
+        assert inserted.rows == 5
+
+        after = await test_db.fetchval("SELECT count(*) FROM trips")
+        assert after - before == 5
+
+        rows = await test_db.fetch(
+            "SELECT region_name FROM regions WHERE region_name IN ('Hamburg', 'Stuttgart')"
+        )
+        assert len(rows) == 2
+
+    finally:
+        csv.close()
+
+
+@pytest.mark.asyncio
+async def test_insert_trips_only_returns_rows_when_asked(test_db: DatabaseConnection):
+    region_id = await test_db.fetchval(
+        "INSERT INTO regions (region_name) VALUES ('Bremen') RETURNING region_id"
+    )
+    df = pd.DataFrame(
+        {
+            "region": ["Bremen", "Bremen"],
+            "origin_x": [8.8, 8.7],
+            "origin_y": [53.1, 53.0],
+            "destination_x": [8.9, 8.6],
+            "destination_y": [53.2, 53.1],
+            "timestamp": pd.to_datetime(["2018-05-01 10:00:00", "2018-05-02 11:30:00"]),
+            "source": ["funny_car", None],
+        }
+    )
+
+    copied = await insert_trips(test_db, df, {"Bremen": region_id})
+    assert copied is None
+
+    returned = await insert_trips(test_db, df, {"Bremen": region_id}, returning=True)
+    assert returned is not None
+    assert len(returned) == 2
+    assert returned[0].get("origin") == (8.8, 53.1)
+    assert returned[0].get("timestamp") == datetime(2018, 5, 1, 10, 0, 0)
+    assert returned[1].get("source") is None
+
+    count = await test_db.fetchval(
+        "SELECT count(*) FROM trips WHERE region_id = $1", region_id
+    )
+    assert count == 4
+
+
+@pytest.mark.asyncio
+async def test_process_mocked_csv_skips_malformed_points(test_db: DatabaseConnection):
+    csv = tempfile.NamedTemporaryFile(mode="w", encoding="utf-8")
+    try:
+        csv.write(
+            """region,origin_coord,destination_coord,datetime,datasource
+Lisbon,POINT (-9.22092316838693 38.75287706839298),POINT (-9.1338512201045 38.71891648012767),2018-05-15 13:21:45,funny_car
+Lisbon,POINT EMPTY,POINT (-9.13808573412354 38.69879958622434),2018-05-20 19:39:10,cheap_mobile"""
+        )
+        csv.seek(0)
+
+        inserted = await process_data_task("mocked", csv.name)
+
+        assert inserted is not None
+        assert inserted.rows == 1
+
+        row = await test_db.fetchrow(
+            """
+            SELECT t.origin FROM trips t JOIN regions r USING (region_id)
+            WHERE r.region_name = 'Lisbon'
+            """
+        )
+        assert row is not None
+        assert row.get("origin") == (-9.22092316838693, 38.75287706839298)
+
+    finally:
+        csv.close()
+
+
+@pytest.mark.asyncio
+async def test_process_mocked_csv_by_partitions(test_db: DatabaseConnection):
+    csv = tempfile.NamedTemporaryFile(mode="w", encoding="utf-8")
+    try:
+        csv.write("region,origin_coord,destination_coord,datetime,datasource\n")
+        for i in range(50):
+            csv.write(
+                f"Porto,POINT (-8.6{i} 41.1{i}),POINT (-8.5{i} 41.2{i}),2018-05-{1 + i % 28:02d} 10:00:00,part_{i}\n"
+            )
+        csv.flush()
+
+        partitions = DataProcesorFactory.create("mocked").partitions(csv.name, 256)
+
+        assert partitions is not None
+        assert len(partitions) > 1
+        # Partitions are contiguous and cover every row after the header
+        for (_, end), (start, _) in zip(partitions, partitions[1:]):
+            assert end == start
+
+        inserted = 0
+        for byte_range in partitions:
+            processed = await process_data_task(
+                "mocked", csv.name, chunksize=7, byte_range=byte_range
+            )
+            assert processed is not None
+            inserted += processed.rows
+
+        assert inserted == 50
+
+        rows = await test_db.fetch(
+            """
+            SELECT t.source FROM trips t JOIN regions r USING (region_id)
+            WHERE r.region_name = 'Porto'
+            """
+        )
+        assert sorted(row["source"] for row in rows) == sorted(
+            f"part_{i}" for i in range(50)
+        )
+
+    finally:
+        csv.close()
+
+
+@pytest.mark.asyncio
+async def test_process_mocked_csv_creates_monthly_partitions(test_db: DatabaseConnection):
+    csv = tempfile.NamedTemporaryFile(mode="w", encoding="utf-8")
+    try:
+        csv.write(
+            """region,origin_coord,destination_coord,datetime,datasource
+Seville,POINT (5.0 37.3),POINT (5.1 37.4),2019-11-30 10:00:00,funny_car
+Seville,POINT (5.0 37.3),POINT (5.1 37.4),2019-12-01 10:00:00,funny_car
+Seville,POINT (5.0 37.3),POINT (5.1 37.4),2020-01-05 10:00:00,funny_car"""
+        )
+        csv.seek(0)
+        inserted = await process_data_task("mocked", csv.name, chunksize=2)
+
+        assert inserted is not None
+        assert inserted.rows == 3
+
+        # Every chunk is routed to its monthly partition, none is left in the default one
+        assert await test_db.fetchval("SELECT count(*) FROM trips_default") == 0
+        for partition in ("trips_2019_11", "trips_2019_12", "trips_2020_01"):
+            assert await test_db.fetchval(f"SELECT count(*) FROM {partition}") == 1
+
+    finally:
+        csv.close()
+
+
+@pytest.mark.asyncio
+async def test_process_mocked_csv_assigns_groups(test_db: DatabaseConnection):
+    csv = tempfile.NamedTemporaryFile(mode="w", encoding="utf-8")
+    try:
+        csv.write(
+            """region,origin_coord,destination_coord,datetime,datasource
+Valencia,POINT (0.3751 39.4691),POINT (0.3521 39.4811),2019-02-01 07:40:00,funny_car
+Valencia,POINT (0.3755 39.4695),POINT (0.3525 39.4815),2019-02-02 07:50:00,funny_car
+Valencia,POINT (0.3751 39.4691),POINT (0.3521 39.4811),2019-02-01 19:40:00,funny_car"""
+        )
+        csv.seek(0)
+
+        # Ingesting the file twice adds the second batch to the groups of the first one
+        for _ in range(2):
+            await process_data_task(
+                "mocked", csv.name, chunksize=2, cluster_distance=0.01, cluster_time_window=30
+            )
+
+        region_id = await test_db.fetchval(
+            "SELECT region_id FROM regions WHERE region_name = 'Valencia'"
+        )
+        assert (
+            await test_db.fetchval(
+                "SELECT COUNT(*) FROM trips WHERE region_id = $1 AND group_id IS NULL",
+                region_id,
+            )
+            == 0
+        )
+        sizes = await test_db.fetch(
+            "SELECT size FROM trip_groups WHERE region_id = $1 ORDER BY size", region_id
+        )
+        assert [row["size"] for row in sizes] == [2, 4]
+
+    finally:
+        csv.close()
+
+
+@pytest.mark.asyncio
+async def test_process_mocked_csv_split_in_shards(shards: ShardRouter):
+    csv = tempfile.NamedTemporaryFile(mode="w", encoding="utf-8")
+    try:
+        csv.write(
+            """region,origin_coord,destination_coord,datetime,datasource
+Prague,POINT (14.4973794438195 50.00136875782316),POINT (14.43109483523328 50.04052930943246),2018-05-28 09:03:40,funny_car
+Turin,POINT (7.672837913286881 44.9957109242058),POINT (7.720368637535126 45.06782385393849),2018-05-21 02:54:04,baba_car
+Prague,POINT (14.32427345662177 50.00002074358429),POINT (14.47767895969969 50.09339790740321),2018-05-13 08:52:25,cheap_mobile
+Turin,POINT (7.672837913286881 44.9957109242058),POINT (7.720368637535126 45.06782385393849),2018-05-22 02:54:04,baba_car
+Turin,POINT (7.672837913286881 44.9957109242058),POINT (7.720368637535126 45.06782385393849),2018-06-21 02:54:04,baba_car"""
+        )
+        csv.seek(0)
+        inserted = await process_data_task("mocked", csv.name, chunksize=2, shards=shards)
+
+        assert inserted is not None
+        assert inserted.rows == 5
+
+        # Each region is in a different shard, along with its groups
+        regions = await RegionRepository.get_ids_by_name({"Prague", "Turin"}, shards.metadata)
+        assigned = await shards.shards_of(regions.values())
+        assert sorted(assigned.values()) == [0, 1]
+        for name, expected in (("Prague", 2), ("Turin", 3)):
+            region_id = regions[name]
+            pool = shards.pools[assigned[region_id]]
+            count = await pool.fetchval("SELECT COUNT(*) FROM trips WHERE region_id = $1", region_id)
+            assert count == expected
+            assert await pool.fetchval(
+                "SELECT SUM(size) FROM trip_groups WHERE region_id = $1", region_id
+            ) == count
+
+    finally:
+        csv.close()
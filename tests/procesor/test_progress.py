@@ -0,0 +1,76 @@
+import tempfile
+import uuid
+from typing import Any
+
+import pytest
+import redis
+
+from optimized_shifts.celery.config import celeryconfig
+from optimized_shifts.celery.progress import IngestionProgress
+from optimized_shifts.celery.tasks import process_data_task
+from optimized_shifts.state import DatabaseConnection
+
+
+@pytest.fixture
+def progress():
+    r = redis.Redis.from_url(celeryconfig.BROKER_URL)
+    published: list[dict[str, Any]] = []
+
+    progress = IngestionProgress(r, published.append, str(uuid.uuid4()), interval=60)
+    yield progress, published
+
+    progress.finish()
+    r.close()
+
+
+def test_progress_is_aggregated_and_throttled(progress):  # type: ignore
+    progress, published = progress
+    progress.start(total_bytes=1000, partitions=2)
+
+    progress.update(rows_parsed=10, rows_inserted=9, bytes_read=250)
+    progress.update(rows_parsed=10, rows_inserted=10, bytes_read=250)
+
+    # The second update falls inside the interval, only the first one is published
+    [notification] = published
+    assert notification["status"] == "PROGRESS"
+    assert notification["rows_parsed"] == 10
+    assert notification["rows_inserted"] == 9
+    assert notification["bytes_read"] == 250
+    assert notification["total_bytes"] == 1000
+    assert notification["partitions"] == 2
+    assert notification["eta_seconds"] is not None
+
+    values = progress.r.hgetall(progress.key)
+    assert progress.notification(values)["rows_inserted"] == 19
+
+
+@pytest.mark.asyncio
+async def test_process_data_reports_progress_per_chunk(test_db: DatabaseConnection):
+    csv = tempfile.NamedTemporaryFile(mode="w", encoding="utf-8")
+    try:
+        csv.write(
+            """region,origin_coord,destination_coord,datetime,datasource
+Bremen,POINT (8.80 53.07),POINT (8.81 53.08),2018-05-06 01:01:28,cheap_mobile
+Bremen,POINT (8.82 53.09),POINT (8.83 53.10),2018-05-07 02:01:28,cheap_mobile
+Bremen,POINT EMPTY,POINT (8.83 53.10),2018-05-07 02:01:28,cheap_mobile
+Bremen,POINT (8.84 53.11),POINT (8.85 53.12),2018-05-08 03:01:28,baba_car
+"""
+        )
+        csv.flush()
+
+        updates: list[tuple[int, int, int]] = []
+        inserted = await process_data_task(
+            "mocked",
+            csv.name,
+            chunksize=2,
+            on_progress=lambda parsed, rows, read: updates.append((parsed, rows, read)),
+        )
+
+        assert inserted is not None
+        assert len(updates) == 2
+        parsed, rows, read = (sum(column) for column in zip(*updates))
+        assert parsed == 4
+        assert rows == inserted.rows == 3
+        assert 0 < read <= len(open(csv.name, "rb").read())
+    finally:
+        csv.close()
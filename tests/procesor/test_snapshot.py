@@ -0,0 +1,114 @@
+import os
+from unittest import mock
+
+import asyncpg
+import numpy as np
+import pytest
+import pytest_asyncio
+
+from optimized_shifts.celery import processer
+from optimized_shifts.celery.snapshot import current_snapshot, export_snapshot_task
+from optimized_shifts.columnar import TripsColumnStore
+from optimized_shifts.crud.region import RegionRepository
+from optimized_shifts.crud.trips import TripsRepository
+from tests.crud.test_trips_columnar import random_trips
+
+
+@pytest_asyncio.fixture  # type: ignore # noqa
+async def regions(test_pool: "asyncpg.Pool[asyncpg.Record]"):
+    # Other tests may leave trips behind, the store reads every region
+    await test_pool.execute("TRUNCATE TABLE regions, trips, trips_weekly_cells, trip_groups")
+    regions = await RegionRepository.get_or_create_multiple({"Turin", "Hamburg"}, test_pool)
+    await TripsRepository.create_multiple(random_trips(regions["Turin"], 1_000, 0), test_pool)
+    await TripsRepository.create_multiple(random_trips(regions["Hamburg"], 300, 1), test_pool)
+
+    yield regions
+
+    await test_pool.execute("TRUNCATE TABLE regions, trips, trips_weekly_cells, trip_groups")
+
+
+@pytest.mark.asyncio
+async def test_snapshot_is_memory_mapped_by_the_column_store(
+    tmp_path, test_pool: "asyncpg.Pool[asyncpg.Record]", regions: dict[str, int]
+):
+    manifest = await export_snapshot_task(str(tmp_path), 0.25, pool=test_pool)
+    assert manifest["regions"] == {str(regions["Turin"]): 1_000, str(regions["Hamburg"]): 300}
+
+    # Trips inserted after the export are read from the database when the snapshot is loaded
+    await TripsRepository.create_multiple(random_trips(regions["Hamburg"], 50, 2), test_pool)
+
+    store = TripsColumnStore(snapshot_dir=str(tmp_path))
+    await store.load(test_pool)
+
+    assert store.snapshot_path == current_snapshot(str(tmp_path))
+    assert store.grid_size == 0.25
+    assert len(store) == 1_350
+    assert isinstance(store._snapshot.main[regions["Turin"]].segment.ox, np.memmap)
+
+    bbox = ((0.3, 0.2), (1.7, 1.9))
+    for region_id in regions.values():
+        expected = await TripsRepository.get_count_weekly_average_by_bbox_and_region(
+            bbox, region_id, test_pool
+        )
+        assert store.weekly_average(bbox, region_id) == pytest.approx(expected.mean)
+
+
+@pytest.mark.asyncio
+async def test_new_snapshots_replace_the_current_one(
+    tmp_path, test_pool: "asyncpg.Pool[asyncpg.Record]", regions: dict[str, int]
+):
+    await export_snapshot_task(str(tmp_path), 0.25, keep=1, pool=test_pool)
+    first = current_snapshot(str(tmp_path))
+    await export_snapshot_task(str(tmp_path), 0.25, keep=1, pool=test_pool)
+    second = current_snapshot(str(tmp_path))
+
+    assert first != second
+    assert second is not None
+    assert sorted(os.listdir(tmp_path)) == ["CURRENT", os.path.basename(second)]
+
+
+@pytest.mark.asyncio
+async def test_snapshot_loads_trips_committed_out_of_order(
+    tmp_path, test_pool: "asyncpg.Pool[asyncpg.Record]", regions: dict[str, int]
+):
+    stmt = """
+    INSERT INTO trips (region_id, origin, destination, timestamp, source)
+    SELECT $1, point(1, 1), point(1.5, 1.5), '2023-01-10'::timestamp, 'snapshot'
+    FROM generate_series(1, $2)
+    """
+
+    async with test_pool.acquire() as conn:
+        transaction = conn.transaction()
+        await transaction.start()
+        await conn.execute(stmt, regions["Hamburg"], 30)
+        # The export covers trips with higher ids, committed before it
+        await TripsRepository.create_multiple(random_trips(regions["Hamburg"], 20, 2), test_pool)
+        manifest = await export_snapshot_task(str(tmp_path), 0.25, pool=test_pool)
+        await transaction.commit()
+
+    assert manifest["regions"][str(regions["Hamburg"])] == 320
+
+    store = TripsColumnStore(snapshot_dir=str(tmp_path))
+    await store.load(test_pool)
+    assert store.snapshot_path == current_snapshot(str(tmp_path))
+    assert len(store) == 1_350
+
+
+def test_snapshot_exports_are_debounced(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setitem(processer.celery_app.conf, "SNAPSHOT_DIR", "/snapshots")
+    monkeypatch.setitem(processer.celery_app.conf, "SHARD_DATABASES", None)
+    monkeypatch.setitem(processer.celery_app.conf, "SNAPSHOT_INTERVAL", 30)
+    processer.r.delete(processer.SNAPSHOT_PENDING_KEY)
+
+    with mock.patch.object(processer.export_snapshot, "apply_async") as apply_async:
+        for _ in range(3):
+            processer._schedule_snapshot()
+        apply_async.assert_called_once_with(countdown=30)
+
+        # Once the export starts, the next ingestion schedules another
+        with mock.patch.object(processer, "export_snapshot_task", mock.AsyncMock(return_value={})):
+            processer.export_snapshot()
+        processer._schedule_snapshot()
+        assert apply_async.call_count == 2
+
+    processer.r.delete(processer.SNAPSHOT_PENDING_KEY)
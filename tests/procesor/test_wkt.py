@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from optimized_shifts.celery.wkt import parse_points
+
+
+def test_parse_well_formed_points():
+    points = pd.Series(
+        [
+            "POINT (14.4973794438195 50.00136875782316)",
+            "POINT (-9.22092316838693 38.75287706839298)",
+            "POINT (7 45)",
+            "POINT (1e-3 -2.5E2)",
+        ]
+    )
+
+    parsed = parse_points(points)
+
+    assert parsed.x.dtype == np.float64
+    assert parsed.y.dtype == np.float64
+    np.testing.assert_array_equal(
+        parsed.x, [14.4973794438195, -9.22092316838693, 7.0, 0.001]
+    )
+    np.testing.assert_array_equal(
+        parsed.y, [50.00136875782316, 38.75287706839298, 45.0, -250.0]
+    )
+    assert not parsed.malformed.any()
+
+
+def test_parse_flags_malformed_points():
+    points = pd.Series(
+        [
+            "POINT (14.49 50.00)",
+            "POINT EMPTY",
+            "POINT (1.0)",
+            "POINT (1.0 2.0 3.0)",
+            None,
+            "LINESTRING (1 2, 3 4)",
+            "POINT(-0.5 .25)",
+        ]
+    )
+
+    parsed = parse_points(points)
+
+    assert parsed.malformed.tolist() == [False, True, True, True, True, True, False]
+    assert (parsed.x[0], parsed.y[0]) == (14.49, 50.0)
+    assert (parsed.x[6], parsed.y[6]) == (-0.5, 0.25)
+    assert np.isnan(parsed.x[parsed.malformed]).all()
+    assert np.isnan(parsed.y[parsed.malformed]).all()
+
+
+def test_parse_flags_points_that_balance_each_other():
+    points = pd.Series(
+        [
+            "POINT (1 2)",
+            "1 2 POINT () ",
+            "POINT (1_0 2)",
+            "POINT ((1 2",
+            "POINT 3 4))",
+            "POINT (3 4)",
+        ]
+    )
+
+    parsed = parse_points(points)
+
+    assert parsed.malformed.tolist() == [False, True, True, True, True, False]
+    assert (parsed.x[0], parsed.y[0]) == (1.0, 2.0)
+    assert (parsed.x[5], parsed.y[5]) == (3.0, 4.0)
+
+
+@pytest.mark.parametrize("point", ["1 2 POINT () ", "POINT (1_0 2)", "POINT ((1 2"])
+def test_parse_flags_a_single_malformed_row(point: str):
+    parsed = parse_points(pd.Series(["POINT (1 2)", point]))
+
+    assert parsed.malformed.tolist() == [False, True]
+
+
+def test_parse_empty_column():
+    parsed = parse_points(pd.Series([], dtype=object))
+
+    assert len(parsed.x) == len(parsed.y) == len(parsed.malformed) == 0
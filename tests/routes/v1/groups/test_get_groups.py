@@ -0,0 +1,102 @@
+from datetime import datetime
+from urllib.parse import urlencode
+
+import pytest
+import pytest_asyncio
+from httpx import AsyncClient
+
+from optimized_shifts.state import DatabaseConnection
+
+
+@pytest_asyncio.fixture  # type: ignore # noqa
+async def poblate_test_groups(test_db: DatabaseConnection):
+    region_id = await test_db.fetchval(
+        "INSERT INTO regions (region_name) VALUES ('Lyon') RETURNING region_id"
+    )
+    await test_db.execute(
+        "SELECT ensure_trips_partitions($1, $2)", datetime(2023, 1, 1), datetime(2023, 1, 31)
+    )
+    await test_db.executemany(
+        """
+        INSERT INTO trips (region_id, origin, destination, timestamp, source)
+        VALUES ($1, $2, $3, $4, 'test_point')
+        """,
+        [
+            (region_id, (4.831, 45.761), (4.852, 45.748), datetime(2023, 1, 2, 7, 40)),
+            (region_id, (4.834, 45.764), (4.855, 45.742), datetime(2023, 1, 3, 7, 50)),
+            (region_id, (4.831, 45.761), (4.852, 45.748), datetime(2023, 1, 2, 18, 0)),
+        ],
+    )
+    await test_db.execute("SELECT cluster_trips($1, 0.01, 30)", region_id)
+
+    yield
+
+    await test_db.execute("TRUNCATE TABLE regions, trips, trips_weekly_cells, trip_groups, trips_sample")
+
+
+@pytest.mark.asyncio
+async def test_should_fail_if_region_doesnt_exists(test_app: AsyncClient):
+    response = await test_app.get(f"/api/v1/groups?{urlencode({'region': 'Lyon'})}")
+
+    assert response.status_code == 400
+    assert response.json() == {"message": "Region Lyon not found"}
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("poblate_test_groups")
+async def test_should_list_groups_of_a_region_largest_first(test_app: AsyncClient):
+    response = await test_app.get(f"/api/v1/groups?{urlencode({'region': 'Lyon'})}")
+
+    assert response.status_code == 200
+    groups = response.json()["groups"]
+    assert [group["size"] for group in groups] == [2, 1]
+    assert groups[0]["time_from"] == "07:30:00"
+    assert groups[0]["time_to"] == "08:00:00"
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("poblate_test_groups")
+async def test_should_list_trips_of_a_group(test_app: AsyncClient):
+    response = await test_app.get(f"/api/v1/groups?{urlencode({'region': 'Lyon'})}")
+    group = response.json()["groups"][0]
+
+    response = await test_app.get(f"/api/v1/groups/{group['id']}/trips")
+
+    assert response.status_code == 200
+    assert response.json()["group"] == group
+    trips = response.json()["trips"]
+    assert [trip["timestamp"] for trip in trips] == [
+        "2023-01-02T07:40:00",
+        "2023-01-03T07:50:00",
+    ]
+    assert all(trip["group_id"] == group["id"] for trip in trips)
+
+    # The region routes the request to the shard of the group, it must be the region of the group
+    response = await test_app.get(f"/api/v1/groups/{group['id']}/trips?{urlencode({'region': 'Lyon'})}")
+    assert response.json()["trips"] == trips
+
+    await test_app.post(
+        "/api/v1/trips",
+        json={
+            "data_type": "json",
+            "data": [
+                {
+                    "region": "Lille",
+                    "origin": [3.06, 50.63],
+                    "destination": [3.07, 50.64],
+                    "timestamp": "2023-01-02 07:40:00",
+                    "source": "test_point",
+                }
+            ],
+        },
+    )
+    response = await test_app.get(f"/api/v1/groups/{group['id']}/trips?{urlencode({'region': 'Lille'})}")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_should_fail_if_group_doesnt_exists(test_app: AsyncClient):
+    response = await test_app.get("/api/v1/groups/123456/trips")
+
+    assert response.status_code == 404
+    assert response.json() == {"message": "Group 123456 not found"}
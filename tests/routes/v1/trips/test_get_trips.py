@@ -1,12 +1,16 @@
+import json
 from datetime import datetime
 from itertools import chain, combinations
+from typing import Any
 from urllib.parse import urlencode
 
 import pytest
 import pytest_asyncio
+from asgi_lifespan import LifespanManager
 from httpx import AsyncClient
 
-from optimized_shifts.state import DatabaseConnection
+from main import app
+from optimized_shifts.state import DatabaseConnection, state
 
 
 @pytest_asyncio.fixture  # type: ignore # noqa
@@ -38,6 +42,8 @@ async def poblate_test_data(test_db: DatabaseConnection):
                 (1.5, 1.0),
                 datetime(2023, 1, 1, 0, 0, 0),
                 "test_point",
+                None,
+                None,
             ),
             (
                 None,
@@ -46,6 +52,8 @@ async def poblate_test_data(test_db: DatabaseConnection):
                 (1.5, 1.5),
                 datetime(2023, 1, 9, 0, 0, 0),
                 "test_point",
+                None,
+                None,
             ),
             (
                 None,
@@ -54,6 +62,8 @@ async def poblate_test_data(test_db: DatabaseConnection):
                 (1.0, 1.5),
                 datetime(2023, 1, 9, 0, 0, 0),
                 "test_point",
+                None,
+                None,
             ),
             (
                 None,
@@ -62,6 +72,8 @@ async def poblate_test_data(test_db: DatabaseConnection):
                 (3.5, 2.5),
                 datetime(2023, 1, 1, 0, 0, 0),
                 "test_point",
+                None,
+                None,
             ),
             (
                 None,
@@ -70,6 +82,8 @@ async def poblate_test_data(test_db: DatabaseConnection):
                 (3.5, 2.0),
                 datetime(2023, 1, 1, 0, 0, 0),
                 "test_point",
+                None,
+                None,
             ),
             (
                 None,
@@ -78,13 +92,18 @@ async def poblate_test_data(test_db: DatabaseConnection):
                 (3.0, 2.5),
                 datetime(2023, 1, 1, 0, 0, 0),
                 "test_point",
+                None,
+                None,
             ),
         ],
     )
 
+    # Rows inserted directly into trips are not counted in the weekly rollup yet
+    await test_db.execute("SELECT rebuild_trips_weekly_cells()")
+
     yield
 
-    await test_db.fetch("TRUNCATE TABLE regions, trips")
+    await test_db.fetch("TRUNCATE TABLE regions, trips, trips_weekly_cells, trips_sample")
 
 
 @pytest.mark.asyncio
@@ -302,3 +321,186 @@ async def test_should_success_when_parameters_are_correct_and_return_weekly_mean
     assert (
         response.json() == expected_response_json_paris
     ), f"HTTP Response response all parameters were sent is missing or is not equal to {expected_response_json_paris} as expected"
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("poblate_test_data")
+async def test_should_success_when_a_date_range_is_sent_and_return_weekly_mean_of_that_range(
+    test_app: AsyncClient
+):
+    # Paris has one trip in the week of 2022-12-26 and two in the week of 2023-01-09
+    expected_http_code = 200
+
+    q = {
+        "nortest": "2,2",
+        "southest": "0.7,0.7",
+        "region": "Paris",
+        "since": "2023-01-10T00:00:00",
+    }
+    response = await test_app.get(f"/api/v1/trips/stats?{urlencode(q)}")
+    assert response.status_code == expected_http_code
+    assert response.json() == {"mean": 2}
+
+    q = {**q, "since": "2022-12-01T00:00:00", "until": "2023-01-08T00:00:00"}
+    response = await test_app.get(f"/api/v1/trips/stats?{urlencode(q)}")
+    assert response.status_code == expected_http_code
+    assert response.json() == {"mean": 1}
+
+    q = {**q, "since": "2023-01-08T00:00:00", "until": "2022-12-01T00:00:00"}
+    response = await test_app.get(f"/api/v1/trips/stats?{urlencode(q)}")
+    assert response.status_code == 400
+    assert response.json() == {"message": "since must be before until"}
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("poblate_test_data")
+async def test_stats_are_cached_until_trips_are_inserted_in_the_region(test_app: AsyncClient):
+    q = {"nortest": "2,2", "southest": "0.7,0.7", "region": "Paris", "since": "2023-01-10T00:00:00"}
+    response = await test_app.get(f"/api/v1/trips/stats?{urlencode(q)}")
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.json() == {"mean": 2}
+
+    # Same bbox with swapped corners and a date in the same week share the entry
+    q = {**q, "nortest": "0.7,0.7", "southest": "2,2", "since": "2023-01-12T10:00:00"}
+    response = await test_app.get(f"/api/v1/trips/stats?{urlencode(q)}")
+    assert response.headers["X-Cache"] == "HIT"
+    assert response.headers["X-Stats-Source"] in ("raw", "rollup", "mixed")
+    assert response.json() == {"mean": 2}
+
+    # Inserting trips in another region keeps the entry
+    trip = {"origin": [1.2, 1.2], "destination": [1.3, 1.3], "timestamp": "2023-01-10 00:00:00", "source": "test"}
+    request = {"data_type": "json", "data": [{"region": "Santiago", **trip}]}
+    assert (await test_app.post("/api/v1/trips", json=request)).status_code == 201
+    response = await test_app.get(f"/api/v1/trips/stats?{urlencode(q)}")
+    assert response.headers["X-Cache"] == "HIT"
+
+    request = {"data_type": "json", "data": [{"region": "Paris", **trip}]}
+    assert (await test_app.post("/api/v1/trips", json=request)).status_code == 201
+    response = await test_app.get(f"/api/v1/trips/stats?{urlencode(q)}")
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.json() == {"mean": 3}
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("poblate_test_data")
+async def test_batch_stats_are_returned_in_request_order(test_app: AsyncClient):
+    bboxes: list[dict[str, Any]] = [
+        {"nortest": [2, 2], "southest": [0.7, 0.7], "region": "Paris"},
+        {"nortest": [4, 3], "southest": [2.5, 1.5], "region": "Santiago"},
+        {"nortest": [3.5, 0.5], "southest": [3, 0], "region": "Santiago"},
+        {"nortest": [4.5, 3.5], "southest": [0, -1], "region": "Paris"},
+    ]
+
+    response = await test_app.post("/api/v1/trips/stats/batch", json={"bboxes": bboxes})
+
+    assert response.status_code == 200, response.text
+    assert [result["mean"] for result in response.json()["results"]] == [1.5, 3, None, 1.5]
+
+    # Every result matches the one of its own /trips/stats request
+    for bbox, result in zip(bboxes, response.json()["results"]):
+        q = {
+            "nortest": ",".join(map(str, bbox["nortest"])),
+            "southest": ",".join(map(str, bbox["southest"])),
+            "region": bbox["region"],
+        }
+        single = await test_app.get(f"/api/v1/trips/stats?{urlencode(q)}")
+        assert single.json()["mean"] == result["mean"]
+        assert single.headers["X-Stats-Source"] == result["source"]
+
+    response = await test_app.post(
+        "/api/v1/trips/stats/batch", json={"bboxes": bboxes[:1], "since": "2023-01-10T00:00:00"}
+    )
+    assert response.json()["results"][0]["mean"] == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("poblate_test_data")
+async def test_batch_stats_fail_with_unknown_regions(test_app: AsyncClient):
+    bboxes = [
+        {"nortest": [2, 2], "southest": [0.7, 0.7], "region": "Paris"},
+        {"nortest": [2, 2], "southest": [0.7, 0.7], "region": "Lima"},
+    ]
+
+    response = await test_app.post("/api/v1/trips/stats/batch", json={"bboxes": bboxes})
+
+    assert response.status_code == 400
+    assert response.json() == {"message": "Region Lima not found"}
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("poblate_test_data")
+async def test_stats_series_are_streamed_as_ndjson(test_app: AsyncClient):
+    q = {"nortest": "2,2", "southest": "0.7,0.7", "region": "Paris", "series": "true"}
+    response = await test_app.get(f"/api/v1/trips/stats?{urlencode(q)}")
+
+    assert response.status_code == 200, response.text
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert "X-Cache" not in response.headers
+
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines == [
+        {"breakdown": "week", "key": "2022-12-26T00:00:00", "count": 1},
+        {"breakdown": "week", "key": "2023-01-09T00:00:00", "count": 2},
+        {"breakdown": "hour", "key": 0, "count": 3},
+        {"breakdown": "weekday", "key": 1, "count": 2},
+        {"breakdown": "weekday", "key": 7, "count": 1},
+        {"mean": 1.5},
+    ]
+
+    # The mean at the end matches the one of the plain request
+    del q["series"]
+    response = await test_app.get(f"/api/v1/trips/stats?{urlencode(q)}")
+    assert response.json() == lines[-1]
+
+    q = {**q, "series": "true", "since": "2023-01-10T00:00:00"}
+    response = await test_app.get(f"/api/v1/trips/stats?{urlencode(q)}")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines[0] == {"breakdown": "week", "key": "2023-01-09T00:00:00", "count": 2}
+    assert lines[-1] == {"mean": 2}
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("poblate_test_data")
+async def test_stats_are_computed_in_memory_with_the_columnar_backend(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("STATS_BACKEND", "columnar")
+
+    async with LifespanManager(app), AsyncClient(app=app, base_url="http://test") as client:
+        q = {"nortest": "2,2", "southest": "0.7,0.7", "region": "Paris"}
+        response = await client.get(f"/api/v1/trips/stats?{urlencode(q)}")
+        assert response.headers["X-Stats-Source"] == "columnar"
+        assert response.headers["X-Cache"] == "BYPASS"
+        assert response.json() == {"mean": 1.5}
+
+        # Trips inserted by the API are read on the next refresh of the engine
+        trip = {"origin": [1.2, 1.2], "destination": [1.3, 1.3], "timestamp": "2023-01-10 00:00:00", "source": "test"}
+        request = {"data_type": "json", "data": [{"region": "Paris", **trip}]}
+        assert (await client.post("/api/v1/trips", json=request)).status_code == 201
+        response = await client.get(f"/api/v1/trips/stats?{urlencode(q)}")
+        assert response.json() == {"mean": 1.5}
+
+        store, db = state["column_store"], state["database"]
+        assert store is not None and db is not None
+        await store.refresh(db)
+        response = await client.get(f"/api/v1/trips/stats?{urlencode(q)}")
+        assert response.json() == {"mean": 2}
+
+        bbox = {"nortest": [2, 2], "southest": [0.7, 0.7], "region": "Paris"}
+        response = await client.post("/api/v1/trips/stats/batch", json={"bboxes": [bbox]})
+        assert response.json() == {"results": [{"mean": 2, "source": "columnar"}]}
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("poblate_test_data")
+async def test_approx_stats_fall_back_to_the_exact_mean_on_small_bboxes(test_app: AsyncClient):
+    q = {"nortest": "2,2", "southest": "0.7,0.7", "region": "Paris", "mode": "approx"}
+    response = await test_app.get(f"/api/v1/trips/stats?{urlencode(q)}")
+
+    assert response.status_code == 200, response.text
+    assert response.headers["X-Cache"] == "BYPASS"
+    assert response.json() == {"mean": 1.5, "lower": 1.5, "upper": 1.5, "sample_rate": 1}
+
+    response = await test_app.get(f"/api/v1/trips/stats?{urlencode({**q, 'max_error': 0})}")
+    assert response.status_code == 400
+
+    response = await test_app.get(f"/api/v1/trips/stats?{urlencode({**q, 'series': 'true'})}")
+    assert response.status_code == 400
@@ -0,0 +1,114 @@
+import json
+import os
+import time
+from typing import cast
+
+import redis
+from fastapi.testclient import TestClient
+
+from main import app
+from optimized_shifts.celery.config import celeryconfig
+from optimized_shifts.celery.processer import NOTIFICATIONS_CHANNEL, _publish
+
+
+def _wait_for_subscriber(r: "redis.Redis[bytes]", timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        # Without decode_responses the channels are returned as bytes
+        subscribers = dict(cast("list[tuple[bytes, int]]", r.pubsub_numsub(NOTIFICATIONS_CHANNEL)))
+        if subscribers[NOTIFICATIONS_CHANNEL.encode()] > 0:
+            return
+        time.sleep(0.01)
+
+    raise TimeoutError("API didn't subscribe to notifications")
+
+
+def test_notifications_are_sent_once_to_every_client():
+    r = redis.Redis.from_url(celeryconfig.BROKER_URL)
+
+    with TestClient(app) as client:
+        with client.websocket_connect("/api/v1/trips/live") as first, client.websocket_connect(
+            "/api/v1/trips/live"
+        ) as second:
+            _wait_for_subscriber(r)
+
+            notifications = [{"task_id": str(i), "status": "DONE"} for i in range(3)]
+            for notification in notifications:
+                r.publish(NOTIFICATIONS_CHANNEL, json.dumps(notification))
+
+            for ws in (first, second):
+                received = [ws.receive_json() for _ in notifications]
+                assert received == [
+                    {"type": "notification", "data": json.dumps(notification)}
+                    for notification in notifications
+                ]
+
+    r.close()
+
+
+def test_client_disconnection_doesnt_stop_notifications():
+    r = redis.Redis.from_url(celeryconfig.BROKER_URL)
+
+    with TestClient(app) as client:
+        with client.websocket_connect("/api/v1/trips/live") as ws:
+            _wait_for_subscriber(r)
+
+        with client.websocket_connect("/api/v1/trips/live") as ws:
+            r.publish(NOTIFICATIONS_CHANNEL, json.dumps({"task_id": "1", "status": "DONE"}))
+
+            assert ws.receive_json()["type"] == "notification"
+
+    r.close()
+
+
+def test_live_metrics_reports_connected_clients():
+    with TestClient(app) as client:
+        with client.websocket_connect("/api/v1/trips/live"):
+            response = client.get("/api/v1/trips/live/metrics")
+
+            assert response.status_code == 200
+            metrics = response.json()
+            assert metrics["connections"] == 1
+            assert metrics["pid"] == os.getpid()
+            assert metrics["dropped_messages"] == 0
+            assert metrics["slow_client_policy"] == "drop_oldest"
+
+
+def test_subscribed_client_only_receives_its_notifications():
+    r = redis.Redis.from_url(celeryconfig.BROKER_URL)
+
+    with TestClient(app) as client:
+        with client.websocket_connect("/api/v1/trips/live") as ws:
+            _wait_for_subscriber(r)
+
+            ws.send_json({"type": "subscribe", "region": "Turin"})
+            assert ws.receive_json() == {"type": "subscribed", "topic": "region:Turin"}
+
+            other = {"task_id": "1", "status": "DONE", "regions": ["Prague"]}
+            mine = {"task_id": "2", "status": "DONE", "regions": ["Prague", "Turin"]}
+            for notification in (other, mine):
+                r.publish(NOTIFICATIONS_CHANNEL, json.dumps(notification))
+
+            assert ws.receive_json() == {"type": "notification", "data": json.dumps(mine)}
+
+    r.close()
+
+
+def test_task_subscription_replays_last_status():
+    r = redis.Redis.from_url(celeryconfig.BROKER_URL)
+
+    with TestClient(app) as client:
+        with client.websocket_connect("/api/v1/trips/live") as ws:
+            _wait_for_subscriber(r)
+
+            notification = {"task_id": "late", "status": "DONE"}
+            _publish(r, notification)
+            assert ws.receive_json()["data"] == json.dumps(notification)
+
+        with client.websocket_connect("/api/v1/trips/live") as ws:
+            ws.send_json({"type": "subscribe", "task_id": "late"})
+
+            assert ws.receive_json() == {"type": "subscribed", "topic": "task:late"}
+            assert ws.receive_json() == {"type": "notification", "data": json.dumps(notification)}
+
+    r.close()
@@ -40,3 +40,66 @@ async def test_create_point_sending_json_request(
     assert point.get("region_id") == region["region_id"]
     assert point.get("timestamp") == utcnow
     assert point.get("source") == "test_point"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "trip",
+    [
+        {"origin": "[1.0]"},
+        {"origin": "not a point"},
+        {"destination": [1.0, 2.0, 3.0]},
+        {"timestamp": "2023-01-01T00:00:00Z"},
+        {"timestamp": "yesterday"},
+    ],
+)
+async def test_invalid_trips_are_rejected(test_app: AsyncClient, trip: dict[str, object]):
+    request = {
+        "data_type": "json",
+        "data": [
+            {
+                "region": "Paris",
+                "origin": [1.0, 1.0],
+                "destination": "[1.5, 1.0]",
+                "timestamp": "2023-01-01 00:00:00",
+                "source": "test_point",
+                **trip,
+            }
+        ],
+    }
+
+    response = await test_app.post("/api/v1/trips", json=request)
+
+    assert response.status_code == 400, response.text
+    # Body errors are reported with the field that failed, not as missing query parameters
+    message = response.json()["message"]
+    assert "query parameters" not in message
+    assert next(iter(trip)) in message
+
+
+@pytest.mark.asyncio
+async def test_json_insertion_schedules_weekly_cells_compaction(
+    test_app: AsyncClient, test_db: DatabaseConnection, monkeypatch: pytest.MonkeyPatch
+):
+    scheduled: list[list[int]] = []
+    monkeypatch.setattr(
+        "optimized_shifts.routes.v1.trips.compact_weekly_cells.delay", scheduled.append
+    )
+    request = {
+        "data_type": "json",
+        "data": [
+            {
+                "region": "Paris",
+                "origin": "[1.0, 1.0]",
+                "destination": "[1.5, 1.0]",
+                "timestamp": "2023-01-02 10:00:00",
+                "source": "test_point",
+            }
+        ],
+    }
+
+    response = await test_app.post("/api/v1/trips", json=request)
+
+    assert response.status_code == 201, response.text
+    region_id = await test_db.fetchval("SELECT region_id FROM regions WHERE region_name = 'Paris'")
+    assert scheduled == [[region_id]]
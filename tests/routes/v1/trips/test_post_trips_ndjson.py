@@ -0,0 +1,124 @@
+import json
+
+import pytest
+from httpx import AsyncClient
+
+from optimized_shifts.routes.v1.trips import MAX_LINE_SIZE
+from optimized_shifts.state import DatabaseConnection
+
+NDJSON = {"Content-Type": "application/x-ndjson"}
+
+
+def _trip(region: str, day: int) -> str:
+    return json.dumps(
+        {
+            "region": region,
+            "origin": [14.43, 50.04],
+            "destination": [14.47, 50.09],
+            "timestamp": f"2018-05-{day:02d} 09:03:40",
+            "source": "funny_car",
+        }
+    )
+
+
+@pytest.mark.asyncio
+async def test_ndjson_is_inserted_in_batches(test_app: AsyncClient, test_db: DatabaseConnection):
+    lines = [_trip("Prague", day) for day in range(1, 6)]
+    lines.insert(2, '{"region": "Prague"}')
+    lines.insert(4, "not json")
+
+    async def body():
+        # The body arrives in pieces that split lines in the middle
+        payload = ("\n".join(lines) + "\n").encode()
+        for start in range(0, len(payload), 7):
+            yield payload[start : start + 7]
+
+    before = await test_db.fetchval("SELECT count(*) FROM trips")
+    response = await test_app.post("/api/v1/trips/ndjson?batch_size=3", content=body(), headers=NDJSON)
+
+    assert response.status_code == 201, response.text
+    result = response.json()
+    assert result["inserted"] == 5
+    assert result["failed"] == 2
+    assert result["batch_count"] == 3
+    # The last batch has no failures, so it isn't detailed
+    assert [(b["first_line"], b["last_line"], b["inserted"], b["failed"]) for b in result["batches"]] == [
+        (1, 3, 2, 1),
+        (4, 6, 2, 1),
+    ]
+    assert [error["line"] for error in result["batches"][0]["errors"]] == [3]
+    assert [error["line"] for error in result["batches"][1]["errors"]] == [5]
+
+    assert await test_db.fetchval("SELECT count(*) FROM trips") - before == 5
+
+
+@pytest.mark.asyncio
+async def test_ndjson_response_details_a_bounded_number_of_batches(
+    test_app: AsyncClient, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr("optimized_shifts.routes.v1.trips.MAX_REPORTED_BATCHES", 2)
+    body = "\n".join(line for day in range(1, 6) for line in (_trip("Genoa", day), "not json"))
+
+    response = await test_app.post("/api/v1/trips/ndjson?batch_size=2", content=body, headers=NDJSON)
+
+    assert response.status_code == 201, response.text
+    result = response.json()
+    assert (result["inserted"], result["failed"], result["batch_count"]) == (5, 5, 5)
+    assert [b["batch"] for b in result["batches"]] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_ndjson_reports_oversized_lines(test_app: AsyncClient, test_db: DatabaseConnection):
+    body = "\n".join([_trip("Turin", 1), "x" * (MAX_LINE_SIZE + 1), _trip("Turin", 2)])
+
+    response = await test_app.post("/api/v1/trips/ndjson", content=body, headers=NDJSON)
+
+    assert response.status_code == 201, response.text
+    result = response.json()
+    assert result["inserted"] == 2
+    assert result["batches"][0]["errors"][0]["line"] == 2
+
+
+@pytest.mark.asyncio
+async def test_ndjson_requires_content_type(test_app: AsyncClient):
+    response = await test_app.post("/api/v1/trips/ndjson", content=_trip("Turin", 1))
+
+    assert response.status_code == 415
+
+
+@pytest.mark.asyncio
+async def test_ndjson_schedules_a_single_compaction(
+    test_app: AsyncClient, test_db: DatabaseConnection, monkeypatch: pytest.MonkeyPatch
+):
+    scheduled: list[list[int]] = []
+    monkeypatch.setattr(
+        "optimized_shifts.routes.v1.trips.compact_weekly_cells.delay", scheduled.append
+    )
+    body = "\n".join(_trip(region, day) for day in range(1, 6) for region in ("Lyon", "Nice"))
+
+    response = await test_app.post("/api/v1/trips/ndjson?batch_size=2", content=body, headers=NDJSON)
+
+    assert response.status_code == 201, response.text
+    assert response.json()["batch_count"] == 5
+    region_ids = await test_db.fetch(
+        "SELECT region_id FROM regions WHERE region_name IN ('Lyon', 'Nice')"
+    )
+    assert [sorted(ids) for ids in scheduled] == [sorted(row["region_id"] for row in region_ids)]
+
+
+@pytest.mark.asyncio
+async def test_ndjson_is_negotiated_on_the_trips_route(test_app: AsyncClient, test_db: DatabaseConnection):
+    async def body():
+        for day in range(1, 4):
+            yield (_trip("Bordeaux", day) + "\n").encode()
+
+    before = await test_db.fetchval("SELECT count(*) FROM trips")
+    response = await test_app.post(
+        "/api/v1/trips?batch_size=2",
+        content=body(),
+        headers={"Content-Type": "application/x-ndjson; charset=utf-8"},
+    )
+
+    assert response.status_code == 201, response.text
+    assert (response.json()["inserted"], response.json()["batch_count"]) == (3, 2)
+    assert await test_db.fetchval("SELECT count(*) FROM trips") - before == 3
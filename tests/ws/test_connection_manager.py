@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+from starlette.websockets import WebSocketState
+
+from optimized_shifts.ws import ConnectionManager
+
+
+class FakeWebSocket:
+    """WebSocket whose sends can be paused to simulate a slow client"""
+
+    def __init__(self, fail: bool = False):
+        self.application_state = WebSocketState.CONNECTING
+        self.sent: list[str] = []
+        self.fail = fail
+        self.ready = asyncio.Event()
+        self.ready.set()
+
+    async def accept(self):
+        self.application_state = WebSocketState.CONNECTED
+
+    async def close(self):
+        self.application_state = WebSocketState.DISCONNECTED
+
+    async def send_text(self, message: str):
+        await self.ready.wait()
+        if self.fail:
+            raise RuntimeError("Connection lost")
+        self.sent.append(message)
+
+
+async def _drain():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_slow_client_doesnt_delay_the_others():
+    manager = ConnectionManager(max_queue_size=10)
+    slow, fast = FakeWebSocket(), FakeWebSocket()
+    slow.ready.clear()
+    await manager.connect(slow)  # type: ignore
+    await manager.connect(fast)  # type: ignore
+
+    for i in range(3):
+        await manager.broadcast(str(i))
+    await _drain()
+
+    assert fast.sent == ["0", "1", "2"]
+    assert slow.sent == []
+    assert manager.metrics()["max_queue_depth"] == 2
+
+    slow.ready.set()
+    await _drain()
+
+    assert slow.sent == ["0", "1", "2"]
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_drop_oldest_policy_keeps_latest_messages():
+    manager = ConnectionManager(max_queue_size=2, slow_client_policy="drop_oldest")
+    slow = FakeWebSocket()
+    slow.ready.clear()
+    await manager.connect(slow)  # type: ignore
+    await _drain()
+
+    for i in range(5):
+        await manager.broadcast(str(i))
+        await _drain()
+
+    # The writer holds "0" while waiting to send it, so "1" and "2" are dropped
+    assert manager.metrics()["dropped_messages"] == 2
+
+    slow.ready.set()
+    await _drain()
+
+    assert slow.sent == ["0", "3", "4"]
+    assert slow.application_state == WebSocketState.CONNECTED
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_disconnect_policy_closes_slow_clients():
+    manager = ConnectionManager(max_queue_size=1, slow_client_policy="disconnect")
+    slow, fast = FakeWebSocket(), FakeWebSocket()
+    slow.ready.clear()
+    await manager.connect(slow)  # type: ignore
+    await manager.connect(fast)  # type: ignore
+    await _drain()
+
+    for i in range(3):
+        await manager.broadcast(str(i))
+        await _drain()
+
+    assert manager.active_connections == [fast]
+    assert slow.application_state == WebSocketState.DISCONNECTED
+    assert fast.sent == ["0", "1", "2"]
+    assert manager.metrics()["slow_disconnections"] == 1
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_failing_client_is_disconnected():
+    manager = ConnectionManager()
+    broken = FakeWebSocket(fail=True)
+    await manager.connect(broken)  # type: ignore
+
+    await manager.broadcast("0")
+    await _drain()
+
+    assert manager.active_connections == []
+    assert broken.application_state == WebSocketState.DISCONNECTED
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        ConnectionManager(slow_client_policy="ignore")  # type: ignore
+
+
+@pytest.mark.asyncio
+async def test_publish_routes_by_topic():
+    manager = ConnectionManager()
+    task, region, everything = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+    for ws in (task, region, everything):
+        await manager.connect(ws)  # type: ignore
+    manager.subscribe(task, "task:1")  # type: ignore
+    manager.subscribe(region, "region:Turin")  # type: ignore
+    manager.subscribe(region, "task:1")  # type: ignore
+
+    await manager.publish("a", ["task:1", "region:Turin"])
+    await manager.publish("b", ["task:2", "region:Prague"])
+    await _drain()
+
+    assert task.sent == ["a"]
+    assert region.sent == ["a"]
+    assert everything.sent == ["a", "b"]
+
+    await manager.disconnect(region)  # type: ignore
+    assert manager.subscribers == {"task:1": {task}}
+    await manager.close()